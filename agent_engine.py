@@ -0,0 +1,198 @@
+import asyncio
+import functools
+import itertools
+import queue
+import threading
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been superseded or cancelled."""
+
+
+class JobContext:
+    """Handed to a running job: lets it stream partial output and notice cancellation."""
+
+    def __init__(self, engine, slot, job_id):
+        self.engine = engine
+        self.slot = slot
+        self.job_id = job_id
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.cancel_callbacks = []
+
+    def emit(self, text):
+        """Send a chunk of partial output to the UI queue."""
+        self.check()
+        self.engine.results.put(("chunk", self.slot, self.job_id, text))
+
+    def restart(self):
+        """Tell the UI to drop the partial output sent so far (the reply is being requested again)."""
+        self.check()
+        self.engine.results.put(("restart", self.slot, self.job_id, None))
+
+    def check(self):
+        """Raise JobCancelled if the job was cancelled (call between blocking steps)."""
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def on_cancel(self, callback):
+        """Call `callback()` (from the cancelling thread) when the job is cancelled, e.g. to abort a request."""
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            callbacks, self.cancel_callbacks = self.cancel_callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class AgentEngine:
+    """
+    Runs agent calls on one background asyncio loop.
+
+    Jobs are submitted from the Tk thread against a "slot" (e.g. the target
+    text area). Submitting to a busy slot cancels the job already there, at
+    most `max_concurrency` calls run at once, and several slots can be
+    submitted together to fan independent agents out over the same input.
+
+    Every outcome goes onto `results`, a thread-safe queue of
+    (kind, slot, job_id, payload) tuples with kind "chunk", "restart", "done",
+    "error" or "cancelled"; the Tk loop drains it with drain().
+
+    Each job runs on a thread of its own and keeps its place until that
+    thread has returned, so at most `max_concurrency` calls are ever in
+    flight. Cancelling a job runs its context.on_cancel callbacks (the app
+    uses them to abort the job's HTTP requests) and the job stops at its
+    next context.check(); its place is freed once it has.
+    """
+
+    def __init__(self, max_concurrency=4):
+        self.results = queue.Queue()
+        self.job_ids = itertools.count(1)
+        self.active = {}  # slot -> (job_id, task, context); only touched on the loop thread
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.max_concurrency = max_concurrency
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, name="agent-engine", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.ready.set()
+        self.loop.run_forever()
+
+    def submit(self, slot, job):
+        """
+        Run `job(context)` (a blocking callable returning the final text) for `slot`.
+
+        Any job still running for the same slot is cancelled first.
+
+        Returns:
+            int: The job id, used to tell fresh results from stale ones.
+        """
+        job_id = next(self.job_ids)
+        self.loop.call_soon_threadsafe(self._start, slot, job_id, job)
+        return job_id
+
+    def fan_out(self, jobs):
+        """Submit several independent jobs at once. Returns {slot: job_id}."""
+        return {slot: self.submit(slot, job) for slot, job in jobs.items()}
+
+    def cancel(self, slot):
+        self.loop.call_soon_threadsafe(self._cancel, slot)
+
+    def cancel_all(self):
+        self.loop.call_soon_threadsafe(self._cancel_all)
+
+    def drain(self, limit=1000):
+        """Return pending results without blocking (called from the Tk loop)."""
+        messages = []
+        while len(messages) < limit:
+            try:
+                messages.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def shutdown(self):
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+    # --- loop thread ---
+    def _start(self, slot, job_id, job):
+        self._cancel(slot)
+        context = JobContext(self, slot, job_id)
+        task = self.loop.create_task(self._run_job(context, job))
+        task.add_done_callback(functools.partial(self._report_unstarted, context))
+        self.active[slot] = (job_id, task, context)
+
+    def _report_unstarted(self, context, task):
+        # A task cancelled before its first step never enters _run_job, which reports all the others
+        if task.cancelled():
+            self.results.put(("cancelled", context.slot, context.job_id, None))
+
+    def _cancel(self, slot):
+        entry = self.active.pop(slot, None)
+        if entry is not None:
+            _, task, context = entry
+            context.cancel()  # aborts its requests; a streaming job also stops between chunks
+            task.cancel()
+
+    def _cancel_all(self):
+        for slot in list(self.active):
+            self._cancel(slot)
+
+    def _in_thread(self, job, context):
+        """Start `job(context)` on its own thread; returns a future for its result."""
+        future = self.loop.create_future()
+
+        def settle(result, error):
+            if future.done():
+                return  # cancelled meanwhile
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def run():
+            try:
+                result = job(context)
+            except Exception as e:
+                self.loop.call_soon_threadsafe(settle, None, e)
+            else:
+                self.loop.call_soon_threadsafe(settle, result, None)
+
+        threading.Thread(target=run, name=f"agent-{context.job_id}", daemon=True).start()
+        return future
+
+    async def _run_job(self, context, job):
+        try:
+            async with self.semaphore:
+                context.check()
+                worker = self._in_thread(job, context)
+                try:
+                    result = await asyncio.shield(worker)
+                except asyncio.CancelledError:
+                    # Hold the place until the thread has actually stopped
+                    await asyncio.wait([worker])
+                    worker.exception()  # retrieved, the job is reported as cancelled
+                    raise
+            self.results.put(("done", context.slot, context.job_id, result))
+        except (asyncio.CancelledError, JobCancelled):
+            context.cancel()
+            self.results.put(("cancelled", context.slot, context.job_id, None))
+        except Exception as e:
+            self.results.put(("error", context.slot, context.job_id, str(e)))
+        finally:
+            entry = self.active.get(context.slot)
+            if entry is not None and entry[0] == context.job_id:
+                del self.active[context.slot]
@@ -0,0 +1,488 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import requests
+
+import metrics
+from cloudflare_client import (DEFAULT_MAX_TOKENS, cancel_scope, cloudflare_chat_completion, current_cancel_scope,
+                               stream_cloudflare_chat_completion)
+from routing import answered, get_router
+from scheduler import current_priority, estimate_tokens
+from voucher_check import AmountError, correction_message, verify_voucher
+from voucher_extract import VoucherFormatError, extract_voucher, extraction_stats
+
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+
+# How many targeted correction turns an unbalanced voucher gets
+MAX_CORRECTIONS = 2
+
+# Agents run by the voucher chain: agent_1 drafts the voucher. The JSON is then
+# extracted locally; agent_2 is only called when that fails.
+VOUCHER_CHAIN = ("agent_1",)
+EXTRACTION_AGENT = "agent_2"
+
+# Define system prompts for different AI agents
+SYSTEM_PROMPTS = {
+    "agent_1": 
+'''
+你是一名会计师，根据最新中国会计准则和我的输入制作会计凭证。会计凭证的格式为json和表格，包括（编号，科目，摘要，借方金额，贷方金额）。增值税率为13%。
+# 凭证制作要求
+1. 在输出时候请确认借贷平衡。
+2. 在金额含税的情况下根据增值税率计算进项或者销项的金额，方便在凭证中使用。
+3. 当出现熟悉公式时计算公式，例如：输入 1000*10 ，返回 10000。
+# 科目要求
+1. 一级科目选择要遵守最新的中国的企业会计准则。 参考（https://www.zkemu.com/acc4/u/kjkm/）
+# Json要求
+1. “借方合计”和“贷方合计”使用数字格式，非字符串。
+2. 对Json对象进行计算。“借方合计”和“贷方合计”为“明细"中的合计（相加）。校验Json对象是否符合Json的格式要求。
+如果“借方合计”和“贷方合计”不一致则代表借贷不平衡（“借方合计”和“贷方合计”是汇总“明细”里面的金额，请执行校验步骤避免错误）。
+3. 使用计算器用加法分别计算"借方金额"和"贷方金额"的和，保存在“合计”中的“借方合计”和“贷方合计”。
+4. 比较合计中的"借方合计”和“贷方合计” ，如果一致则“平衡”是 true，否则为 false 。保存在“合计“中。
+
+Json示例：
+{
+"明细": [
+{
+"编号": "1",
+"科目": "银行存款",
+"摘要": "收回维力贸易公司前欠购货款",
+"借方金额": "52100",
+"贷方金额": null
+},
+{
+"编号": "1",
+"科目": "应收账款-维力贸易公司",
+"摘要": "收回前欠购货款",
+"借方金额": null,
+"贷方金额": "52100"
+}
+],
+"合计": {
+"借方合计": 52100,
+"贷方合计": 52100,
+ "平衡“: true
+}
+}
+。
+
+
+表格示例：
+
+| 编号 | 科目               | 摘要                     | 借方金额 | 贷方金额 |
+|------|--------------------|--------------------------|----------|----------|
+| 1    | 银行存款           | 收回维力贸易公司前欠购货款 | 52100    |          |
+| 1    | 应收账款-维力贸易公司 | 收回前欠购货款             |          | 52100    |
+| |  |  合计 | 52100    | 52100    |
+
+。
+
+''',
+
+    "agent_2":
+'''
+please only return the json object in the input
+''',
+
+    "agent_3": "You are a legal consultant for financial agreements. Provide guidance on contracts and obligations."
+}
+
+# agent_1 without the markdown table and the long worked example: JSON only
+COMPACT_AGENT_1_PROMPT = (
+    "你是一名会计师，按最新中国企业会计准则把输入的经济业务做成会计凭证，增值税率13%。\n"
+    "只输出一个JSON对象，不要输出任何其他文字：\n"
+    '{"明细":[{"编号":"1","科目":"一级科目-明细科目","摘要":"...","借方金额":"金额或null","贷方金额":"金额或null"}],'
+    '"合计":{"借方合计":数字,"贷方合计":数字,"平衡":true}}\n'
+    "要求：借贷必须平衡；含税金额拆分出进项或销项税额；算式先算出结果；明细金额用字符串，合计用数字。"
+)
+
+# Agents whose replies are voucher JSON, so profiles may shrink and size their requests
+PROFILE_AGENTS = ("agent_1", EXTRACTION_AGENT)
+
+
+class PromptProfile:
+    """
+    How voucher agents are prompted: which system prompts, whether the API's
+    JSON response mode is requested, and how max_tokens is chosen.
+
+    With `reply_base` set, max_tokens is sized from the input instead of the
+    fixed DEFAULT_MAX_TOKENS: reply_base + reply_per_token * input tokens. A
+    reply cut off at that limit is asked for again with the full budget.
+    """
+
+    def __init__(self, name, prompts=None, response_format=None, reply_base=None, reply_per_token=0.0):
+        self.name = name
+        self.prompts = prompts or {}
+        self.response_format = response_format
+        self.reply_base = reply_base
+        self.reply_per_token = reply_per_token
+
+    def system_prompts(self, base=SYSTEM_PROMPTS):
+        """`base` with this profile's prompt variants applied."""
+        return dict(base, **self.prompts) if self.prompts else base
+
+    def max_tokens(self, text):
+        if self.reply_base is None:
+            return DEFAULT_MAX_TOKENS
+        needed = self.reply_base + self.reply_per_token * estimate_tokens([{"content": text}])
+        return min(DEFAULT_MAX_TOKENS, int(needed))
+
+    def request_options(self, agent_key, text):
+        """
+        Keyword arguments for cloudflare_chat_completion when `agent_key` answers `text`.
+
+        Voucher agents' replies are only cached when a voucher can be extracted
+        from them, so asking again after a bad reply reaches the model.
+        """
+        if agent_key not in PROFILE_AGENTS:
+            return {}
+        options = {"max_tokens": self.max_tokens(text), "cacheable": _voucher_answer}
+        if self.response_format is not None:
+            options["response_format"] = self.response_format
+        return options
+
+
+PROMPT_PROFILES = {
+    # The original prompt (JSON + markdown table) with a fixed 4096 token budget
+    "full": PromptProfile("full"),
+    # Same prompt, max_tokens sized from the input (the table roughly doubles the reply)
+    "full-sized": PromptProfile("full-sized", reply_base=768, reply_per_token=6),
+    # JSON-only prompt, sized budget
+    "compact": PromptProfile("compact", {"agent_1": COMPACT_AGENT_1_PROMPT}, reply_base=384, reply_per_token=3),
+    # JSON-only prompt plus the API's JSON mode
+    "json": PromptProfile("json", {"agent_1": COMPACT_AGENT_1_PROMPT}, {"type": "json_object"},
+                          reply_base=384, reply_per_token=3),
+}
+
+# Pick with AGENT_PROMPT_PROFILE (or batch.py --profile); "full" keeps the original behaviour
+_active_profile = PROMPT_PROFILES.get(os.getenv("AGENT_PROMPT_PROFILE", "full"), PROMPT_PROFILES["full"])
+
+# Models that rejected response_format; they are asked again (and from then on) without it
+JSON_MODE_REJECTED = (400, 422)
+_no_json_mode = set()
+_no_json_mode_lock = threading.Lock()
+
+
+class AgentError(Exception):
+    """Raised when an agent call fails or returns something unusable."""
+
+
+def get_prompt_profile():
+    """The PromptProfile used by the voucher agents."""
+    return _active_profile
+
+
+def set_prompt_profile(name):
+    """
+    Switch the voucher agents to another entry of PROMPT_PROFILES.
+
+    Raises:
+        KeyError: If `name` is not a known profile.
+    """
+    global _active_profile
+    _active_profile = PROMPT_PROFILES[name]
+    return _active_profile
+
+
+class ProfileRequest:
+    """
+    Retry rules of one voucher agent request, shared by chat() and stream_chat().
+
+    JSON mode is dropped (for this request and, from then on, for the model)
+    when the model rejects it with 400/422, and a reply cut off at a sized
+    max_tokens is asked for again with the full budget. Each rule fires at
+    most once, so a request takes at most three attempts.
+    """
+
+    def __init__(self, model, max_tokens=DEFAULT_MAX_TOKENS, response_format=None):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.response_format = None if model in _no_json_mode else response_format
+
+    def retry(self, status=None, finish_reason=None):
+        """
+        Decide on the attempt just made.
+
+        Returns:
+            bool: True if the request must be sent again (with the updated
+            max_tokens / response_format).
+        """
+        if self.response_format is not None and status in JSON_MODE_REJECTED:
+            with _no_json_mode_lock:
+                _no_json_mode.add(self.model)
+            self.response_format = None
+            return True
+        if finish_reason == "length" and self.max_tokens < DEFAULT_MAX_TOKENS:
+            metrics.registry.inc("cf_truncated_total", model=self.model)
+            self.max_tokens = DEFAULT_MAX_TOKENS
+            return True
+        return False
+
+
+_local = threading.local()
+
+
+def current_limiter():
+    """Rate limiter of the calling thread (see request_limiter), or None."""
+    return getattr(_local, "limiter", None)
+
+
+@contextmanager
+def request_limiter(limiter):
+    """
+    Make every API request sent by the enclosed calls (on this thread) wait
+    for `limiter` (anything with a blocking wait(), e.g. batch.RateLimiter).
+
+    Every upstream attempt (HTTP retries, correction turns, the agent_2
+    fallback and hedged requests) takes its own token inside the API client,
+    while cache hits take none, so the limiter caps the actual request rate.
+    """
+    previous = current_limiter()
+    _local.limiter = limiter
+    try:
+        yield
+    finally:
+        _local.limiter = previous
+
+
+def chat(auth_token, account_id, model, messages, max_tokens=DEFAULT_MAX_TOKENS, response_format=None,
+         priority=None, coalesce=True, limiter=None, cacheable=None):
+    """
+    cloudflare_chat_completion with the profile extras handled (see ProfileRequest).
+
+    Requests sent upstream wait for `limiter` (default: the thread's request_limiter).
+    """
+    limiter = limiter or current_limiter()
+    request = ProfileRequest(model, max_tokens, response_format)
+    while True:
+        response = cloudflare_chat_completion(auth_token, account_id, model, messages, priority=priority,
+                                              max_tokens=request.max_tokens,
+                                              response_format=request.response_format, coalesce=coalesce,
+                                              limiter=limiter, cacheable=cacheable)
+        choice = (response.get("choices") or [{}])[0]
+        if not request.retry(response.get("status"), choice.get("finish_reason")):
+            return response
+
+
+def stream_chat(auth_token, account_id, model, messages, max_tokens=DEFAULT_MAX_TOKENS, response_format=None,
+                priority=None, restart=None, limiter=None, cacheable=None):
+    """
+    Streaming chat(): yield the reply's text as it arrives, with the same retries.
+
+    A model rejecting JSON mode is asked again without it before anything is
+    streamed. A reply cut off at a sized max_tokens is streamed again with the
+    full budget; `restart()` is called first so the caller can drop the text
+    it has shown. Requests sent upstream wait for `limiter` as in chat().
+
+    Raises:
+        requests.exceptions.RequestException: On network or HTTP errors.
+    """
+    limiter = limiter or current_limiter()
+    request = ProfileRequest(model, max_tokens, response_format)
+    while True:
+        outcome = {}
+        streamed = False
+        try:
+            for text in stream_cloudflare_chat_completion(auth_token, account_id, model, messages,
+                                                          priority=priority, max_tokens=request.max_tokens,
+                                                          response_format=request.response_format,
+                                                          outcome=outcome, limiter=limiter,
+                                                          cacheable=cacheable):
+                streamed = True
+                yield text
+        except requests.exceptions.HTTPError as e:
+            if streamed or not request.retry(status=getattr(e.response, "status_code", None)):
+                raise
+            continue
+        if not request.retry(finish_reason=outcome.get("finish_reason")):
+            return
+        if streamed and restart is not None:
+            restart()
+
+
+def _voucher_answer(response):
+    # A voucher agent's reply only counts if a voucher can be extracted from it
+    if not answered(response):
+        return False
+    try:
+        extract_voucher(response["choices"][0]["message"]["content"])
+    except VoucherFormatError:
+        return False
+    return True
+
+
+def agent_model(agent_key, model):
+    """The model `agent_key` runs on: its AGENT_MODELS route, else `model`."""
+    return get_router().model_for(agent_key, model)
+
+
+def routed_chat(agent_key, auth_token, account_id, model, messages, **options):
+    """
+    chat() on the model routed for `agent_key`, hedged if the router hedges.
+
+    `model` is the default for agents without a route of their own. For the
+    voucher agents, only a reply holding a voucher counts as an answer when
+    a hedged pair races.
+    """
+    # The hedge runs on another thread
+    priority = current_priority()
+    limiter = current_limiter()
+    scope = current_cancel_scope()
+
+    def send(routed_model, hedge):
+        with cancel_scope(scope):
+            return chat(auth_token, account_id, routed_model, messages, priority=priority, coalesce=not hedge,
+                        limiter=limiter, **options)
+
+    valid = _voucher_answer if agent_key in PROFILE_AGENTS else answered
+    return get_router().call(agent_key, model, send, valid)
+
+
+def remove_first_and_last_lines(text):
+    """
+    Removes the first and last lines from a multi-line text string.
+
+    Args:
+    text: A string containing multiple lines of text.
+
+    Returns:
+    A string containing the text with the first and last lines removed.
+    Returns an empty string if the input text has less than 3 lines.
+    """
+    lines = text.splitlines()
+    if not text.startswith('```'):return text
+    if len(lines) < 3:
+        return text  # Or raise an exception if you prefer, e.g., ValueError("Text must have at least 3 lines")
+    else:
+        return "\n".join(lines[1:-1])
+
+
+def build_messages(agent_key, text, system_prompts=SYSTEM_PROMPTS):
+    """Build the chat messages for an agent: its system prompt plus the user input."""
+    return [
+        {"role": "system", "content": system_prompts.get(agent_key, DEFAULT_SYSTEM_PROMPT)},
+        {"role": "user", "content": text}
+    ]
+
+
+def response_content(response):
+    """
+    Pull the assistant text out of a chat completion response.
+
+    Raises:
+        AgentError: If the response carries an error or no content.
+    """
+    if "error" in response:
+        raise AgentError(response["error"])
+    content = response.get("choices", [{}])[0].get("message", {}).get("content")
+    if not content:
+        raise AgentError("No content received")
+    return content
+
+
+def run_agent(agent_key, text, auth_token, account_id, model, system_prompts=SYSTEM_PROMPTS):
+    """
+    Run a single agent on `text` and return its reply.
+
+    The active prompt profile picks agent_1's prompt variant and the
+    request options (max_tokens, JSON mode); the router picks the model
+    (`model` unless the agent has a route) and hedges slow calls.
+
+    Raises:
+        AgentError: If the API call fails.
+    """
+    profile = get_prompt_profile()
+    messages = build_messages(agent_key, text, profile.system_prompts(system_prompts))
+    response = routed_chat(agent_key, auth_token, account_id, model, messages,
+                           **profile.request_options(agent_key, text))
+    return response_content(response)
+
+
+def run_chain(text, auth_token, account_id, model, chain=VOUCHER_CHAIN, system_prompts=SYSTEM_PROMPTS):
+    """
+    Feed `text` through a chain of agents, each one's reply becoming the next one's input.
+
+    Returns:
+        str: The reply of the last agent in the chain.
+    """
+    for agent_key in chain:
+        text = run_agent(agent_key, text, auth_token, account_id, model, system_prompts)
+    return text
+
+
+def parse_voucher(text):
+    """
+    Parse a voucher JSON object from an agent reply (fenced, bare or mixed with the table).
+
+    Raises:
+        AgentError: If the reply holds no valid voucher object.
+    """
+    try:
+        return extract_voucher(text)
+    except VoucherFormatError as e:
+        raise AgentError(f"Invalid voucher JSON: {e}")
+
+
+def extract_voucher_with_fallback(reply, auth_token, account_id, model, system_prompts=SYSTEM_PROMPTS):
+    """
+    Get the voucher out of an agent_1 reply, locally if possible.
+
+    Only when local extraction fails is the reply sent to the extraction
+    agent (agent_2). The outcome is counted in voucher_extract.extraction_stats.
+
+    Raises:
+        AgentError: If neither the local extractor nor the agent yields a voucher.
+    """
+    try:
+        voucher = extract_voucher(reply)
+    except VoucherFormatError:
+        pass
+    else:
+        extraction_stats.record("local")
+        return voucher
+    try:
+        voucher = parse_voucher(run_agent(EXTRACTION_AGENT, reply, auth_token, account_id, model, system_prompts))
+    except AgentError:
+        extraction_stats.record("failed")
+        raise
+    extraction_stats.record("fallback")
+    return voucher
+
+
+def balance_voucher(voucher, question, reply, auth_token, account_id, model,
+                    system_prompts=SYSTEM_PROMPTS, max_corrections=MAX_CORRECTIONS):
+    """
+    Verify a voucher's totals locally and ask agent_1 to fix it if it does not balance.
+
+    Totals and the 进项/销项 VAT lines are recomputed with exact arithmetic
+    (voucher_check.verify_voucher). A failing voucher is not regenerated: the
+    conversation is continued with a correction message naming the two
+    totals and the difference, or the VAT found and expected.
+
+    Returns:
+        tuple: (voucher, result, corrections) where result is the last
+        verify_voucher result and corrections the number of follow-up calls.
+    """
+    profile = get_prompt_profile()
+    messages = build_messages("agent_1", question, profile.system_prompts(system_prompts))
+    options = profile.request_options("agent_1", question)
+    corrections = 0
+    while True:
+        try:
+            result = verify_voucher(voucher)
+        except AmountError as e:
+            raise AgentError(str(e))
+        if (result["balanced"] and result["vat_ok"]) or corrections >= max_corrections:
+            return voucher, result, corrections
+        messages = messages + [
+            {"role": "assistant", "content": reply},
+            {"role": "user", "content": correction_message(result)},
+        ]
+        corrections += 1
+        reply = response_content(routed_chat("agent_1", auth_token, account_id, model, messages, **options))
+        try:
+            voucher = extract_voucher(reply)
+        except VoucherFormatError:
+            # Keep the previous draft and let the next round (or the caller) decide
+            continue
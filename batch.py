@@ -0,0 +1,410 @@
+"""
+Headless batch voucher pipeline.
+
+Reads bank-statement lines from a CSV or JSONL file, runs each one through the
+agent chain (agent_1, then local JSON extraction) on a bounded worker pool with an overall
+requests-per-second cap, and writes one voucher JSON file per input line. The
+files take the next free voucher numbers of the output directory through the
+same allocator as the app, so --out can be the app's own voucher directory
+while it is running; nothing already there is overwritten.
+
+Usage:
+    python batch.py transactions.csv --out vouchers --workers 8 --rps 4
+
+Progress is journaled to a checkpoint file, so re-running the same command
+after a crash only processes the lines that have not produced a voucher yet.
+
+Each line is first looked up in a duplicate index of the lines before it (and
+of the vouchers in --archive); a likely duplicate is reported, skipped, or
+turned into a voucher from the earlier one without an API call (--duplicates).
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Before the imports below: the scheduler, routing, agents, response cache and
+# API client read their settings from the environment when they are imported
+load_dotenv()
+
+from agents import (PROMPT_PROFILES, SYSTEM_PROMPTS, VOUCHER_CHAIN, AgentError, balance_voucher,
+                    extract_voucher_with_fallback, get_prompt_profile, request_limiter, run_agent,
+                    set_prompt_profile)
+from duplicate_index import DuplicateIndex, apply_template, line_date
+from ledger_store import voucher_number
+from routing import get_router
+from scheduler import BATCH, priority_class
+from voucher_archive import VoucherArchive
+from voucher_extract import extraction_stats
+from voucher_numbers import get_allocator
+
+
+DEFAULT_MODEL = "@cf/mistralai/mistral-small-3.1-24b-instruct"
+
+# What to do with a line that looks like an earlier one: report it and process it anyway,
+# skip it, or write the earlier voucher adapted to it (no API call)
+DUPLICATE_MODES = ("flag", "skip", "template", "off")
+
+# Column / field names tried (in order) for the transaction text
+TEXT_FIELDS = ("text", "description", "摘要", "transaction")
+
+
+def _row_text(row):
+    for field in TEXT_FIELDS:
+        if row.get(field):
+            return str(row[field]).strip()
+    # No known column: describe the whole row
+    return " ".join(f"{key}: {value}" for key, value in row.items() if value not in (None, ""))
+
+
+def read_transactions(path):
+    """
+    Read transactions from a CSV (with header) or JSONL file.
+
+    Args:
+        path (str): Input file; ".jsonl"/".ndjson" is read as JSON lines, anything else as CSV.
+
+    Returns:
+        list of str: The transaction texts in file order (blank rows skipped).
+    """
+    transactions = []
+    if path.endswith((".jsonl", ".ndjson")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                text = _row_text(item) if isinstance(item, dict) else str(item).strip()
+                if text:
+                    transactions.append(text)
+    else:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                text = _row_text(row)
+                if text:
+                    transactions.append(text)
+    return transactions
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to at most `rate` per second (0 = unlimited)."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def line_digest(text):
+    """Short fingerprint of an input line, to tell it from another line at the same index."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class Checkpoint:
+    """
+    Append-only journal of finished items.
+
+    Each line is {"index": n, "file": "...", "line": digest}; loading it tells
+    a re-run which items can be skipped. An entry only counts for the same
+    line text (see resume()), so another input file written to the same
+    --out is processed in full instead of being skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        self.digests = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    self.done[entry["index"]] = entry["file"]
+                    self.digests[entry["index"]] = entry.get("line")
+
+    def resume(self, transactions):
+        """Forget the entries whose line is not the same text in `transactions`."""
+        for index in list(self.done):
+            if index >= len(transactions) or self.digests.get(index) != line_digest(transactions[index]):
+                del self.done[index]
+
+    def mark_done(self, index, filename, text):
+        with self.lock:
+            self.done[index] = filename
+            self.digests[index] = line_digest(text)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"index": index, "file": filename, "line": self.digests[index]}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def process_transaction(index, text, out_dir, auth_token, account_id, model, limiter,
+                        chain=VOUCHER_CHAIN, system_prompts=SYSTEM_PROMPTS, archive=None):
+    """
+    Run one transaction through the chain and write its voucher file
+    (or append it to `archive`, a VoucherArchive; see store_voucher).
+
+    The voucher totals and VAT lines are verified locally and a failing
+    voucher gets targeted correction turns before it is written (with 平衡
+    set to false if it still does not balance). The date the line names, if
+    any, is written as the voucher's 日期.
+
+    Returns:
+        dict: {"index", "file", "balanced", "vat_ok", "corrections"} on
+        success or {"index", "error"} on failure.
+    """
+    try:
+        # Every request of this transaction (retries and corrections included) waits for the limiter
+        with request_limiter(limiter):
+            reply = text
+            for agent_key in chain:
+                reply = run_agent(agent_key, reply, auth_token, account_id, model, system_prompts)
+            voucher = extract_voucher_with_fallback(reply, auth_token, account_id, model, system_prompts)
+            voucher, check, corrections = balance_voucher(voucher, text, reply, auth_token, account_id,
+                                                          model, system_prompts)
+    except AgentError as e:
+        return {"index": index, "error": str(e)}
+
+    date = line_date(text)
+    if date is not None:
+        voucher["日期"] = date
+    filename = store_voucher(index, voucher, out_dir, archive)
+    return {"index": index, "file": filename, "balanced": check["balanced"], "vat_ok": check["vat_ok"],
+            "corrections": corrections}
+
+
+def store_voucher(index, voucher, out_dir, archive=None):
+    """
+    Save the voucher of line `index` and return its file name ("n.json").
+
+    It takes the next free voucher number: in an archive the one above every
+    archived voucher (VoucherArchive.append), in `out_dir` the next unclaimed
+    file (voucher_numbers.get_allocator, claimed with O_EXCL). Vouchers saved
+    by the app or an earlier batch are never overwritten.
+    """
+    if archive is not None:
+        return f"{archive.append(voucher)}.json"
+    return get_allocator(out_dir).save(json.dumps(voucher, ensure_ascii=False, indent=2))
+
+
+def load_voucher(filename, out_dir, archive=None):
+    """
+    The voucher store_voucher saved as `filename` (None if it cannot be read).
+
+    With an archive the file name only carries the voucher number.
+    """
+    if archive is not None:
+        number = voucher_number(filename)
+        return archive.get(number) if number is not None else None
+    try:
+        with open(os.path.join(out_dir, filename), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_template_voucher(index, text, voucher, out_dir, archive=None):
+    """
+    Write the voucher of line `index` from an earlier `voucher`, adapted to `text`.
+
+    Returns:
+        dict or None: A process_transaction-style result, or None if there is
+        no earlier voucher (it was not written, or could not be read).
+    """
+    if not isinstance(voucher, dict):
+        return None
+    voucher = apply_template(voucher, text)
+    filename = store_voucher(index, voucher, out_dir, archive)
+    return {"index": index, "file": filename, "balanced": voucher["合计"]["平衡"], "corrections": 0,
+            "template": True}
+
+
+def run_batch(transactions, out_dir, auth_token, account_id, model=DEFAULT_MODEL,
+              workers=4, rps=0.0, checkpoint_path=None, chain=VOUCHER_CHAIN,
+              system_prompts=SYSTEM_PROMPTS, archive=None, duplicates="flag"):
+    """
+    Process transactions concurrently and yield results in input order.
+
+    Args:
+        transactions (list of str): Transaction texts.
+        out_dir (str): Directory for the voucher JSON files.
+        workers (int): Maximum number of transactions in flight.
+        rps (float): Overall cap on API requests per second (0 = no cap).
+        checkpoint_path (str): Journal file; defaults to "<out_dir>/checkpoint.jsonl".
+        archive (VoucherArchive): Append the vouchers here instead of writing n.json files.
+        duplicates (str): One of DUPLICATE_MODES, for lines that look like an earlier
+            line or archived voucher.
+
+    Yields:
+        dict: One result per transaction, in input order. Items already in the
+        checkpoint are yielded with "skipped": True; likely duplicates carry
+        "duplicate_of" and "duplicate_source" (the earlier line's number for
+        "input", the archived voucher's for "voucher") and, if skipped, no "file".
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(out_dir, "checkpoint.jsonl"))
+    checkpoint.resume(transactions)
+    limiter = RateLimiter(rps)
+    seen = None
+    first_line = {}     # input text -> index of its first line, for input matches
+    if duplicates != "off":
+        seen = DuplicateIndex()
+        if archive is not None:
+            for number, voucher, _ in archive.items():
+                seen.replace_voucher(number, voucher.get("明细", []))
+        for index in sorted(checkpoint.done):
+            seen.add_input(transactions[index])
+            first_line.setdefault(transactions[index], index)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {}
+        next_index = 0
+        submit_index = 0
+        # Keep a bounded window of submitted work so memory stays flat for large inputs
+        window = max(1, workers) * 4
+
+        def work(index, match=None, earlier=None):
+            text = transactions[index]
+            result = None
+            duplicate = {}
+            if match is not None:
+                duplicate = {"duplicate_of": match["number"] if match["source"] == "voucher" else match["line"] + 1,
+                             "duplicate_source": match["source"]}
+            if match is not None and duplicates == "skip":
+                return {"index": index, **duplicate}
+            if match is not None and duplicates == "template":
+                if match["source"] == "voucher":
+                    voucher = archive.get(match["number"])
+                else:
+                    if earlier is not None:
+                        earlier.result()  # submitted first, so already running on another worker
+                    filename = checkpoint.done.get(match["line"])
+                    voucher = load_voucher(filename, out_dir, archive) if filename is not None else None
+                result = write_template_voucher(index, text, voucher, out_dir, archive)
+            if result is None:
+                # Batch calls yield to interactive ones sharing the account's rate limit
+                with priority_class(BATCH):
+                    result = process_transaction(index, text, out_dir, auth_token,
+                                                 account_id, model, limiter, chain, system_prompts, archive)
+            result.update(duplicate)
+            # Journal as soon as the file exists, not when its turn in the output comes
+            if "file" in result:
+                checkpoint.mark_done(result["index"], result["file"], text)
+            return result
+
+        def submit_more():
+            nonlocal submit_index
+            while submit_index < len(transactions) and len(pending) < window:
+                index = submit_index
+                submit_index += 1
+                if index in checkpoint.done:
+                    pending[index] = None
+                    continue
+                if seen is None:
+                    pending[index] = pool.submit(work, index)
+                    continue
+                # Checked in input order, so a line is only ever a duplicate of an earlier one
+                text = transactions[index]
+                matches = seen.check_and_add(text)
+                first_line.setdefault(text, index)
+                match = dict(matches[0]) if matches else None
+                earlier = None
+                if match is not None and match["source"] == "input":
+                    match["line"] = first_line[match["text"]]
+                    earlier = pending.get(match["line"])
+                pending[index] = pool.submit(work, index, match, earlier)
+
+        submit_more()
+        while next_index < len(transactions):
+            future = pending.pop(next_index)
+            if future is None:
+                result = {"index": next_index, "file": checkpoint.done[next_index], "skipped": True}
+            else:
+                result = future.result()
+            next_index += 1
+            submit_more()
+            yield result
+
+
+def main(argv=None):
+    """Command line entry point for the batch pipeline."""
+    parser = argparse.ArgumentParser(description="Turn bank-statement lines into voucher JSON files.")
+    parser.add_argument("input", help="CSV or JSONL file with one transaction per row")
+    parser.add_argument("--out", default="vouchers", help="output directory for voucher files")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent transactions")
+    parser.add_argument("--rps", type=float, default=0.0, help="max API requests per second (0 = no cap)")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file (default: <out>/checkpoint.jsonl)")
+    parser.add_argument("--archive", default=None,
+                        help="append vouchers to this archive file instead of writing n.json files")
+    parser.add_argument("--duplicates", choices=DUPLICATE_MODES, default="flag",
+                        help="lines that look like an earlier one: report them (flag), skip them, "
+                             "or copy the earlier voucher without an API call (template)")
+    parser.add_argument("--model", default=os.getenv("CLOUDFLARE_MODEL", DEFAULT_MODEL))
+    parser.add_argument("--profile", choices=sorted(PROMPT_PROFILES), default=get_prompt_profile().name,
+                        help="prompt profile for agent_1 (compact/json send a shorter JSON-only prompt)")
+    args = parser.parse_args(argv)
+    set_prompt_profile(args.profile)
+
+    auth_token = os.getenv("CLOUDFLARE_AUTH_TOKEN", "")
+    account_id = os.getenv("CLOUDFLARE_ACCOUNT_ID", "")
+
+    transactions = read_transactions(args.input)
+    archive = VoucherArchive(args.archive) if args.archive else None
+    done = failed = unbalanced = vat_mismatch = duplicated = 0
+    for result in run_batch(transactions, args.out, auth_token, account_id, args.model,
+                            args.workers, args.rps, args.checkpoint, archive=archive,
+                            duplicates=args.duplicates):
+        if "duplicate_of" in result:
+            duplicated += 1
+            action = "skipped" if "file" not in result else "from template" if result.get("template") else "processed"
+            of = "line" if result["duplicate_source"] == "input" else "voucher"
+            print(f"[{result['index'] + 1}] likely duplicate of {of} {result['duplicate_of']} ({action})",
+                  file=sys.stderr)
+        if "error" in result:
+            failed += 1
+            print(f"[{result['index'] + 1}] error: {result['error']}", file=sys.stderr)
+        elif "file" in result:
+            done += 1
+            if result.get("balanced") is False:
+                unbalanced += 1
+                print(f"[{result['index'] + 1}] voucher does not balance: {result['file']}", file=sys.stderr)
+            if result.get("vat_ok") is False:
+                vat_mismatch += 1
+                print(f"[{result['index'] + 1}] VAT does not fit the net amount: {result['file']}", file=sys.stderr)
+    if archive is not None:
+        archive.close()
+    print(f"{done} vouchers written to {args.archive or args.out} ({unbalanced} unbalanced, "
+          f"{vat_mismatch} with wrong VAT), {failed} failed, "
+          f"{duplicated} likely duplicates")
+    counts = extraction_stats.snapshot()
+    print(f"JSON extraction: {counts['local']} local, {counts['fallback']} via agent_2, {counts['failed']} failed")
+    router = get_router()
+    if router.hedge or router.agent_models:
+        for agent, stats in sorted(router.report()["agents"].items()):
+            print(f"{agent}: {stats['calls']} calls, {stats['hedged']} hedged, answered by {stats['wins']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
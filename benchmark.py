@@ -0,0 +1,471 @@
+"""
+End-to-end benchmark against the local mock server (no real API calls unless --live).
+
+Scenarios, each run at every requested scale (number of calls / vouchers):
+    chat_completion       cloudflare_chat_completion round trips
+    agent_chain           agent_1 + local extraction + balance check + voucher file
+    load_all_json_files   importing n.json files into the ledger and reading the rows
+    init_json             filling the ledger table (Tk widget if a display exists)
+    trial_balance         loading the aggregation engine and per-month trial balances
+    startup               `import main`, and the ledger load from n.json files vs a snapshot
+    duplicate_check       duplicate index lookups of bank lines against `scale` saved vouchers
+
+Usage:
+    python benchmark.py --scales 1 100 10000 --output bench.jsonl
+    python benchmark.py --scenarios agent_chain --scales 20 --profiles full compact json --live
+
+agent_chain runs once per prompt profile (agents.PROMPT_PROFILES) and also
+reports tokens per call, truncated replies and accuracy (share of vouchers
+extracted and balanced). --live sends it to the real API with the account in
+CLOUDFLARE_AUTH_TOKEN / CLOUDFLARE_ACCOUNT_ID, which is where accuracy means
+something; the mock answers every profile with the same canned vouchers.
+It also reports per-agent routing: hedges fired and which model/request
+answered. To see hedging pay off, give the mock a latency tail:
+
+    python benchmark.py --scenarios agent_chain --scales 200 --tail-rate 0.05 --hedge
+
+Prints one JSON document with p50/p95 latency (ms), throughput (ops/s) and
+peak Python memory (KiB, tracemalloc) per scenario and scale; --output also
+appends it as a line to a JSONL file so runs can be compared over time.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import agents
+import cloudflare_client
+import duplicate_index
+import metrics
+import response_cache
+import routing
+import scheduler
+from batch import RateLimiter, process_transaction
+from ledger_snapshot import read_snapshot, write_snapshot
+from ledger_store import LedgerStore
+from mock_server import CANNED_VOUCHERS, MockServer
+from trial_balance import TrialBalanceEngine, facts_from_rows
+from virtual_tree import LedgerTableModel, row_key
+
+
+SCENARIOS = ("chat_completion", "agent_chain", "load_all_json_files", "init_json", "trial_balance", "startup",
+             "duplicate_check")
+# Scenarios whose requests depend on the prompt profile
+PROFILE_SCENARIOS = ("agent_chain",)
+AUTH_TOKEN = "bench-token"
+ACCOUNT_ID = "bench-account"
+MODEL = "@cf/mistralai/mistral-small-3.1-24b-instruct"
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(name, scale, latencies, elapsed, peak_bytes, **extra):
+    result = {
+        "scenario": name,
+        "scale": scale,
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "throughput_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "elapsed_s": round(elapsed, 4),
+        "peak_mem_kb": round(peak_bytes / 1024, 1) if peak_bytes is not None else None,
+    }
+    result.update(extra)
+    return result
+
+
+def timed_concurrent(calls, concurrency):
+    """Run zero-argument callables on a pool; returns (per-call latencies, wall time)."""
+    def run(call):
+        start = time.perf_counter()
+        call()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(run, calls))
+    return latencies, time.perf_counter() - start
+
+
+def transaction_text(i):
+    # Distinct inputs so the response cache (if enabled) cannot answer them
+    return f"第{i}笔：收到客户货款 {1000 + i} 元，存入银行"
+
+
+def write_voucher_files(directory, count):
+    for i in range(count):
+        voucher = CANNED_VOUCHERS[i % len(CANNED_VOUCHERS)]
+        with open(os.path.join(directory, f"{i + 1}.json"), "w", encoding="utf-8") as f:
+            json.dump(voucher, f, ensure_ascii=False, indent=2)
+
+
+def chat_completion_checked(messages):
+    response = cloudflare_client.cloudflare_chat_completion(AUTH_TOKEN, ACCOUNT_ID, MODEL, messages)
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response
+
+
+def bench_chat_completion(scale, workdir, concurrency):
+    calls = [
+        functools.partial(chat_completion_checked, [{"role": "user", "content": transaction_text(i)}])
+        for i in range(scale)
+    ]
+    latencies, elapsed = timed_concurrent(calls, concurrency)
+    return latencies, elapsed, {"concurrency": concurrency}
+
+
+def bench_agent_chain(scale, workdir, concurrency):
+    out_dir = os.path.join(workdir, "vouchers")
+    os.makedirs(out_dir, exist_ok=True)
+    limiter = RateLimiter(0)
+    failures = []
+    balanced = []
+    metrics.registry.reset()
+    routing.get_router().reset_stats()
+
+    def call(i):
+        result = process_transaction(i, transaction_text(i), out_dir, AUTH_TOKEN, ACCOUNT_ID, MODEL, limiter)
+        if "error" in result:
+            failures.append(result["error"])
+        elif result["balanced"]:
+            balanced.append(i)
+
+    latencies, elapsed = timed_concurrent([functools.partial(call, i) for i in range(scale)], concurrency)
+    registry = metrics.registry
+    calls = registry.counter("cf_requests_total") or 1
+    return latencies, elapsed, {
+        "concurrency": concurrency,
+        "profile": agents.get_prompt_profile().name,
+        "failures": len(failures),
+        "accuracy": round(len(balanced) / scale, 4) if scale else None,
+        "api_calls": registry.counter("cf_requests_total"),
+        "truncated": registry.counter("cf_truncated_total"),
+        "prompt_tokens_per_call": round(registry.counter("cf_tokens_total", direction="prompt") / calls, 1),
+        "completion_tokens_per_call": round(registry.counter("cf_tokens_total", direction="completion") / calls, 1),
+        "hedged": registry.counter("cf_hedged_total"),
+        "routing": routing.get_router().report()["agents"],
+    }
+
+
+def bench_load_all_json_files(scale, workdir, concurrency, repeats=3):
+    voucher_dir = os.path.join(workdir, "ledger")
+    os.makedirs(voucher_dir, exist_ok=True)
+    write_voucher_files(voucher_dir, scale)
+    latencies = []
+    start = time.perf_counter()
+    for repeat in range(repeats):
+        db_path = os.path.join(workdir, f"ledger-{repeat}.sqlite3")
+        t = time.perf_counter()
+        store = LedgerStore(db_path)
+        store.import_json_files(voucher_dir)
+        rows = store.all_rows()
+        latencies.append(time.perf_counter() - t)
+        store.close()
+    elapsed = time.perf_counter() - start
+    # Warm start: everything already imported, nothing re-parsed
+    store = LedgerStore(os.path.join(workdir, "ledger-0.sqlite3"))
+    t = time.perf_counter()
+    store.import_json_files(voucher_dir)
+    store.all_rows()
+    warm = time.perf_counter() - t
+    store.close()
+    return latencies, elapsed, {"rows": len(rows), "warm_ms": round(warm * 1000, 3)}
+
+
+def bench_init_json(scale, workdir, concurrency, repeats=3):
+    rows = []
+    for i in range(scale):
+        for line, entry in enumerate(CANNED_VOUCHERS[i % len(CANNED_VOUCHERS)]["明细"]):
+            row = dict(entry)
+            row["编号"] = str(i + 1)
+            row["line"] = line
+            rows.append(row)
+    try:
+        import tkinter as tk
+        from virtual_tree import VirtualTable
+        root = tk.Tk()
+        root.withdraw()
+    except Exception:
+        root = None  # no display: measure the table model alone
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        if root is not None:
+            table = VirtualTable(root)
+            t = time.perf_counter()
+            table.set_rows(rows)
+            root.update_idletasks()
+        else:
+            from virtual_tree import LedgerTableModel, row_key
+            t = time.perf_counter()
+            model = LedgerTableModel()
+            model.load({row_key(row, i): row for i, row in enumerate(rows)})
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    extra = {"rows": len(rows), "widget": root is not None}
+    if root is not None:
+        # Diff refresh after one more voucher: the common case after a save
+        extra_row = dict(rows[0], **{"编号": str(scale + 1)})
+        t = time.perf_counter()
+        table.set_rows(rows + [extra_row])
+        root.update_idletasks()
+        extra["refresh_ms"] = round((time.perf_counter() - t) * 1000, 3)
+        root.destroy()
+    return latencies, elapsed, extra
+
+
+def bench_trial_balance(scale, workdir, concurrency):
+    facts = []
+    for i in range(scale):
+        date = f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}"
+        rows = [dict(entry, 编号=str(i + 1), 日期=date) for entry in CANNED_VOUCHERS[i % len(CANNED_VOUCHERS)]["明细"]]
+        facts.extend(facts_from_rows(rows))
+    engine = TrialBalanceEngine()
+    t = time.perf_counter()
+    engine.load(facts)
+    load = time.perf_counter() - t
+    # One query per month, sub-accounts rolled up and kept
+    latencies = []
+    start = time.perf_counter()
+    for month in engine.periods("month"):
+        for level in (1, None):
+            t = time.perf_counter()
+            engine.trial_balance(month, month, level)
+            latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    t = time.perf_counter()
+    engine.replace_voucher(1, facts[:2])
+    update = time.perf_counter() - t
+    return latencies, elapsed, {"lines": len(facts), "load_ms": round(load * 1000, 3),
+                                "update_ms": round(update * 1000, 3)}
+
+
+def import_main_seconds():
+    """Time `import main` in a fresh interpreter (None if it cannot be imported, e.g. no tkinter)."""
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    return float(result.stdout) if result.returncode == 0 else None
+
+
+def build_ledger_view(rows, facts):
+    # What the app's ledger loader builds before handing the ledger to the Tk loop
+    model = LedgerTableModel()
+    model.load({row_key(row, position): row for position, row in enumerate(rows)})
+    TrialBalanceEngine().load(facts)
+    return model
+
+
+def bench_startup(scale, workdir, concurrency, repeats=3):
+    voucher_dir = os.path.join(workdir, "startup")
+    os.makedirs(voucher_dir, exist_ok=True)
+    write_voucher_files(voucher_dir, scale)
+    imports = [seconds for seconds in (import_main_seconds() for _ in range(repeats)) if seconds is not None]
+
+    # Cold: nothing imported yet, every file parsed
+    store = LedgerStore(os.path.join(workdir, "startup.sqlite3"))
+    t = time.perf_counter()
+    store.import_json_files(voucher_dir)
+    rows = store.all_rows(fen=True)
+    build_ledger_view(rows, store.facts())
+    cold = time.perf_counter() - t
+    snapshot_path = os.path.join(workdir, "startup.snapshot")
+    t = time.perf_counter()
+    write_snapshot(snapshot_path, rows, store.fingerprint())
+    write = time.perf_counter() - t
+    # Warm: the ledger is read from the snapshot, then the directory is reconciled
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        t = time.perf_counter()
+        snapshot = read_snapshot(snapshot_path)
+        build_ledger_view(snapshot.rows(), snapshot.facts())
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    t = time.perf_counter()
+    store.import_json_files(voucher_dir)
+    reconcile = time.perf_counter() - t
+    store.close()
+    return latencies, elapsed, {
+        "rows": len(rows),
+        "import_main_ms": round(min(imports) * 1000, 3) if imports else None,
+        "cold_load_ms": round(cold * 1000, 3),
+        "snapshot_write_ms": round(write * 1000, 3),
+        "snapshot_bytes": os.path.getsize(snapshot_path),
+        "reconcile_ms": round(reconcile * 1000, 3),
+    }
+
+
+def bench_duplicate_check(scale, workdir, concurrency):
+    # Vouchers with their own amount, date and counterparty; every other line checked is a
+    # reworded copy of one of them, the rest are new (another amount or another party)
+    rows = []
+    for i in range(scale):
+        date = f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}"
+        amount = str(1000 + i)
+        rows.append({"编号": str(i + 1), "科目": "银行存款", "摘要": f"收回客户{i}贸易公司前欠货款",
+                     "借方金额": amount, "贷方金额": None, "日期": date})
+        rows.append({"编号": str(i + 1), "科目": f"应收账款-客户{i}贸易公司", "摘要": "收回前欠货款",
+                     "借方金额": None, "贷方金额": amount, "日期": date})
+    index = duplicate_index.DuplicateIndex()
+    t = time.perf_counter()
+    index.load_rows(rows)
+    load = time.perf_counter() - t
+    lines = []
+    for i in range(scale):
+        date = f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}"
+        if i % 2:
+            lines.append((f"{date} 客户{i}贸易有限公司 转账 {1000 + i:,}.00 货款", i + 1))
+        else:
+            lines.append((f"{date} 收回客户{i + 1}贸易公司货款 {1000 + i}.00", None))
+    latencies = []
+    found = false_alarms = 0
+    start = time.perf_counter()
+    for text, expected in lines:
+        t = time.perf_counter()
+        matches = index.check(text)
+        latencies.append(time.perf_counter() - t)
+        if expected is not None:
+            found += any(match["number"] == expected for match in matches)
+        else:
+            false_alarms += bool(matches)
+    elapsed = time.perf_counter() - start
+    copies = sum(1 for _, expected in lines if expected is not None)
+    return latencies, elapsed, {
+        "load_ms": round(load * 1000, 3),
+        "recall": round(found / copies, 4) if copies else None,
+        "false_alarm_rate": round(false_alarms / (len(lines) - copies), 4) if len(lines) > copies else None,
+    }
+
+
+BENCHES = {
+    "chat_completion": bench_chat_completion,
+    "agent_chain": bench_agent_chain,
+    "load_all_json_files": bench_load_all_json_files,
+    "init_json": bench_init_json,
+    "trial_balance": bench_trial_balance,
+    "startup": bench_startup,
+    "duplicate_check": bench_duplicate_check,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(scenarios, scales, concurrency=16, latency=0.02, token_rate=0.0, error_rate=0.0,
+        rate_limit=0.0, measure_memory=True, rpm=0.0, tpm=0.0, profiles=("full",), live=False,
+        tail_rate=0.0, hedge=False, agent_models=None):
+    """Run the selected scenarios against a fresh mock server (or the real API) and return the report dict."""
+    global AUTH_TOKEN, ACCOUNT_ID
+    results = []
+    # Measure the network path, not the cache
+    response_cache.set_cache(None)
+    if live:
+        AUTH_TOKEN = os.getenv("CLOUDFLARE_AUTH_TOKEN", "")
+        ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID", "")
+        server_context = contextlib.nullcontext()
+    else:
+        # The mock has no account limit; rpm/tpm > 0 measures the scheduler itself
+        scheduler.set_scheduler(ACCOUNT_ID, scheduler.RequestScheduler(rpm, tpm))
+        server_context = MockServer(latency=latency, token_rate=token_rate, error_rate=error_rate,
+                                    rate_limit=rate_limit, retry_after=0, seed=1, tail_rate=tail_rate)
+    previous_profile = agents.get_prompt_profile().name
+    previous_router = routing.get_router()
+    routing.set_router(routing.ModelRouter(agent_models, hedge, previous_router.hedge_models))
+    with server_context as server:
+        cloudflare_client.set_client(cloudflare_client.CloudflareClient(
+            base_url=server.base_url if server else cloudflare_client.API_BASE_URL,
+            pool_size=concurrency, backoff_base=0.01 if server else 0.5))
+        for name in scenarios:
+            for profile in (profiles if name in PROFILE_SCENARIOS else profiles[:1]):
+                agents.set_prompt_profile(profile)
+                for scale in scales:
+                    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+                    try:
+                        if measure_memory:
+                            tracemalloc.start()
+                        latencies, elapsed, extra = BENCHES[name](scale, workdir, concurrency)
+                        peak = None
+                        if measure_memory:
+                            peak = tracemalloc.get_traced_memory()[1]
+                            tracemalloc.stop()
+                        results.append(summarize(name, scale, latencies, elapsed, peak, **extra))
+                    finally:
+                        shutil.rmtree(workdir, ignore_errors=True)
+        server_stats = dict(server.config.stats) if server else None
+    agents.set_prompt_profile(previous_profile)
+    routing.set_router(previous_router)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "live": live,
+        "mock": None if live else {"latency": latency, "token_rate": token_rate, "error_rate": error_rate,
+                                   "rate_limit": rate_limit, "tail_rate": tail_rate, "stats": server_stats},
+        "routing": {"hedge": hedge, "agent_models": agent_models or {}},
+        "scheduler": {"rpm": rpm, "tpm": tpm},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline and ledger against a mock API.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 100, 10000])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="mock server latency in seconds")
+    parser.add_argument("--token-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--rpm", type=float, default=0.0, help="scheduler requests/minute (0 = unlimited)")
+    parser.add_argument("--tpm", type=float, default=0.0, help="scheduler tokens/minute (0 = unlimited)")
+    parser.add_argument("--profiles", nargs="+", choices=sorted(agents.PROMPT_PROFILES), default=["full"],
+                        help="prompt profiles to compare in agent_chain")
+    parser.add_argument("--live", action="store_true",
+                        help="call the real API (CLOUDFLARE_AUTH_TOKEN / CLOUDFLARE_ACCOUNT_ID) instead of the mock")
+    parser.add_argument("--tail-rate", type=float, default=0.0,
+                        help="share of mock requests that are 10x slower (a latency tail to hedge)")
+    parser.add_argument("--hedge", action="store_true", help="hedge agent calls slower than their model's p90")
+    parser.add_argument("--agent-models", default=routing.AGENT_MODELS,
+                        help='per-agent models, "agent_2=@cf/...,agent_3=@cf/..." (default AGENT_MODELS)')
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc (less overhead)")
+    parser.add_argument("--output", help="append the report as one line to this JSONL file")
+    args = parser.parse_args(argv)
+
+    report = run(args.scenarios, args.scales, args.concurrency, args.latency, args.token_rate,
+                 args.error_rate, args.rate_limit, not args.no_memory, args.rpm, args.tpm,
+                 args.profiles, args.live, args.tail_rate, args.hedge,
+                 routing.parse_agent_models(args.agent_models))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(report, ensure_ascii=False) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,591 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+from response_cache import cache_key, get_cache
+from scheduler import coalescer, get_scheduler
+
+
+# Override (e.g. with mock_server.py's URL) to point the app at another server
+API_BASE_URL = os.getenv("CLOUDFLARE_API_BASE", "https://api.cloudflare.com/client/v4")
+
+DEFAULT_MAX_TOKENS = 4096
+
+# Status codes that are worth another attempt (rate limited or server side trouble)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def chat_completions_url(account_id, base_url=API_BASE_URL):
+    """Build the OpenAI compatible chat completions URL for an account."""
+    return f"{base_url}/accounts/{account_id}/ai/v1/chat/completions"
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header value.
+
+    Args:
+        value (str): Either a number of seconds or an HTTP date.
+
+    Returns:
+        float or None: Seconds to wait, or None if the header is missing/invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# Call record of the request being sent on this thread, filled in by the connection classes
+_active_call = threading.local()
+
+
+class RequestCancelled(requests.exceptions.RequestException):
+    """Raised when a request is aborted through its CancelScope."""
+
+
+def _shutdown(sock):
+    try:
+        # socket.socket's own shutdown, not SSLSocket's, which must not run while another thread reads
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class CancelScope:
+    """
+    Lets another thread abort the requests sent under it (see cancel_scope).
+
+    cancel() shuts down the sockets of the requests waiting for a reply, so
+    their blocking reads fail at once, and post() does not try again.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.sockets = {}  # thread id -> sockets of that thread's request in flight
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            sockets, self.sockets = self.sockets, {}
+        for thread_sockets in sockets.values():
+            for sock in thread_sockets:
+                _shutdown(sock)
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise RequestCancelled("request cancelled")
+
+    def attach(self, sock):
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.sockets.setdefault(threading.get_ident(), set()).add(sock)
+                return
+        _shutdown(sock)
+
+    def release(self):
+        """Forget this thread's sockets once its request is over (they go back to the pool)."""
+        with self.lock:
+            self.sockets.pop(threading.get_ident(), None)
+
+
+_cancel_scope = threading.local()
+
+
+def current_cancel_scope():
+    """CancelScope of the calling thread, or None."""
+    return getattr(_cancel_scope, "scope", None)
+
+
+@contextmanager
+def cancel_scope(scope):
+    """Send the enclosed requests (on this thread) under `scope`, a CancelScope (None: not abortable)."""
+    previous = current_cancel_scope()
+    _cancel_scope.scope = scope
+    try:
+        yield scope
+    finally:
+        if scope is not None:
+            scope.release()
+        _cancel_scope.scope = previous
+
+
+class _TimedConnectionMixin:
+    """
+    Records DNS and connect (TCP + TLS) time of new pooled connections.
+
+    Reused keep-alive connections never get here, so a call that shows no
+    dns/connect phase went out on a warm connection.
+    """
+
+    def connect(self):
+        call = getattr(_active_call, "record", None)
+        if call is None:
+            return super().connect()
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM)}
+        except OSError:
+            addresses = set()  # urllib3 resolves again and raises its usual error
+        resolved = time.perf_counter()
+        call["dns"] = resolved - start
+        if len(addresses) == 1:
+            # Connect to the address just resolved; with several, keep urllib3's fallback across them
+            self._dns_host = addresses.pop()
+        try:
+            super().connect()
+        finally:
+            self._dns_host = host
+        call["connect"] = time.perf_counter() - resolved
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        # Sent; the wait for the reply can now be cut short by the thread's CancelScope
+        scope = current_cancel_scope()
+        if scope is not None and self.sock is not None:
+            scope.attach(self.sock)
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools use the timed connection classes above."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class CloudflareClient:
+    """
+    Shared HTTP client for the Cloudflare AI API.
+
+    Keeps a pooled keep-alive requests.Session so repeated agent calls reuse
+    the TCP+TLS connection, applies connect/read timeouts to every request and
+    retries 429/5xx responses with jittered exponential backoff. Every call
+    is timed by phase (dns, connect, ttfb, total) and reported to metrics
+    together with its retries and token usage.
+    """
+
+    def __init__(self, base_url=API_BASE_URL, pool_size=10, connect_timeout=5.0,
+                 read_timeout=120.0, max_retries=3, backoff_base=0.5, backoff_max=30.0):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        # Retries are handled in post() so Retry-After and jitter apply to every attempt
+        adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """
+        Seconds to sleep before retry number `attempt` (0 based).
+
+        Uses "full jitter" exponential backoff; a Retry-After from the server
+        takes precedence when it asks us to wait longer.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def post(self, url, headers, payload, stream=False, timeout=None, call=None, admission=None, limiter=None):
+        """
+        POST a JSON payload, retrying on connection errors, timeouts and 429/5xx.
+
+        If `call` (a metrics.new_call record) is given, the attempt count, the
+        final status and the dns/connect/ttfb phases are written into it. If
+        `admission` (a scheduler.Admission) is given, every attempt waits for
+        it and 429s are reported to it; a `limiter` (anything with a blocking
+        wait(), e.g. batch.RateLimiter) is waited for first. Under a cancelled
+        CancelScope the request is aborted and not retried.
+
+        Returns:
+            requests.Response: The final response (raise_for_status already applied).
+
+        Raises:
+            requests.exceptions.RequestException: When all attempts fail
+            (RequestCancelled when aborted).
+        """
+        scope = current_cancel_scope()
+        attempt = 0
+        while True:
+            if scope is not None:
+                scope.check()
+                scope.release()
+            if limiter is not None:
+                limiter.wait()
+            if admission is not None:
+                admission.wait()
+            if call is not None:
+                call["retries"] = attempt
+                _active_call.record = call
+            start = time.perf_counter()
+            try:
+                # Always stream so the headers arrive first: that moment is the TTFB
+                response = self.session.post(url, headers=headers, json=payload,
+                                             stream=True, timeout=timeout or self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if scope is not None:
+                    scope.check()  # the connection error was the abort
+                if attempt >= self.max_retries:
+                    raise
+                self.pause(self.backoff_delay(attempt), scope)
+                attempt += 1
+                continue
+            finally:
+                _active_call.record = None
+            if call is not None:
+                call["ttfb"] = time.perf_counter() - start
+                call["status"] = response.status_code
+
+            retry_after = None
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if admission is not None:
+                    admission.throttled(retry_after)
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                response.close()  # hand the connection back to the pool
+                self.pause(self.backoff_delay(attempt, retry_after), scope)
+                attempt += 1
+                continue
+
+            if response.status_code >= 400:
+                response.close()  # the body is not read, so give the connection back before raising
+                response.raise_for_status()
+            if not stream:
+                try:
+                    response.content  # read the body now so the connection goes back to the pool
+                except requests.exceptions.RequestException:
+                    if scope is not None:
+                        scope.check()
+                    raise
+                if scope is not None:
+                    scope.release()
+            return response
+
+    @staticmethod
+    def pause(delay, scope=None):
+        """Sleep before a retry, cut short (RequestCancelled) if `scope` is cancelled meanwhile."""
+        if scope is None:
+            time.sleep(delay)
+        elif scope.cancelled.wait(delay):
+            scope.check()
+
+    def chat_completion(self, auth_token, account_id, model, messages, max_tokens=DEFAULT_MAX_TOKENS,
+                        admission=None, response_format=None, limiter=None):
+        """
+        Send a chat completion request and return the decoded JSON body.
+
+        Raises:
+            requests.exceptions.RequestException: On network or HTTP errors.
+        """
+        headers = {
+            "Authorization": f"Bearer {auth_token}",
+            "Content-Type": "application/json",
+        }
+        data = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens
+        }
+        if response_format is not None:
+            data["response_format"] = response_format
+        call = metrics.new_call(model)
+        start = time.perf_counter()
+        try:
+            response = self.post(chat_completions_url(account_id, self.base_url), headers, data,
+                                 call=call, admission=admission, limiter=limiter)
+            body = response.json()
+            metrics.record_usage(call, body.get("usage"))
+            if admission is not None:
+                admission.settle(body.get("usage"))
+        except requests.exceptions.RequestException as e:
+            call["status"] = call["status"] or type(e).__name__
+            raise
+        finally:
+            call["total"] = time.perf_counter() - start
+            metrics.record_call(call)
+        return body
+
+    def stream_chat_completion(self, auth_token, account_id, model, messages, max_tokens=DEFAULT_MAX_TOKENS,
+                               admission=None, response_format=None, outcome=None, limiter=None):
+        """
+        Send a chat completion request with `stream: true` and yield text as it arrives.
+
+        If `outcome` (a dict) is given, the finish_reason of the final event is
+        stored in it, so the caller can tell a reply cut off at max_tokens.
+
+        Yields:
+            str: Content deltas in the order the server sends them.
+
+        Raises:
+            requests.exceptions.RequestException: On network or HTTP errors.
+        """
+        headers = {
+            "Authorization": f"Bearer {auth_token}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        data = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+        if response_format is not None:
+            data["response_format"] = response_format
+        call = metrics.new_call(model, stream=True)
+        start = time.perf_counter()
+        try:
+            response = self.post(chat_completions_url(account_id, self.base_url), headers, data,
+                                 stream=True, call=call, admission=admission, limiter=limiter)
+            with response:
+                for event in iter_sse_events(response.iter_lines(decode_unicode=False)):
+                    # The last event usually carries the usage, with an empty delta
+                    if "usage" in event:
+                        metrics.record_usage(call, event["usage"])
+                        if admission is not None:
+                            admission.settle(event["usage"])
+                    choices = event.get("choices")
+                    if outcome is not None and choices and choices[0].get("finish_reason"):
+                        outcome["finish_reason"] = choices[0]["finish_reason"]
+                    text = event_text(event)
+                    if text:
+                        yield text
+        except requests.exceptions.RequestException as e:
+            scope = current_cancel_scope()
+            if scope is not None and scope.cancelled.is_set() and not isinstance(e, RequestCancelled):
+                call["status"] = "cancelled"
+                raise RequestCancelled("request cancelled") from e
+            call["status"] = call["status"] or type(e).__name__
+            raise
+        except GeneratorExit:
+            call["status"] = "cancelled"
+            raise
+        finally:
+            call["total"] = time.perf_counter() - start
+            metrics.record_call(call)
+            if current_cancel_scope() is not None:
+                current_cancel_scope().release()
+
+    def close(self):
+        self.session.close()
+
+
+def iter_sse_events(lines):
+    """
+    Decode server-sent events carrying JSON payloads.
+
+    Args:
+        lines (iterable of bytes or str): Raw lines from the response body.
+
+    Yields:
+        dict: The decoded `data:` payload of each event, until `[DONE]`.
+    """
+    data_lines = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if line.startswith("data:"):
+            data_lines.append(line[5:].lstrip())
+            continue
+        if line or not data_lines:
+            continue  # comments, "event:"/"id:" fields, keep-alive blank lines
+        # A blank line ends the event
+        payload = "\n".join(data_lines)
+        data_lines = []
+        if payload == "[DONE]":
+            return
+        try:
+            yield json.loads(payload)
+        except ValueError:
+            continue
+    if data_lines:
+        payload = "\n".join(data_lines)
+        if payload != "[DONE]":
+            try:
+                yield json.loads(payload)
+            except ValueError:
+                pass
+
+
+def event_text(event):
+    """Extract the text delta from a streamed event (OpenAI or Workers AI style)."""
+    choices = event.get("choices")
+    if choices:
+        delta = choices[0].get("delta") or {}
+        return delta.get("content") or ""
+    return event.get("response") or ""
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process wide CloudflareClient, creating it on first use."""
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = CloudflareClient()
+    return _shared_client
+
+
+def set_client(client):
+    """Replace the process wide client (e.g. to point at a different base URL)."""
+    global _shared_client
+    with _shared_client_lock:
+        old, _shared_client = _shared_client, client
+    if old is not None and old is not client:
+        old.close()
+
+
+def _request_key(model, messages, max_tokens, response_format):
+    # Options left at their defaults stay out of the key so existing cache entries still match
+    if response_format is None:
+        return cache_key(model, messages, max_tokens=max_tokens)
+    return cache_key(model, messages, max_tokens=max_tokens, response_format=response_format)
+
+
+def cloudflare_chat_completion(auth_token, account_id, model, messages, priority=None,
+                               max_tokens=DEFAULT_MAX_TOKENS, response_format=None, coalesce=True, limiter=None,
+                               cacheable=None):
+    """
+    Send a chat completion request to the Cloudflare AI API.
+
+    Identical requests (same model, system prompt and messages) are answered
+    from the response cache when it is enabled, and identical requests in
+    flight at the same time share one upstream call. Every upstream attempt
+    goes through the account's scheduler (request and token budgets) and
+    waits for `limiter`; cache hits and shared calls take nothing from either.
+
+    Args:
+        auth_token (str): Authorization token for the API.
+        account_id (str): Cloudflare account ID.
+        model (str): The model to use, e.g., "@cf/meta/llama-3.1-8b-instruct".
+        messages (list of dict): Chat messages with role and content, e.g.,
+                                 [{"role": "user", "content": "Your question"}].
+        priority (int): scheduler.INTERACTIVE or scheduler.BATCH; None uses the
+                        calling thread's class (see scheduler.priority_class).
+        max_tokens (int): Generation limit for the reply.
+        response_format (dict): Optional structured output mode, e.g. {"type": "json_object"}.
+        coalesce (bool): Share an identical request in flight; False forces a request
+                         of its own (a hedge must not just wait for the call it hedges).
+        limiter: Optional caller-side rate limiter with a blocking wait() (e.g. batch.RateLimiter).
+        cacheable (callable): Optional check of a reply before it is cached; replies it
+                              rejects (e.g. no voucher in them) are asked again next time.
+
+    Returns:
+        dict: The JSON response from the Cloudflare API, or {"error": message,
+        "status": HTTP status or None} on failure.
+    """
+    cache = get_cache()
+    key = _request_key(model, messages, max_tokens, response_format)
+    if cache:
+        cached = cache.get(key)
+        metrics.registry.inc("cf_cache_requests_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+    admission = get_scheduler(account_id).admission(messages, max_tokens, priority)
+
+    def call():
+        try:
+            response = get_client().chat_completion(auth_token, account_id, model, messages, max_tokens,
+                                                    admission=admission, response_format=response_format,
+                                                    limiter=limiter)
+        except requests.exceptions.RequestException as e:
+            return {"error": str(e), "status": getattr(e.response, "status_code", None)}
+        # A reply cut off at max_tokens, or one the caller cannot use, is not worth replaying
+        finish_reason = (response.get("choices") or [{}])[0].get("finish_reason")
+        if (cache and "error" not in response and finish_reason != "length"
+                and (cacheable is None or cacheable(response))):
+            cache.put(key, response)
+        return response
+
+    return coalescer.run((account_id, key), call) if coalesce else call()
+
+
+def stream_cloudflare_chat_completion(auth_token, account_id, model, messages, priority=None,
+                                      max_tokens=DEFAULT_MAX_TOKENS, response_format=None, outcome=None,
+                                      limiter=None, cacheable=None):
+    """
+    Streaming variant of cloudflare_chat_completion.
+
+    A cache hit is yielded as a single chunk; a completed stream is stored in
+    the cache in the same shape as a non-streamed response, unless it was cut
+    off at max_tokens or `cacheable` rejects it. Streams go through the account's scheduler (and
+    `limiter`) but are not coalesced. `outcome` (a dict) receives the
+    stream's "finish_reason".
+
+    Yields:
+        str: Content deltas as they arrive.
+
+    Raises:
+        requests.exceptions.RequestException: On network or HTTP errors.
+    """
+    cache = get_cache()
+    key = _request_key(model, messages, max_tokens, response_format) if cache else None
+    if cache:
+        cached = cache.get(key)
+        metrics.registry.inc("cf_cache_requests_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            content = cached.get("choices", [{}])[0].get("message", {}).get("content")
+            if content:
+                yield content
+                return
+    admission = get_scheduler(account_id).admission(messages, max_tokens, priority)
+    outcome = {} if outcome is None else outcome
+    parts = []
+    for text in get_client().stream_chat_completion(auth_token, account_id, model, messages, max_tokens,
+                                                    admission=admission, response_format=response_format,
+                                                    outcome=outcome, limiter=limiter):
+        parts.append(text)
+        yield text
+    if cache and parts and outcome.get("finish_reason") != "length":
+        response = {"choices": [{"message": {"role": "assistant", "content": "".join(parts)},
+                                 "finish_reason": outcome.get("finish_reason", "stop")}]}
+        if cacheable is None or cacheable(response):
+            cache.put(key, response)
@@ -0,0 +1,372 @@
+"""
+Fuzzy duplicate detection for bank lines, before they are sent to agent_1.
+
+Every processed input and every saved voucher is reduced to a few keys:
+its amounts (fen), dates, counterparty and a bottom-k MinHash sketch of
+its wording (character 3-grams). A new line is only compared with the
+entries that share an amount and a date or counterparty with it (or have
+the same text), so a check costs a few dict lookups and a handful of sketch
+comparisons whatever the size of the ledger.
+
+    index = DuplicateIndex()
+    index.load_rows(ledger.all_rows(fen=True))
+    index.check("2025-03-01 收到维力贸易公司货款 52,100.00")
+    -> [{"source": "voucher", "number": 1, "score": 0.21, "reasons": ["amount", "date", "counterparty"], ...}]
+"""
+import datetime
+import re
+import threading
+
+import metrics
+from voucher_check import AmountError, to_fen, verify_voucher
+
+
+# Hashes kept per sketch; texts with fewer 3-grams are compared exactly
+SKETCH_SIZE = 32
+SHINGLE = 3
+# Wording similarity (estimated Jaccard of 3-grams) needed when the amount and only
+# one of date / counterparty agree, and when the amount is all a line has to go on
+SIMILAR_TEXT = 0.35
+NEAR_COPY = 0.8
+# Entries compared per amount when the line has neither a date nor a counterparty
+MAX_AMOUNT_CANDIDATES = 200
+
+_DATE = re.compile(r"(?<!\d)(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})日?|(?<!\d)(20\d{2})(\d{2})(\d{2})(?!\d)")
+_AMOUNT = re.compile(r"(?<![\d.,])-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d{1,2})?(?![\d.]*\d)")
+# "对方户名: 张三", "收款人 李四"
+_PARTY_FIELD = re.compile(r"(?:对方户名|对方账户名|对方名称|对方|收款人|收款方|付款人|付款方|户名|客户|供应商)"
+                          r"(?:\s*[:：]\s*|\s+)([一-鿿A-Za-z0-9()（）·&]{2,40})")
+# "维力贸易公司", "招商银行", "某某事务所"
+_PARTY_NAME = re.compile(r"[一-鿿A-Za-z0-9()（）·&]{2,40}?"
+                         r"(?:有限责任公司|股份有限公司|有限公司|公司|银行|事务所|研究所|医院|学校|中心|商行|商店|厂|店)")
+# Verbs that run into the name in Chinese bank lines ("收回维力贸易公司前欠购货款")
+_PARTY_PREFIXES = ("支付给", "转账给", "付给", "转给", "支付", "收到", "收回", "收取", "转账", "付款", "收款",
+                   "预付", "预收", "归还", "偿还", "退还", "退回", "向", "给", "从", "自", "由", "付", "收")
+_LEGAL_FORM = re.compile(r"(?:有限责任|股份有限|有限)(?=公司$)")
+_NOT_TEXT = re.compile(r"[\W\d_]+")
+_NOT_WORD = re.compile(r"[\W_]+")
+
+
+def _dates(text):
+    dates = set()
+    for match in _DATE.finditer(text):
+        year, month, day = (int(part) for part in (match.group(1, 2, 3) if match.group(1) else match.group(4, 5, 6)))
+        try:
+            dates.add(datetime.date(year, month, day).isoformat())
+        except ValueError:
+            pass
+    return dates
+
+
+def line_date(text):
+    """The date a bank line names (ISO format), or None if it names none or several."""
+    dates = _dates(text)
+    return next(iter(dates)) if len(dates) == 1 else None
+
+
+def _amounts(text):
+    amounts = set()
+    for match in _AMOUNT.finditer(text):
+        value = match.group().lstrip("-")
+        # Long digit runs are account or card numbers, not amounts
+        if len(value.partition(".")[0].replace(",", "")) > 10:
+            continue
+        fen = to_fen(value)
+        if fen:
+            amounts.add(fen)
+    return amounts
+
+
+def counterparty(text):
+    """
+    Best guess at the other party named in a bank line or 摘要 (None if none is found).
+
+    Names are normalised (case, spaces, 有限公司 -> 公司) so wording variants share a key.
+    """
+    match = _PARTY_FIELD.search(text) or _PARTY_NAME.search(text)
+    if match is None:
+        return None
+    name = _NOT_WORD.sub("", (match.group(1) if match.lastindex else match.group()).casefold())
+    stripped = True
+    while stripped:
+        stripped = False
+        for prefix in _PARTY_PREFIXES:
+            if name.startswith(prefix) and len(name) > len(prefix) + 1:
+                name = name[len(prefix):]
+                stripped = True
+                break
+    name = _LEGAL_FORM.sub("", name)
+    return name if len(name) >= 2 else None
+
+
+def sketch(text):
+    """Bottom-k MinHash sketch (frozenset of the SKETCH_SIZE smallest 3-gram hashes) of the wording."""
+    letters = _NOT_TEXT.sub("", text.casefold())
+    if len(letters) <= SHINGLE:
+        grams = {letters} if letters else set()
+    else:
+        grams = {letters[i:i + SHINGLE] for i in range(len(letters) - SHINGLE + 1)}
+    # hash() is salted per process; sketches live in memory only
+    return frozenset(sorted(hash(gram) for gram in grams)[:SKETCH_SIZE])
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of the texts behind two sketches (0.0 - 1.0)."""
+    if not a or not b:
+        return 0.0
+    union = sorted(a | b)[:SKETCH_SIZE]
+    both = a & b
+    return sum(1 for value in union if value in both) / len(union)
+
+
+def features(text, amounts=None, dates=None):
+    """
+    Keys of one text: (amounts, dates, counterparty, sketch, exact text key).
+
+    Args:
+        text (str): A bank line, or the 摘要 lines of a voucher.
+        amounts (iterable of int): Amounts in fen; default: parsed from the text.
+        dates (iterable of str): ISO dates; default: parsed from the text.
+    """
+    if dates is None:
+        dates = _dates(text)
+        text_without_dates = _DATE.sub(" ", text)
+    else:
+        text_without_dates = text
+    if amounts is None:
+        amounts = _amounts(text_without_dates)
+    return (frozenset(amounts), frozenset(dates), counterparty(text), sketch(text_without_dates),
+            _NOT_WORD.sub("", text.casefold()))
+
+
+def voucher_features(rows):
+    """features() of a voucher from its ledger rows (amounts and dates from the lines, wording from 摘要)."""
+    amounts, dates, summaries = set(), set(), []
+    for row in rows:
+        for field in ("借方金额", "贷方金额"):
+            fen = row.get("debit_fen" if field == "借方金额" else "credit_fen")
+            if fen is None:
+                try:
+                    fen = to_fen(row[field]) if row.get(field) else 0
+                except AmountError:
+                    fen = 0
+            if fen:
+                amounts.add(abs(fen))
+        if row.get("日期"):
+            dates.add(str(row["日期"])[:10])
+        summary = row.get("摘要")
+        if summary and summary not in summaries:
+            summaries.append(str(summary))
+    # The 科目 carries the counterparty when the 摘要 does not ("应收账款-维力贸易公司")
+    text = " ".join(summaries + [str(row.get("科目") or "") for row in rows])
+    return features(text, amounts, dates)
+
+
+class DuplicateIndex:
+    """
+    In-memory index of processed inputs and saved vouchers.
+
+    Inputs are keyed by their text, so recording the same line again (e.g.
+    once it has been saved as a voucher) updates its entry. Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}       # ("input", text key) / ("voucher", number) -> (number, text, features)
+        self.by_date = {}       # (amount fen, date) -> set of entry keys
+        self.by_party = {}      # (amount fen, counterparty) -> set of entry keys
+        self.by_amount = {}     # amount fen -> set of entry keys
+        self.by_text = {}       # exact text key -> set of entry keys
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _buckets(self, feature):
+        amounts, dates, party, _, text_key = feature
+        for amount in amounts:
+            yield self.by_amount, amount
+            for date in dates:
+                yield self.by_date, (amount, date)
+            if party:
+                yield self.by_party, (amount, party)
+        if text_key:
+            yield self.by_text, text_key
+
+    def _add(self, key, number, text, feature):
+        # Caller holds the lock
+        self._discard(key)
+        self.entries[key] = (number, text, feature)
+        for buckets, bucket in self._buckets(feature):
+            buckets.setdefault(bucket, set()).add(key)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for buckets, bucket in self._buckets(entry[2]):
+            keys = buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del buckets[bucket]
+
+    # --- building ---
+    def add_input(self, text, number=None):
+        """Record a bank line that was sent to the agents (`number`: the voucher it became, if saved)."""
+        feature = features(text)
+        with self.lock:
+            key = ("input", feature[4])
+            if number is None and key in self.entries:
+                number = self.entries[key][0]
+            self._add(key, number, text, feature)
+
+    def replace_voucher(self, number, rows):
+        """Index (or with no rows, forget) voucher `number` from its ledger rows."""
+        feature = voucher_features(rows) if rows else None
+        with self.lock:
+            if feature is None:
+                self._discard(("voucher", number))
+            else:
+                text = " ".join(str(row.get("摘要") or "") for row in rows)
+                self._add(("voucher", number), number, text, feature)
+
+    def load_rows(self, rows):
+        """
+        Index every voucher of `rows` (LedgerStore.all_rows / LedgerSnapshot.rows), replacing
+        the vouchers indexed so far. Recorded inputs are kept.
+        """
+        vouchers = {}
+        for row in rows:
+            number = str(row.get("编号", ""))
+            if number.isdigit():
+                vouchers.setdefault(int(number), []).append(row)
+        prepared = [(number, " ".join(str(row.get("摘要") or "") for row in lines), voucher_features(lines))
+                    for number, lines in vouchers.items()]
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == "voucher"]:
+                self._discard(key)
+            for number, text, feature in prepared:
+                self._add(("voucher", number), number, text, feature)
+
+    # --- lookups ---
+    def check(self, text, limit=3, exclude=None):
+        """
+        Find likely duplicates of a bank line.
+
+        A line is a duplicate of an entry with the same text, or one that shares
+        an amount and its date and counterparty, or an amount and one of them
+        with similar wording (SIMILAR_TEXT), or, when the line has neither,
+        an amount with nearly the same wording (NEAR_COPY). Two lines that
+        both carry dates but no date in common never match, so next month's
+        rent is not a duplicate of this month's.
+
+        Args:
+            text (str): The line about to be sent.
+            limit (int): Maximum number of matches returned.
+            exclude (int): Ignore entries of this voucher number (the line's own).
+
+        Returns:
+            list of dict: {"source": "input"/"voucher", "number" (None for an input
+            not saved as a voucher), "text", "score" (wording similarity), "reasons"
+            (what agreed: "text", "amount", "date", "counterparty", "wording")},
+            best first; empty if the line looks new.
+        """
+        with metrics.span("duplicate_check_seconds"):
+            feature = features(text)
+            with self.lock:
+                return self._check(feature, limit, exclude)
+
+    def check_and_add(self, text, number=None, limit=3):
+        """check() and add_input() in one step, so concurrent callers see each other's lines."""
+        with metrics.span("duplicate_check_seconds"):
+            feature = features(text)
+            with self.lock:
+                matches = self._check(feature, limit, number)
+                # A repeat of a recorded line keeps pointing at the first one
+                if ("input", feature[4]) not in self.entries:
+                    self._add(("input", feature[4]), number, text, feature)
+        return matches
+
+    def _check(self, feature, limit, exclude):
+        amounts, dates, party, words, text_key = feature
+        candidates = set(self.by_text.get(text_key, ()))
+        for amount in amounts:
+            for date in dates:
+                candidates.update(self.by_date.get((amount, date), ()))
+            if party:
+                candidates.update(self.by_party.get((amount, party), ()))
+            if not dates and not party:
+                keys = self.by_amount.get(amount, ())
+                candidates.update(keys if len(keys) <= MAX_AMOUNT_CANDIDATES else ())
+
+        matches = []
+        for key in candidates:
+            number, text, (other_amounts, other_dates, other_party, other_words, other_text_key) = self.entries[key]
+            if exclude is not None and number == exclude:
+                continue
+            score = similarity(words, other_words)
+            reasons = []
+            if amounts & other_amounts:
+                reasons.append("amount")
+            if dates & other_dates:
+                reasons.append("date")
+            if party and party == other_party:
+                reasons.append("counterparty")
+            if text_key == other_text_key:
+                reasons.insert(0, "text")
+                score = 1.0
+            elif "amount" not in reasons:
+                continue
+            elif dates and other_dates and "date" not in reasons:
+                continue  # both dated, on different days: a recurring payment (rent, payroll), not a repeat
+            elif len(reasons) == 3 or (len(reasons) == 2 and score >= SIMILAR_TEXT):
+                pass
+            elif not dates and not party and score >= NEAR_COPY:
+                reasons.append("wording")
+            else:
+                continue
+            matches.append({"source": key[0], "number": number, "text": text,
+                            "score": round(score, 3), "reasons": reasons})
+        # Saved vouchers first on equal terms (they can serve as templates), then the earliest
+        matches.sort(key=lambda match: (-len(match["reasons"]), -match["score"], match["number"] is None,
+                                        match["number"] or 0))
+        if matches:
+            metrics.registry.inc("duplicates_flagged_total", source=matches[0]["source"])
+        return matches[:limit]
+
+
+def apply_template(voucher, text):
+    """
+    A copy of an earlier voucher adapted to a new bank line, for review before it is saved.
+
+    The line's date, if it names exactly one, becomes the voucher's 日期 and
+    replaces the 日期 of its lines;
+    its amount, if it names exactly one and the voucher moves a single amount,
+    replaces that amount. 合计 is recomputed.
+    """
+    template = dict(voucher)
+    template["明细"] = [dict(entry) for entry in voucher.get("明细", []) if isinstance(entry, dict)]
+    date = line_date(text)
+    amounts = _amounts(_DATE.sub(" ", text))
+    if date is not None:
+        template["日期"] = date
+        for entry in template["明细"]:
+            if "日期" in entry:
+                entry["日期"] = date
+    try:
+        used = {to_fen(entry[field]) for entry in template["明细"] for field in ("借方金额", "贷方金额")
+                if entry.get(field)}
+    except AmountError:
+        used = set()
+    if len(amounts) == 1 and len(used) == 1:
+        fen = next(iter(amounts))
+        value = str(fen // 100) if fen % 100 == 0 else f"{fen // 100}.{fen % 100:02d}"
+        for entry in template["明细"]:
+            for field in ("借方金额", "贷方金额"):
+                if entry.get(field):
+                    entry[field] = value
+    try:
+        verify_voucher(template)
+    except AmountError:
+        pass
+    return template
@@ -0,0 +1,187 @@
+"""
+Compact columnar snapshot of the ledger rows for fast startup.
+
+One file holds every 明细 line as a few typed arrays plus one string table
+(each distinct 科目 / 摘要 / amount / date stored once), so loading 100k
+lines is a handful of bulk reads instead of N JSON files or N SQLite rows.
+The snapshot records the ledger fingerprint it was taken at; callers
+compare it with LedgerStore.fingerprint() to know whether it is current.
+
+Layout: MAGIC, a 4 byte header length, a JSON header (row count,
+fingerprint, byte order, column sizes), the string table (uint32 lengths,
+then the UTF-8 bytes) and the columns in COLUMNS order.
+"""
+import json
+import os
+import struct
+import sys
+import threading
+from array import array
+
+from ledger_store import LEDGER_PATH
+
+
+SNAPSHOT_PATH = os.getenv("LEDGER_SNAPSHOT", LEDGER_PATH + ".snapshot")
+
+MAGIC = b"LEDGERSNAP1\n"
+HEADER_LENGTH = struct.Struct("<I")
+
+# (name, array typecode); string columns hold ids into the string table, -1 for None
+COLUMNS = (
+    ("id", "q"),
+    ("voucher", "q"),
+    ("line", "i"),
+    ("account", "i"),
+    ("summary", "i"),
+    ("debit", "i"),
+    ("credit", "i"),
+    ("date", "i"),
+    ("debit_fen", "q"),
+    ("credit_fen", "q"),
+)
+STRING_FIELDS = {"account": "科目", "summary": "摘要", "debit": "借方金额", "credit": "贷方金额", "date": "日期"}
+
+
+class LedgerSnapshot:
+    """Rows of a snapshot file, column-wise; rows() and facts() build the shapes the app uses."""
+
+    def __init__(self, fingerprint, strings, columns):
+        self.fingerprint = fingerprint
+        self.strings = strings
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def rows(self):
+        """Row dicts in the LedgerStore.all_rows(fen=True) format."""
+        strings = self.strings
+        c = self.columns
+        return [
+            {"id": row_id, "编号": str(voucher), "科目": strings[account] if account >= 0 else "",
+             "摘要": strings[summary] if summary >= 0 else "",
+             "借方金额": strings[debit] if debit >= 0 else None,
+             "贷方金额": strings[credit] if credit >= 0 else None,
+             "日期": strings[date] if date >= 0 else None, "line": line,
+             "debit_fen": debit_fen, "credit_fen": credit_fen}
+            for row_id, voucher, line, account, summary, debit, credit, date, debit_fen, credit_fen in zip(
+                c["id"], c["voucher"], c["line"], c["account"], c["summary"], c["debit"], c["credit"], c["date"],
+                c["debit_fen"], c["credit_fen"])
+        ]
+
+    def facts(self):
+        """(voucher, 科目, date, debit fen, credit fen) tuples, as LedgerStore.facts() returns them."""
+        strings = self.strings
+        c = self.columns
+        return [
+            (voucher, strings[account] if account >= 0 else "", strings[date] if date >= 0 else None,
+             debit, credit)
+            for voucher, account, date, debit, credit in zip(
+                c["voucher"], c["account"], c["date"], c["debit_fen"], c["credit_fen"])
+        ]
+
+
+def write_snapshot(path, rows, fingerprint):
+    """
+    Write ledger `rows` (LedgerStore.all_rows(fen=True) dicts) to `path`.
+
+    The file is written to a temporary name and renamed, so a reader never
+    sees half a snapshot.
+    """
+    string_ids = {}
+    strings = []
+    columns = {name: array(typecode) for name, typecode in COLUMNS}
+
+    def intern(value):
+        if value is None or value == "":
+            return -1
+        value = str(value)
+        index = string_ids.get(value)
+        if index is None:
+            index = string_ids[value] = len(strings)
+            strings.append(value)
+        return index
+
+    for row in rows:
+        columns["id"].append(row.get("id") or 0)
+        columns["voucher"].append(int(row["编号"]))
+        columns["line"].append(row.get("line") or 0)
+        for name, field in STRING_FIELDS.items():
+            columns[name].append(intern(row.get(field)))
+        columns["debit_fen"].append(row.get("debit_fen") or 0)
+        columns["credit_fen"].append(row.get("credit_fen") or 0)
+
+    encoded = [value.encode("utf-8") for value in strings]
+    lengths = array("I", (len(value) for value in encoded))
+    header = json.dumps({
+        "rows": len(columns["id"]),
+        "fingerprint": list(fingerprint),
+        "byteorder": sys.byteorder,
+        "strings": len(strings),
+        "string_bytes": sum(lengths),
+        "itemsize": {name: columns[name].itemsize for name, _ in COLUMNS},
+    }).encode("utf-8")
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        lengths.tofile(f)
+        for value in encoded:
+            f.write(value)
+        for name, _ in COLUMNS:
+            columns[name].tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Load a snapshot written by write_snapshot.
+
+    Returns:
+        LedgerSnapshot or None: None if the file is missing, from another
+        format version or machine byte order, or damaged.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        if not data.startswith(MAGIC):
+            return None
+        offset = len(MAGIC)
+        (header_length,) = HEADER_LENGTH.unpack_from(data, offset)
+        offset += HEADER_LENGTH.size
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+        if header["byteorder"] != sys.byteorder:
+            return None
+
+        lengths = array("I")
+        lengths.frombytes(data[offset:offset + header["strings"] * lengths.itemsize])
+        offset += len(lengths) * lengths.itemsize
+        # Lengths are in bytes: slice the raw block, then decode each string
+        raw = data[offset:offset + header["string_bytes"]]
+        offset += header["string_bytes"]
+        strings = []
+        position = 0
+        for length in lengths:
+            strings.append(raw[position:position + length].decode("utf-8"))
+            position += length
+
+        columns = {}
+        for name, typecode in COLUMNS:
+            column = array(typecode)
+            if column.itemsize != header["itemsize"][name]:
+                return None
+            size = header["rows"] * column.itemsize
+            column.frombytes(data[offset:offset + size])
+            offset += size
+            columns[name] = column
+        if offset != len(data):
+            return None
+    except (ValueError, KeyError, struct.error, UnicodeDecodeError):
+        return None
+    return LedgerSnapshot(tuple(header["fingerprint"]), strings, columns)
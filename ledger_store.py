@@ -0,0 +1,326 @@
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from voucher_check import AmountError, to_fen
+
+
+LEDGER_PATH = os.getenv("LEDGER_DB", "ledger.sqlite3")
+
+# import_json_files reports progress after this many directory entries
+PROGRESS_EVERY = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vouchers (
+    number INTEGER PRIMARY KEY,
+    file TEXT,
+    mtime REAL,
+    date TEXT,
+    data TEXT NOT NULL,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS details (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    voucher INTEGER NOT NULL REFERENCES vouchers(number) ON DELETE CASCADE,
+    line INTEGER NOT NULL,
+    account TEXT,
+    summary TEXT,
+    debit TEXT,
+    credit TEXT,
+    debit_fen INTEGER NOT NULL DEFAULT 0,
+    credit_fen INTEGER NOT NULL DEFAULT 0,
+    date TEXT
+);
+CREATE INDEX IF NOT EXISTS details_voucher ON details (voucher);
+CREATE INDEX IF NOT EXISTS details_account ON details (account);
+CREATE INDEX IF NOT EXISTS details_date ON details (date);
+CREATE INDEX IF NOT EXISTS vouchers_date ON vouchers (date);
+"""
+
+
+def voucher_number(path):
+    """Voucher number of an "n.json" file, or None for other files."""
+    stem = Path(path).stem
+    return int(stem) if stem.isdigit() else None
+
+
+def voucher_date(voucher, mtime=None):
+    """
+    The voucher's 日期 (the app and batch.py set it from the bank line's date), else
+    the first 日期 of its lines; the file's modification date is only a fallback.
+    """
+    date = voucher.get("日期")
+    if not date:
+        for entry in voucher.get("明细", []):
+            if isinstance(entry, dict) and entry.get("日期"):
+                date = entry["日期"]
+                break
+    if not date and mtime is not None:
+        date = datetime.date.fromtimestamp(mtime).isoformat()
+    return str(date) if date else None
+
+
+def _amount_fen(value):
+    if not value:
+        return 0
+    try:
+        return to_fen(value)
+    except AmountError:
+        return 0
+
+
+def _text(value):
+    return None if value is None or value == "" else str(value)
+
+
+class LedgerStore:
+    """
+    SQLite ledger of vouchers and their 明细 lines.
+
+    Lines are indexed by voucher number, account (科目) and date. Vouchers are
+    written one at a time, so saving a voucher costs one small transaction
+    instead of re-reading the whole directory, and readers can ask for just
+    the lines added after a given row id.
+    """
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(SCHEMA)
+        # Ledgers created before archive imports were versioned
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(vouchers)")}
+        if "version" not in columns:
+            self.db.execute("ALTER TABLE vouchers ADD COLUMN version INTEGER")
+        self.db.commit()
+
+    def add_voucher(self, number, voucher, file=None, mtime=None):
+        """
+        Insert or replace voucher `number` and its 明细 lines.
+
+        Returns:
+            list of dict: The stored lines, in the row format used by the tables.
+        """
+        with self.lock, self.db:
+            self._store_voucher(number, voucher, file, mtime)
+        return self.voucher_rows(number)
+
+    def _store_voucher(self, number, voucher, file, mtime, version=None):
+        # Caller holds the lock and the transaction
+        date = voucher_date(voucher, mtime)
+        details = [entry for entry in voucher.get("明细", []) if isinstance(entry, dict)]
+        self.db.execute("DELETE FROM details WHERE voucher = ?", (number,))
+        self.db.execute(
+            "INSERT OR REPLACE INTO vouchers (number, file, mtime, date, data, version) VALUES (?, ?, ?, ?, ?, ?)",
+            (number, file, mtime, date, json.dumps(voucher, ensure_ascii=False), version)
+        )
+        self.db.executemany(
+            "INSERT INTO details (voucher, line, account, summary, debit, credit, debit_fen, credit_fen, date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (number, line, entry.get("科目"), entry.get("摘要"),
+                 _text(entry.get("借方金额")), _text(entry.get("贷方金额")),
+                 _amount_fen(entry.get("借方金额")), _amount_fen(entry.get("贷方金额")), date)
+                for line, entry in enumerate(details)
+            ]
+        )
+
+    def remove_voucher(self, number):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM details WHERE voucher = ?", (number,))
+            self.db.execute("DELETE FROM vouchers WHERE number = ?", (number,))
+
+    def import_json_files(self, directory=".", progress=None):
+        """
+        One-shot importer for existing "n.json" voucher files.
+
+        Files already imported with the same modification time are skipped,
+        so calling this again only parses new or changed files. Vouchers whose
+        file has disappeared are removed (those imported from a voucher
+        archive are left alone).
+
+        Args:
+            directory (str): Directory holding the n.json files.
+            progress (callable): Optional progress(done, total) callback, called
+                every few hundred files from the calling thread.
+
+        Returns:
+            tuple: (imported numbers, list of (filename, error message)).
+        """
+        with self.lock:
+            stored = self.db.execute("SELECT number, mtime, file FROM vouchers").fetchall()
+        known = {number: mtime for number, mtime, _ in stored}
+        from_files = {number for number, _, file in stored if file is None or file.endswith(".json")}
+        parsed, errors = [], []
+        seen = set()
+        entries = list(os.scandir(directory))
+        for done, entry in enumerate(entries):
+            if progress is not None and done % PROGRESS_EVERY == 0:
+                progress(done, len(entries))
+            number = voucher_number(entry.name)
+            if number is None or not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            seen.add(number)
+            stat = entry.stat()
+            if stat.st_size == 0:
+                continue  # number reserved, content not renamed into place yet
+            mtime = stat.st_mtime
+            if known.get(number) == mtime:
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    voucher = json.load(f)
+            except (OSError, ValueError) as e:
+                errors.append((entry.name, str(e)))
+                continue
+            if not isinstance(voucher, dict) or "明细" not in voucher:
+                continue
+            parsed.append((number, voucher, entry.name, mtime))
+        # One transaction for the whole import; files deleted since the last
+        # import leave the ledger too
+        with self.lock, self.db:
+            for number, voucher, name, mtime in parsed:
+                self._store_voucher(number, voucher, name, mtime)
+            for number in from_files - seen:
+                self.db.execute("DELETE FROM details WHERE voucher = ?", (number,))
+                self.db.execute("DELETE FROM vouchers WHERE number = ?", (number,))
+        if progress is not None:
+            progress(len(entries), len(entries))
+        return sorted(number for number, _, _, _ in parsed), errors
+
+    def import_archive(self, archive):
+        """
+        Import the vouchers of a VoucherArchive (see voucher_archive.py).
+
+        Vouchers already imported in the same version (the record's CRC32 and
+        mtime; vouchers written by batch.py have no mtime) are skipped; the
+        rest are parsed one at a time straight from the archive's memory map.
+
+        Returns:
+            list of int: The imported voucher numbers.
+        """
+        with self.lock:
+            known = {number: (version, mtime) for number, version, mtime
+                     in self.db.execute("SELECT number, version, mtime FROM vouchers")}
+        numbers = [number for number in archive.numbers()
+                   if known.get(number) != (archive.version(number), archive.mtime(number))]
+        name = os.path.basename(archive.path)
+        imported = []
+        with self.lock, self.db:
+            for number, voucher, mtime in archive.items(numbers):
+                if isinstance(voucher, dict) and "明细" in voucher:
+                    self._store_voucher(number, voucher, name, mtime, archive.version(number))
+                    imported.append(number)
+        return imported
+
+    def _rows(self, where="", params=(), fen=False):
+        with self.lock:
+            cursor = self.db.execute(
+                "SELECT id, voucher, account, summary, debit, credit, date, line, debit_fen, credit_fen "
+                f"FROM details {where} ORDER BY voucher, line", params
+            )
+            rows = []
+            for row in cursor:
+                entry = {"id": row[0], "编号": str(row[1]), "科目": row[2] or "", "摘要": row[3] or "",
+                         "借方金额": row[4], "贷方金额": row[5], "日期": row[6], "line": row[7]}
+                if fen:
+                    entry["debit_fen"], entry["credit_fen"] = row[8], row[9]
+                rows.append(entry)
+            return rows
+
+    def all_rows(self, fen=False):
+        """Every line; with `fen`, also its parsed debit_fen/credit_fen (as ledger snapshots store them)."""
+        return self._rows(fen=fen)
+
+    def rows_after(self, last_id):
+        """Lines stored after row id `last_id` (for loading only what is new)."""
+        return self._rows("WHERE id > ?", (last_id,))
+
+    def voucher_rows(self, number):
+        return self._rows("WHERE voucher = ?", (number,))
+
+    def account_rows(self, account, include_sub_accounts=True):
+        """Lines booked to `account` (and its "account-xxx" sub-accounts)."""
+        if include_sub_accounts:
+            return self._rows("WHERE account = ? OR account LIKE ?", (account, account + "-%"))
+        return self._rows("WHERE account = ?", (account,))
+
+    def date_rows(self, start, end):
+        """Lines dated between `start` and `end` (ISO dates, inclusive)."""
+        return self._rows("WHERE date BETWEEN ? AND ?", (start, end))
+
+    def voucher(self, number):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM vouchers WHERE number = ?", (number,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def has_voucher(self, number):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM vouchers WHERE number = ?", (number,)).fetchone() is not None
+
+    def file_mtime(self, number):
+        """Modification time of the file voucher `number` was last read from (None if unknown)."""
+        with self.lock:
+            row = self.db.execute("SELECT mtime FROM vouchers WHERE number = ?", (number,)).fetchone()
+        return row[0] if row else None
+
+    def facts(self, number=None):
+        """
+        (voucher, 科目, date, debit fen, credit fen) per line, for the aggregation
+        engine; amounts come pre-parsed from the table. Optionally one voucher only.
+        """
+        where, params = ("WHERE voucher = ?", (number,)) if number is not None else ("", ())
+        with self.lock:
+            return self.db.execute(
+                f"SELECT voucher, account, date, debit_fen, credit_fen FROM details {where} ORDER BY voucher, line",
+                params
+            ).fetchall()
+
+    def fingerprint(self):
+        """
+        (line count, highest line id): changes whenever lines are added, replaced
+        or removed, since row ids are never reused. Used to validate snapshots.
+        """
+        with self.lock:
+            return tuple(self.db.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM details").fetchone())
+
+    def totals_fen(self):
+        """Grand debit/credit totals in fen."""
+        with self.lock:
+            return tuple(self.db.execute(
+                "SELECT COALESCE(SUM(debit_fen), 0), COALESCE(SUM(credit_fen), 0) FROM details"
+            ).fetchone())
+
+    def close(self):
+        self.db.close()
+
+
+def main(argv=None):
+    """Import the n.json files of a directory into the ledger database."""
+    parser = argparse.ArgumentParser(description="Import n.json voucher files into the SQLite ledger.")
+    parser.add_argument("directory", nargs="?", default=".")
+    parser.add_argument("--db", default=LEDGER_PATH)
+    parser.add_argument("--archive", help="import this voucher archive instead of a directory")
+    args = parser.parse_args(argv)
+    store = LedgerStore(args.db)
+    if args.archive:
+        from voucher_archive import VoucherArchive
+        archive = VoucherArchive(args.archive)
+        imported = store.import_archive(archive)
+        archive.close()
+    else:
+        imported, errors = store.import_json_files(args.directory)
+        for name, message in errors:
+            print(f"Failed to load {name}: {message}")
+    print(f"Imported {len(imported)} vouchers into {args.db}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
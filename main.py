@@ -1,16 +1,31 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
-import requests
+import functools
+import sqlite3
 import threading
-from dotenv import load_dotenv
+import time
 import os
 import json
 from pathlib import Path
 
+from dotenv import load_dotenv
 
-# Load environment variables for API credentials (optional, for security)
+# Before the imports below: metrics (METRICS_PORT), the ledger (LEDGER_DB) and
+# the other modules read their settings from the environment when imported
 load_dotenv()
 
+import metrics
+from duplicate_index import DuplicateIndex, apply_template, line_date
+from ledger_snapshot import SNAPSHOT_PATH, read_snapshot, write_snapshot
+from ledger_store import LEDGER_PATH, LedgerStore, voucher_number
+from voucher_check import AmountError, sum_amounts, verify_voucher
+from trial_balance import TrialBalanceEngine
+from virtual_tree import LedgerTableModel, VirtualTable, row_key
+from voucher_numbers import get_allocator
+from voucher_watcher import VoucherWatcher
+from voucher_extract import VoucherFormatError, extract_voucher, extraction_stats
+
+
 # Cloudflare API credentials (replace with your values or use environment variables)
 #CLOUDFLARE_AUTH_TOKEN = os.getenv("CLOUDFLARE_AUTH_TOKEN", "your-auth-token-here")
 #CLOUDFLARE_ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID", "your-account-id-here")
@@ -20,63 +35,31 @@ CLOUDFLARE_ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID", "")
 
 CLOUDFLARE_MODEL = "@cf/mistralai/mistral-small-3.1-24b-instruct"  # Model for Cloudflare AI
 
+# Stream tokens into the text areas as they arrive ("0" to wait for the full reply)
+STREAM_RESPONSES = os.getenv("CLOUDFLARE_STREAM", "1") != "0"
+# Minimum seconds between text area updates while streaming
+STREAM_FLUSH_INTERVAL = 0.05
+# Agent calls allowed in flight at once, and how often (ms) the UI collects their results
+MAX_CONCURRENT_CALLS = 4
+ENGINE_POLL_MS = 30
+# How often (ms) the status bar re-reads the metrics, and the startup progress bar its loaders
+STATUS_REFRESH_MS = 1000
+PROGRESS_POLL_MS = 100
 
-def remove_first_and_last_lines(text):
-    """
-    Removes the first and last lines from a multi-line text string.
-
-    Args:
-    text: A string containing multiple lines of text.
-
-    Returns:
-    A string containing the text with the first and last lines removed.
-    Returns an empty string if the input text has less than 3 lines.
-    """
-    lines = text.splitlines()
-    if not text.startswith('```'):return text
-    if len(lines) < 3:
-        return text  # Or raise an exception if you prefer, e.g., ValueError("Text must have at least 3 lines")
-    else:
-        return "\n".join(lines[1:-1])
+# Agents whose input is a bank line, checked against the duplicate index before it is sent
+DUPLICATE_CHECK_AGENTS = ("agent_1",)
 
+# Trial balance view: columns, the "whole ledger" period choice and the account levels offered
+TRIAL_BALANCE_COLUMNS = ["科目", "期初余额", "借方发生额", "贷方发生额", "期末余额"]
+ALL_PERIODS = "全部期间"
+ACCOUNT_LEVELS = {"一级科目": 1, "明细科目": None}
 
 
-def cloudflare_chat_completion(auth_token, account_id, model, messages):
-    """
-    Send a chat completion request to the Cloudflare AI API.
-
-    Args:
-        auth_token (str): Authorization token for the API.
-        account_id (str): Cloudflare account ID.
-        model (str): The model to use, e.g., "@cf/meta/llama-3.1-8b-instruct".
-        messages (list of dict): Chat messages with role and content, e.g.,
-                                 [{"role": "user", "content": "Your question"}].
-
-    Returns:
-        dict: The JSON response from the Cloudflare API.
-    """
-    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {auth_token}",
-        "Content-Type": "application/json",
-    }
-    data = {
-        "model": model,
-        "messages": messages,
-        "max_tokens": 4096
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        return {"error": str(e)}
-
 def save_to_next_available_file(string_to_save, directory=".", extension="json"):
     """
     Saves the provided string to a file with an incrementing filename format ("n.json").
-    The function ensures the filename does not overwrite any existing files by checking the next available number.
+    The next number comes from a persisted high-water mark and is claimed with an exclusive
+    create, so saving is constant time and concurrent saves never share a number.
     
     Parameters:
         string_to_save (str): The string content to save in the file.
@@ -86,20 +69,24 @@ def save_to_next_available_file(string_to_save, directory=".", extension="json")
     Returns:
         str: The name of the file created.
     """
-    # Initialize the counter for filenames
-    counter = 1
-    
-    # Generate filenames incrementally until we find an available one
-    while True:
-        filename = f"{counter}.{extension}"
-        file_path = os.path.join(directory, filename)
-        # Check if the file already exists
-        if not os.path.exists(file_path):
-            # File doesn't exist; create and save the content
-            with open(file_path, "w", encoding="utf-8") as file:
-                file.write(string_to_save)
-            return filename  # Return the created filename
-        counter += 1  # Increment the counter for the next file
+    return get_allocator(directory, extension).save(string_to_save)
+
+
+def load_services():
+    """
+    Import the API client, the agents and the agent engine.
+
+    requests/urllib3 and asyncio are most of the app's import time, so the
+    window calls this on a background thread after it has painted. .env has
+    been loaded when main.py was imported.
+
+    Returns:
+        tuple: (agents module, cloudflare_client module, AgentEngine class)
+    """
+    import agents
+    import cloudflare_client
+    from agent_engine import AgentEngine
+    return agents, cloudflare_client, AgentEngine
 
 
 class CloudflareChatApp:
@@ -131,70 +118,18 @@ class CloudflareChatApp:
             ["", "", "合计", "10000", "10000"]
         ]
 
-        # Define system prompts for different AI agents
-        self.system_prompts = {
-            "agent_1": 
-'''
-你是一名会计师，根据最新中国会计准则和我的输入制作会计凭证。会计凭证的格式为json和表格，包括（编号，科目，摘要，借方金额，贷方金额）。增值税率为13%。
-# 凭证制作要求
-1. 在输出时候请确认借贷平衡。
-2. 在金额含税的情况下根据增值税率计算进项或者销项的金额，方便在凭证中使用。
-3. 当出现熟悉公式时计算公式，例如：输入 1000*10 ，返回 10000。
-# 科目要求
-1. 一级科目选择要遵守最新的中国的企业会计准则。 参考（https://www.zkemu.com/acc4/u/kjkm/）
-# Json要求
-1. “借方合计”和“贷方合计”使用数字格式，非字符串。
-2. 对Json对象进行计算。“借方合计”和“贷方合计”为“明细"中的合计（相加）。校验Json对象是否符合Json的格式要求。
-如果“借方合计”和“贷方合计”不一致则代表借贷不平衡（“借方合计”和“贷方合计”是汇总“明细”里面的金额，请执行校验步骤避免错误）。
-3. 使用计算器用加法分别计算"借方金额"和"贷方金额"的和，保存在“合计”中的“借方合计”和“贷方合计”。
-4. 比较合计中的"借方合计”和“贷方合计” ，如果一致则“平衡”是 true，否则为 false 。保存在“合计“中。
-
-Json示例：
-{
-"明细": [
-{
-"编号": "1",
-"科目": "银行存款",
-"摘要": "收回维力贸易公司前欠购货款",
-"借方金额": "52100",
-"贷方金额": null
-},
-{
-"编号": "1",
-"科目": "应收账款-维力贸易公司",
-"摘要": "收回前欠购货款",
-"借方金额": null,
-"贷方金额": "52100"
-}
-],
-"合计": {
-"借方合计": 52100,
-"贷方合计": 52100,
- "平衡“: true
-}
-}
-。
-
-
-表格示例：
-
-| 编号 | 科目               | 摘要                     | 借方金额 | 贷方金额 |
-|------|--------------------|--------------------------|----------|----------|
-| 1    | 银行存款           | 收回维力贸易公司前欠购货款 | 52100    |          |
-| 1    | 应收账款-维力贸易公司 | 收回前欠购货款             |          | 52100    |
-| |  |  合计 | 52100    | 52100    |
-
-。
-
-''',
-
-            "agent_2":
-'''
-please only return the json object in the input
-''',
-
-            "agent_3": "You are a legal consultant for financial agreements. Provide guidance on contracts and obligations."
-        }
+        # The agents, API client and agent engine are imported by load_services() on a
+        # background thread; system prompts (AGENT_PROMPT_PROFILE picks agent_1's variant)
+        # are set once they arrive in on_services_loaded
+        self.agents = None
+        self.client = None
+        self.engine = None       # agent calls run on one background asyncio loop
+        self.services_error = None
+        self.prompt_profile = None
+        self.system_prompts = {}
+        self.slot_jobs = {}      # text area index -> id of the job whose output it shows
+        self.streamed = set()    # text areas that already received streamed text
+        self.sent_inputs = {}    # agent_1 job id -> bank line, recorded as a duplicate once answered
 
         # Create and configure UI elements (Text Areas, Buttons, and Two Tables)
         self.setup_ui()
@@ -207,7 +142,26 @@ please only return the json object in the input
         )
 
 
-        # Initialize table with data from all JSON files
+        # Live API latency / token throughput; METRICS_PORT also serves them to Prometheus
+        self.status_bar = ttk.Label(root, text="", anchor="w")
+        self.status_bar.grid(row=7, column=0, columnspan=2, padx=5, pady=(0, 5), sticky="ew")
+        self.setup_load_progress()
+        self.metrics_server = metrics.start_http_exporter()
+        self.root.after(STATUS_REFRESH_MS, self.refresh_status_bar)
+
+        # Ledger database of all saved vouchers (n.json files are imported into it)
+        self.ledger = LedgerStore(LEDGER_PATH)
+        # Per-科目 / per-period totals, kept up to date as vouchers come and go
+        self.aggregates = TrialBalanceEngine()
+        self.trial_balance_pending = False
+        # Picks up vouchers written by other machines or scripts; started once the ledger is loaded
+        self.watcher = None
+        # Bank lines already sent and saved vouchers, to catch a line pasted twice before it costs a call
+        self.duplicates = DuplicateIndex()
+        self.pending_input = None  # last line sent to agent_1; linked to the voucher saved next
+
+        # Heavy imports and the ledger load run in the background, so the window paints at once
+        threading.Thread(target=self.start_services, name="load-services", daemon=True).start()
         self.load_all_json_files()
 
 
@@ -233,7 +187,8 @@ please only return the json object in the input
             ("Ask Legal Consultant (Agent 3)", self.ask_agent_3),
             ("Clear All", self.clear_all),
             ("Update Table 1 (Test)", self.update_table_1_test),
-            ("Update Table 2 (Test)", self.update_table_2_test)  # Added button for second table
+            ("Update Table 2 (Test)", self.update_table_2_test),  # Added button for second table
+            ("Ask Agents 1 + 3 (Parallel)", self.ask_agents_parallel)
         ]
         for i, (label, command) in enumerate(button_configs):
             btn = ttk.Button(self.root, text=label, command=command)
@@ -246,6 +201,9 @@ please only return the json object in the input
         # Set up the second table in column 2, row 4
         self.setup_table_2()
 
+        # Trial balance under the ledger table (column 2, rows 5-6)
+        self.setup_trial_balance()
+
     def setup_table_1(self):
         """Set up the first table using ttk.Treeview in column 0, row 4."""
         headers = ["编号", "科目", "摘要", "借方金额", "贷方金额"]
@@ -265,22 +223,85 @@ please only return the json object in the input
         self.tree_1.pack(side="left", fill="both", expand=True)
 
     def setup_table_2(self):
-        """Set up the second table using ttk.Treeview in column 2, row 4."""
-        headers = ["编号", "科目", "摘要", "借方金额", "贷方金额"]
-        tree_frame = ttk.Frame(self.root)
-        tree_frame.grid(row=4, column=2, padx=5, pady=5, sticky="nsew")  # Place in column 2
-        self.tree_2 = ttk.Treeview(tree_frame, columns=headers, show="headings", height=8)
-        for header in headers:
-            self.tree_2.heading(header, text=header)
-            self.tree_2.column(header, width=120, anchor=tk.CENTER)
-        for row in self.table_data_2:
-            self.tree_2.insert("", "end", values=row)
-        tree_scrollbar_y = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree_2.yview)
-        tree_scrollbar_x = ttk.Scrollbar(tree_frame, orient="horizontal", command=self.tree_2.xview)
-        self.tree_2.configure(yscrollcommand=tree_scrollbar_y.set, xscrollcommand=tree_scrollbar_x.set)
-        tree_scrollbar_y.pack(side="right", fill="y")
-        tree_scrollbar_x.pack(side="bottom", fill="x")
-        self.tree_2.pack(side="left", fill="both", expand=True)
+        """Set up the second (ledger) table in column 2, row 4; only the visible rows are materialised."""
+        self.table_2 = VirtualTable(self.root)
+        self.table_2.frame.grid(row=4, column=2, padx=5, pady=5, sticky="nsew")  # Place in column 2
+        self.tree_2 = self.table_2.tree
+
+    def setup_trial_balance(self):
+        """Set up the trial balance view: period and account level pickers above a per-科目 table."""
+        frame = ttk.Frame(self.root)
+        frame.grid(row=5, column=2, rowspan=2, padx=5, pady=5, sticky="nsew")
+        controls = ttk.Frame(frame)
+        controls.pack(side="top", fill="x")
+        ttk.Label(controls, text="试算平衡表").pack(side="left")
+        self.period_picker = ttk.Combobox(controls, state="readonly", width=10, values=[ALL_PERIODS])
+        self.period_picker.set(ALL_PERIODS)
+        self.period_picker.pack(side="left", padx=5)
+        self.level_picker = ttk.Combobox(controls, state="readonly", width=8, values=list(ACCOUNT_LEVELS))
+        self.level_picker.set("一级科目")
+        self.level_picker.pack(side="left")
+        for picker in (self.period_picker, self.level_picker):
+            picker.bind("<<ComboboxSelected>>", lambda event: self.refresh_trial_balance())
+        self.trial_balance_label = ttk.Label(controls, text="", anchor="e")
+        self.trial_balance_label.pack(side="right")
+
+        self.tree_3 = ttk.Treeview(frame, columns=TRIAL_BALANCE_COLUMNS, show="headings", height=6)
+        for header in TRIAL_BALANCE_COLUMNS:
+            self.tree_3.heading(header, text=header)
+            self.tree_3.column(header, width=110, anchor=tk.CENTER)
+        scrollbar = ttk.Scrollbar(frame, orient="vertical", command=self.tree_3.yview)
+        self.tree_3.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        self.tree_3.pack(side="left", fill="both", expand=True)
+
+    def setup_load_progress(self):
+        """Progress bar and label for the startup loaders, in the status row (removed when done)."""
+        self.load_frame = ttk.Frame(self.root)
+        self.load_frame.grid(row=7, column=2, padx=5, pady=(0, 5), sticky="ew")
+        self.load_label = ttk.Label(self.load_frame, text="Loading ledger...", anchor="e")
+        self.load_label.pack(side="left", fill="x", expand=True)
+        self.load_bar = ttk.Progressbar(self.load_frame, mode="indeterminate", length=160)
+        self.load_bar.pack(side="right")
+
+    def refresh_load_progress(self):
+        """Show the ledger loader's progress (set from its thread), then check again shortly."""
+        if not self.ledger_loading:
+            return
+        done, total, text = self.load_progress
+        if total:
+            self.load_bar.configure(mode="determinate", maximum=total, value=done)
+        else:
+            self.load_bar.configure(mode="indeterminate")
+            self.load_bar.step()
+        self.load_label.config(text=text)
+        self.root.after(PROGRESS_POLL_MS, self.refresh_load_progress)
+
+    def schedule_trial_balance(self):
+        """Refresh the trial balance once the current burst of ledger changes is applied."""
+        if not self.trial_balance_pending:
+            self.trial_balance_pending = True
+            self.root.after_idle(self.refresh_trial_balance)
+
+    @metrics.timed("ui_update_seconds", op="trial_balance")
+    def refresh_trial_balance(self):
+        """Recompute the trial balance for the chosen period and level from the aggregation engine."""
+        self.trial_balance_pending = False
+        months = self.aggregates.periods("month")
+        self.period_picker.configure(values=[ALL_PERIODS] + months)
+        period = self.period_picker.get()
+        if period not in months:
+            period = ALL_PERIODS
+            self.period_picker.set(period)
+        start = end = None if period == ALL_PERIODS else period
+        result = self.aggregates.trial_balance(start, end, ACCOUNT_LEVELS.get(self.level_picker.get(), 1))
+
+        for item in self.tree_3.get_children():
+            self.tree_3.delete(item)
+        for row in result["rows"]:
+            self.tree_3.insert("", "end", values=[row[header] for header in TRIAL_BALANCE_COLUMNS])
+        self.tree_3.insert("", "end", values=["合计", "", result["借方合计"], result["贷方合计"], ""])
+        self.trial_balance_label.config(text="借贷平衡" if result["平衡"] else "借贷不平衡")
 
     def update_table(self, json_data, table_tree):
         """
@@ -351,15 +372,48 @@ please only return the json object in the input
           }
         }
         '''
+        if not self.require_services():
+            return
         source_text = self.text_areas[2].get(1.0, tk.END).strip()
-        temp = remove_first_and_last_lines(source_text)
+        temp = self.agents.remove_first_and_last_lines(source_text)
+        temp = self.verify_voucher_text(temp, self.pending_input)
         sample_json = temp
         self.text_areas[2].delete(1.0, tk.END)
         self.text_areas[2].insert(tk.END, temp)
-        save_to_next_available_file(temp)
-        self.load_all_json_files()
+        filename = save_to_next_available_file(temp)
+        self.add_saved_voucher(filename, temp)
         self.update_table(sample_json, self.tree_1)
 
+    def verify_voucher_text(self, text, source_text=None):
+        """
+        Recompute the 合计 of a voucher JSON string before it is saved.
+
+        Returns the JSON with authoritative 借方合计/贷方合计/平衡, or the text
+        unchanged if it cannot be parsed. Warns when the voucher does not balance
+        or its 进项/销项 VAT does not fit the net amount. The date named by
+        `source_text` (the bank line the voucher was made from), if any,
+        becomes its 日期.
+        """
+        try:
+            voucher = json.loads(text)
+            result = verify_voucher(voucher)
+        except (json.JSONDecodeError, AttributeError, AmountError):
+            return text
+        date = line_date(source_text) if source_text else None
+        if date is not None:
+            voucher["日期"] = date
+        if not result["balanced"]:
+            messagebox.showwarning(
+                "Balance Error",
+                f"借方合计 {result['debit']} ≠ 贷方合计 {result['credit']} (差额 {result['difference']})"
+            )
+        elif not result["vat_ok"]:
+            messagebox.showwarning(
+                "VAT Error",
+                f"增值税 {result['vat_actual']} ≠ 应为 {result['vat_expected']}"
+            )
+        return json.dumps(voucher, ensure_ascii=False, indent=2)
+
     def update_table_2_test(self):
         """Test method to update the second table with sample JSON data (different data for demo)."""
         sample_json = '''
@@ -386,7 +440,7 @@ please only return the json object in the input
           }
         }
         '''
-        self.update_table(sample_json, self.tree_2)
+        self.init_json(json.loads(sample_json)["明细"])
 
     def ask_agent_1(self):
         """Handle button click for 'Ask Financial Advisor (Agent 1)' (Text Area 1 to Text Area 2)."""
@@ -400,8 +454,25 @@ please only return the json object in the input
         """Handle button click for 'Ask Legal Consultant (Agent 3)' (Text Area 3 to Text Area 4)."""
         self.get_cloudflare_response(2, 3, 2, "agent_3")
 
+    def ask_agents_parallel(self):
+        """Handle button click for running Agent 1 and Agent 3 on Text Area 1 at the same time."""
+        source_text = self.text_areas[0].get(1.0, tk.END).strip()
+        if not source_text:
+            messagebox.showwarning("Input Error", "Please enter a question!")
+            return
+        if not self.require_services():
+            return
+        if self.check_duplicate(source_text, 1):
+            return
+        # Advisor answer goes to Text Area 2, legal review to Text Area 4
+        self.submit_agents({1: "agent_1", 3: "agent_3"}, source_text)
+        self.sent_inputs[self.slot_jobs[1]] = source_text
+
     def clear_all(self):
-        """Handle button click for 'Clear All' to clear all text areas."""
+        """Handle button click for 'Clear All' to cancel running requests and clear all text areas."""
+        if self.engine is not None:
+            self.engine.cancel_all()
+        self.slot_jobs.clear()
         for text_area in self.text_areas:
             text_area.delete(1.0, tk.END)
 
@@ -409,110 +480,484 @@ please only return the json object in the input
         """
         Fetch response from Cloudflare AI API based on input from source text area
         and display it in target text area, using a specific agent configuration.
+        A request still running for the same text area is cancelled.
         """
         source_text = self.text_areas[source_area_idx].get(1.0, tk.END).strip()
         if not source_text:
             messagebox.showwarning("Input Error", "Please enter a question!")
             return
-        self.buttons[button_idx].config(state="disabled")
-        self.text_areas[target_area_idx].delete(1.0, tk.END)
-        self.text_areas[target_area_idx].insert(tk.END, "Fetching response...\n")
-        thread = threading.Thread(target=self.fetch_cloudflare_response,
-                                 args=(source_text, target_area_idx, button_idx, agent_key))
-        thread.daemon = True
-        thread.start()
+        if not self.require_services():
+            return
+        if agent_key == self.agents.EXTRACTION_AGENT:
+            self.ask_extraction_agent(source_text, target_area_idx)
+            return
+        if agent_key in DUPLICATE_CHECK_AGENTS and self.check_duplicate(source_text, target_area_idx):
+            return
+        self.submit_agents({target_area_idx: agent_key}, source_text)
+        if agent_key in DUPLICATE_CHECK_AGENTS:
+            self.sent_inputs[self.slot_jobs[target_area_idx]] = source_text
 
-    def fetch_cloudflare_response(self, question, target_area_idx, button_idx, agent_key):
+    def check_duplicate(self, source_text, target_area_idx):
         """
-        Fetch response from Cloudflare AI API in a separate thread and update UI.
+        Look the bank line up in the duplicate index before it is sent.
+
+        A likely duplicate of a saved voucher can be taken as a template (the
+        earlier voucher with this line's date and amount, shown in the target
+        text area without an API call), sent anyway or dropped; a line sent
+        before but not saved can be sent anyway or dropped. A line is only
+        recorded as sent once agent_1 has answered it (drain_agent_results),
+        so re-sending it after an error or a cancel does not match itself.
+
+        Returns:
+            bool: True if the line must not be sent (template shown or cancelled).
         """
-        try:
-            messages = [
-                {"role": "system", "content": self.system_prompts.get(agent_key, "You are a helpful assistant.")},
-                {"role": "user", "content": question}
-            ]
-            response = cloudflare_chat_completion(
-                CLOUDFLARE_AUTH_TOKEN,
-                CLOUDFLARE_ACCOUNT_ID,
-                CLOUDFLARE_MODEL,
-                messages
+        matches = self.duplicates.check(source_text)
+        match = matches[0] if matches else None
+        voucher = None
+        # Offer a saved voucher as the template even if a plain input matched better
+        for candidate in matches:
+            if candidate["number"] is not None:
+                voucher = self.ledger.voucher(candidate["number"])
+                if voucher is not None:
+                    match = candidate
+                    break
+        if voucher is not None:
+            answer = messagebox.askyesnocancel(
+                "Possible Duplicate",
+                f"This line looks like voucher {match['number']} (same {', '.join(match['reasons'])}):\n"
+                f"{match['text']}\n\nYes: start from voucher {match['number']} (no API call)\n"
+                "No: send it anyway\nCancel: do nothing"
             )
-            if "error" in response:
-                answer = f"Error: {response['error']}"
-            else:
-                answer = response.get("choices", [{}])[0].get("message", {}).get("content", "No content received")
-            self.root.after(0, self.update_text_area, target_area_idx, answer, button_idx)
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            self.root.after(0, self.update_text_area, target_area_idx, error_msg, button_idx)
-
-    def update_text_area(self, target_area_idx, text, button_idx):
+            if answer is None:
+                return True
+            if answer:
+                self.engine.cancel(target_area_idx)
+                self.slot_jobs.pop(target_area_idx, None)
+                template = apply_template(voucher, source_text)
+                self.update_text_area(target_area_idx, json.dumps(template, ensure_ascii=False, indent=2))
+                self.pending_input = source_text
+                return True
+        elif match is not None and not messagebox.askyesno(
+                "Possible Duplicate",
+                f"This line was already sent (same {', '.join(match['reasons'])}):\n{match['text']}\n\n"
+                "Send it anyway?"):
+            return True
+        return False
+
+    def submit_agents(self, targets, question):
+        """Queue one agent call per {target_area_idx: agent_key} on the agent engine, in parallel."""
+        self.submit_jobs({
+            target_area_idx: functools.partial(self.fetch_cloudflare_response, question, agent_key)
+            for target_area_idx, agent_key in targets.items()
+        })
+
+    def submit_jobs(self, jobs):
+        """Queue {target_area_idx: job} on the agent engine, showing a placeholder in each target text area."""
+        for target_area_idx in jobs:
+            self.text_areas[target_area_idx].delete(1.0, tk.END)
+            self.text_areas[target_area_idx].insert(tk.END, "Fetching response...\n")
+            self.streamed.discard(target_area_idx)
+        self.slot_jobs.update(self.engine.fan_out({
+            target_area_idx: functools.partial(self.run_abortable, job) for target_area_idx, job in jobs.items()
+        }))
+
+    def run_abortable(self, job, context):
+        """Run an engine job so that cancelling it aborts the API requests it has in flight."""
+        scope = self.client.CancelScope()
+        context.on_cancel(scope.cancel)
+        with self.client.cancel_scope(scope):
+            return job(context)
+
+    def ask_extraction_agent(self, reply, target_area_idx):
         """
-        Update the target text area with the response and re-enable the button.
+        Turn agent_1's reply into the voucher JSON shown in the target text area.
+
+        The JSON is taken from the reply locally when it is there; a voucher
+        that balances and has the right VAT is shown straight away. Otherwise
+        fetch_voucher() asks agent_2 for it and/or corrects it on the engine.
+        """
+        voucher = self.extract_voucher_locally(reply)
+        if voucher is not None and self.voucher_is_correct(voucher):
+            self.engine.cancel(target_area_idx)
+            self.slot_jobs.pop(target_area_idx, None)
+            self.update_text_area(target_area_idx, json.dumps(voucher, ensure_ascii=False, indent=2))
+            return
+        question = self.text_areas[0].get(1.0, tk.END).strip()
+        self.submit_jobs({target_area_idx: functools.partial(self.fetch_voucher, reply, question, voucher)})
+
+    def voucher_is_correct(self, voucher):
+        """True if the voucher balances and its VAT fits the net amounts (unreadable amounts are left to the save check)."""
+        try:
+            result = verify_voucher(voucher)
+        except AmountError:
+            return True
+        return result["balanced"] and result["vat_ok"]
+
+    def fetch_voucher(self, reply, question, voucher, context):
+        """
+        Engine job: the voucher of agent_1's `reply`, corrected before it can be saved.
+
+        Without a locally extracted `voucher`, agent_2 is asked for the JSON.
+        A voucher that does not balance or whose VAT is off then gets the
+        same correction turns as batch.py (agents.balance_voucher, at most
+        MAX_CORRECTIONS), continuing agent_1's conversation about `question`,
+        the bank line in Text Area 1. If they fail, the last draft is
+        returned and the save warns about it.
+        """
+        if voucher is None:
+            answer = self.fetch_cloudflare_response(reply, self.agents.EXTRACTION_AGENT, context)
+            try:
+                voucher = extract_voucher(answer)
+            except VoucherFormatError:
+                return answer
+        if question:
+            try:
+                voucher, _, _ = self.agents.balance_voucher(
+                    voucher, question, reply, CLOUDFLARE_AUTH_TOKEN, CLOUDFLARE_ACCOUNT_ID, CLOUDFLARE_MODEL,
+                    self.system_prompts
+                )
+            except self.agents.AgentError:
+                pass
+        # Replace agent_2's streamed reply with the corrected voucher
+        context.restart()
+        return json.dumps(voucher, ensure_ascii=False, indent=2)
+
+    def start_services(self):
+        """Run load_services() (on a background thread) and hand the result to the Tk loop."""
+        try:
+            services = load_services()
+        except ImportError as e:
+            self.root.after(0, self.on_services_failed, str(e))
+            return
+        self.root.after(0, self.on_services_loaded, *services)
+
+    def on_services_loaded(self, agents, client, engine_class):
+        """Set up the system prompts and the agent engine once their modules are imported."""
+        self.agents = agents
+        self.client = client
+        self.prompt_profile = agents.get_prompt_profile()
+        self.system_prompts = dict(self.prompt_profile.system_prompts(agents.SYSTEM_PROMPTS))
+        # Results come back from the engine through a queue drained on the Tk loop
+        self.engine = engine_class(MAX_CONCURRENT_CALLS)
+        self.root.after(ENGINE_POLL_MS, self.drain_agent_results)
+
+    def on_services_failed(self, message):
+        self.services_error = message
+        messagebox.showerror("Error", f"Failed to load the API client: {message}")
+
+    def require_services(self):
+        """
+        Check that the agents are loaded before an action that needs them.
+
+        Returns:
+            bool: True if they are; otherwise the user is told why not.
+        """
+        if self.engine is not None:
+            return True
+        if self.services_error:
+            messagebox.showerror("Error", f"Failed to load the API client: {self.services_error}")
+        else:
+            messagebox.showinfo("Info", "Still starting up, please try again in a moment.")
+        return False
+
+    def extract_voucher_locally(self, source_text):
+        """
+        Try to pull the voucher JSON out of the source text without calling the API.
+
+        Returns:
+            dict or None: The voucher, or None if agent_2 has to be asked.
+        """
+        try:
+            voucher = extract_voucher(source_text)
+        except VoucherFormatError:
+            extraction_stats.record("fallback")
+            return None
+        extraction_stats.record("local")
+        return voucher
+
+    def fetch_cloudflare_response(self, question, agent_key, context):
+        """
+        Fetch response from Cloudflare AI API on an engine worker thread.
+
+        Returns the full answer; when streaming, partial text is also sent
+        through context.emit as it arrives. The agent's model comes from its
+        route (AGENT_MODELS); replies that are not streamed may be hedged.
+        """
+        messages = [
+            {"role": "system", "content": self.system_prompts.get(agent_key, self.agents.DEFAULT_SYSTEM_PROMPT)},
+            {"role": "user", "content": question}
+        ]
+        options = self.prompt_profile.request_options(agent_key, question)
+        if STREAM_RESPONSES:
+            model = self.agents.agent_model(agent_key, CLOUDFLARE_MODEL)
+            return self.stream_cloudflare_response(messages, context, options, model)
+        response = self.agents.routed_chat(
+            agent_key,
+            CLOUDFLARE_AUTH_TOKEN,
+            CLOUDFLARE_ACCOUNT_ID,
+            CLOUDFLARE_MODEL,
+            messages,
+            **options
+        )
+        context.check()  # cancelled: the call was aborted, drop its error
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response.get("choices", [{}])[0].get("message", {}).get("content", "No content received")
+
+    def stream_cloudflare_response(self, messages, context, options=None, model=CLOUDFLARE_MODEL):
+        """
+        Stream the reply through the engine's result queue.
+
+        Tokens are buffered here and emitted at most every STREAM_FLUSH_INTERVAL
+        seconds, so a long reply costs a few dozen widget updates rather than
+        one per token. Cancellation is noticed between chunks. The profile
+        retries of agents.chat() apply: a reply cut off at a sized max_tokens
+        is cleared and streamed again with the full budget.
+        """
+        parts = []
+        pending = []
+        last_flush = time.monotonic()
+
+        def restart():
+            parts.clear()
+            pending.clear()
+            context.restart()
+
+        for text in self.agents.stream_chat(
+            CLOUDFLARE_AUTH_TOKEN,
+            CLOUDFLARE_ACCOUNT_ID,
+            model,
+            messages,
+            restart=restart,
+            **(options or {})
+        ):
+            context.check()
+            parts.append(text)
+            pending.append(text)
+            now = time.monotonic()
+            # Show the first token straight away, then batch
+            if len(parts) == 1 or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                context.emit("".join(pending))
+                pending.clear()
+                last_flush = now
+        if pending:
+            context.emit("".join(pending))
+        return "".join(parts) or "No content received"
+
+    def drain_agent_results(self):
+        """Apply queued agent results on the Tk thread, then check again shortly."""
+        for kind, target_area_idx, job_id, payload in self.engine.drain():
+            sent_input = self.sent_inputs.pop(job_id, None) if kind in ("done", "error", "cancelled") else None
+            if self.slot_jobs.get(target_area_idx) != job_id:
+                continue  # superseded or cleared
+            if kind == "done" and sent_input is not None:
+                self.duplicates.add_input(sent_input)
+                self.pending_input = sent_input
+            if kind == "chunk":
+                self.append_text_area(target_area_idx, payload, target_area_idx not in self.streamed)
+                self.streamed.add(target_area_idx)
+                continue
+            if kind == "restart":
+                self.streamed.discard(target_area_idx)  # the next chunk replaces the text shown
+                continue
+            del self.slot_jobs[target_area_idx]
+            if kind == "done" and target_area_idx not in self.streamed:
+                self.update_text_area(target_area_idx, payload)
+            elif kind == "error":
+                if target_area_idx in self.streamed:
+                    self.append_text_area(target_area_idx, f"\nError: {payload}")
+                else:
+                    self.update_text_area(target_area_idx, f"Error: {payload}")
+        self.root.after(ENGINE_POLL_MS, self.drain_agent_results)
+
+    def refresh_status_bar(self):
+        """Show p95 API latency, tokens/minute and the cache hit rate, then schedule the next refresh."""
+        registry = metrics.registry
+        p95 = registry.percentile("cf_request_seconds", 0.95, phase="total")
+        latency = f"{p95 * 1000:.0f} ms" if p95 is not None else "–"
+        hits = registry.counter("cf_cache_requests_total", result="hit")
+        lookups = registry.counter("cf_cache_requests_total")
+        cache = f"{hits / lookups:.0%}" if lookups else "–"
+        self.status_bar.config(
+            text=f"API p95 {latency}    {registry.tokens_per_minute():.0f} tokens/min    "
+                 f"calls {registry.counter('cf_requests_total')}    "
+                 f"retries {registry.counter('cf_retries_total')}    cache hits {cache}"
+        )
+        self.root.after(STATUS_REFRESH_MS, self.refresh_status_bar)
+
+    @metrics.timed("ui_update_seconds", op="append_text_area")
+    def append_text_area(self, target_area_idx, text, replace=False):
+        """Append streamed text to the target text area (replacing the placeholder on the first batch)."""
+        text_area = self.text_areas[target_area_idx]
+        if replace:
+            text_area.delete(1.0, tk.END)
+        text_area.insert(tk.END, text)
+        text_area.see(tk.END)
+
+    @metrics.timed("ui_update_seconds", op="update_text_area")
+    def update_text_area(self, target_area_idx, text):
+        """
+        Update the target text area with the response.
         """
         self.text_areas[target_area_idx].delete(1.0, tk.END)
         self.text_areas[target_area_idx].insert(tk.END, text)
-        self.buttons[button_idx].config(state="normal")
     ## --- Table Functions ---
     def calculate_total(self, table_rows):
-        total_debit = sum(float(row.get("借方金额")) if row.get("借方金额") else 0 for row in table_rows)
-        total_credit = sum(float(row.get("贷方金额")) if row.get("贷方金额") else 0 for row in table_rows)
-        return total_debit, total_credit
+        # Exact fen arithmetic; float sums drift on amounts with cents
+        return sum_amounts(table_rows)
 
+    @metrics.timed("ui_update_seconds", op="init_json")
     def init_json(self, table_rows):
-        """Initialize or update the table with the provided rows."""
-        print(table_rows)
+        """Initialize or update the table with the provided rows (only differences are applied)."""
         if not hasattr(self, 'tree_2'):
             return  # Safeguard in case tree is not initialized
-        for i in self.tree_2.get_children():
-            self.tree_2.delete(i)
-        for row in table_rows:
-            values = [
-                row.get("编号", ""),
-                row.get("科目", ""),
-                row.get("摘要", ""),
-                row.get("借方金额") if row.get("借方金额") else "",
-                row.get("贷方金额") if row.get("贷方金额") else ""
-            ]
-            self.tree_2.insert("", "end", values=values)
-        total_debit, total_credit = self.calculate_total(table_rows)
-        total_row = ["合计", "", "", total_debit, total_credit]
-        self.tree_2.insert("", "end", values=total_row)
+        self.table_2.set_rows(table_rows)
+        return self.update_total_label()
+
+    @metrics.timed("ui_update_seconds", op="append_json")
+    def append_json(self, table_rows, voucher=None):
+        """Add rows to the table (replacing the lines of `voucher` if given) without a full reload."""
+        if not hasattr(self, 'tree_2'):
+            return  # Safeguard in case tree is not initialized
+        if voucher is not None:
+            self.table_2.replace_voucher(voucher, table_rows)
+        else:
+            self.table_2.upsert_rows(table_rows)
+        return self.update_total_label()
+
+    def update_total_label(self):
+        # Totals are kept up to date by the table model as rows come and go
+        total_debit, total_credit = self.table_2.model.totals()
         self.total_label.config(text=f"借方合计: {total_debit}    贷方合计: {total_credit}")
         return total_debit, total_credit
 
+    def add_saved_voucher(self, filename, text):
+        """Store a just-saved voucher file in the ledger and append only its rows to the table."""
+        number = voucher_number(filename)
+        try:
+            voucher = json.loads(text)
+        except json.JSONDecodeError as e:
+            messagebox.showerror("Error", f"Failed to load {filename}: {str(e)}")
+            return
+        if number is None or not isinstance(voucher, dict) or "明细" not in voucher:
+            return
+        mtime = os.path.getmtime(filename)
+        if self.ledger_loading:
+            self.saved_during_load.add(number)  # re-applied to the model the loader hands over
+        rows = self.ledger.add_voucher(number, voucher, filename, mtime)
+        self.append_json(rows, number)
+        self.aggregates.replace_voucher(number, self.ledger.facts(number))
+        self.duplicates.replace_voucher(number, rows)
+        if self.pending_input is not None:
+            self.duplicates.add_input(self.pending_input, number)
+            self.pending_input = None
+        self.schedule_trial_balance()
+
+    def on_vouchers_changed(self, deltas):
+        """Called on the watcher thread; hands the deltas to the Tk loop."""
+        self.root.after(0, self.apply_voucher_deltas, deltas)
+
+    @metrics.timed("ui_update_seconds", op="apply_voucher_deltas")
+    def apply_voucher_deltas(self, deltas):
+        """Apply (number, rows) deltas from the watcher to the ledger table; rows None means deleted."""
+        for number, rows in deltas:
+            self.table_2.replace_voucher(number, rows or [])
+            self.aggregates.replace_voucher(number, self.ledger.facts(number))
+            self.duplicates.replace_voucher(number, rows)
+        self.update_total_label()
+        self.schedule_trial_balance()
+
     def load_all_json_files(self):
-        
-        """Load all JSON files from the current directory and display their data in the table."""
+        """
+        Load the ledger (all n.json files of the current directory) into the table and
+        trial balance, on a background thread; progress shows in the status row.
+        """
         if not hasattr(self, 'tree_2'):
             return  # Safeguard in case tree is not initialized
-        all_data = []
-        current_dir = Path.cwd()
-        json_files = current_dir.glob("*.json")
-        
+        self.ledger_loading = True
+        self.saved_during_load = set()
+        self.load_progress = (0, 0, "Loading ledger...")
+        threading.Thread(target=self.load_ledger, name="load-ledger", daemon=True).start()
+        self.root.after(PROGRESS_POLL_MS, self.refresh_load_progress)
 
-        for json_file in json_files:
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    n = os.path.basename(json_file).split('.')[0]
-                    file_data = json.load(f)
-                    if "明细" in file_data:
-                        all_data.extend(file_data["明细"])
-                        for item in file_data["明细"]:
-                            if "编号" in item:
-                                item["编号"] = n
-                        
-                    
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load {json_file.name}: {str(e)}")
-
-        if all_data:
-            
-            self.init_json(all_data)
-        else:
-            messagebox.showinfo("Info", "No valid JSON data found to display in the table.")
-            self.init_json(data["明细"])  # Fallback to sample data if no JSON files are found
+    def load_ledger(self):
+        """
+        Ledger loader thread.
 
+        A snapshot taken at the database's current fingerprint is shown first,
+        without touching SQLite rows or JSON files. Then new or changed n.json
+        files are imported (only those are parsed); if that changed the ledger,
+        the rows are read from the database, shown, and saved as the new snapshot.
+        """
+        try:
+            shown = None
+            snapshot = read_snapshot(SNAPSHOT_PATH)
+            if snapshot is not None and snapshot.fingerprint == self.ledger.fingerprint():
+                self.hand_over_ledger(snapshot.rows(), snapshot.facts())
+                shown = snapshot.fingerprint
+            _, errors = self.ledger.import_json_files(Path.cwd(), self.report_load_progress)
+            fingerprint = self.ledger.fingerprint()
+            if fingerprint == shown:
+                self.root.after(0, self.on_ledger_loaded, None, None, errors, True)
+                return
+            self.load_progress = (0, 0, "Reading ledger...")
+            rows = self.ledger.all_rows(fen=True)
+            self.hand_over_ledger(rows, self.ledger.facts(), errors)
+            self.load_progress = (0, 0, "Saving ledger snapshot...")
+            write_snapshot(SNAPSHOT_PATH, rows, fingerprint)
+            self.root.after(0, self.on_ledger_loaded, None, None, (), True)
+        except (OSError, sqlite3.Error) as e:
+            self.root.after(0, self.on_ledger_failed, str(e))
+
+    def report_load_progress(self, done, total):
+        # Called on the loader thread; refresh_load_progress picks it up
+        self.load_progress = (done, total, f"Importing voucher files {done}/{total}")
+
+    def hand_over_ledger(self, rows, facts, errors=()):
+        """
+        Build the table model and aggregates on the loader thread, then swap them in on the Tk loop.
+        The duplicate index is re-filled here too (it has its own lock).
+        """
+        model = LedgerTableModel()
+        model.load({row_key(row, position): row for position, row in enumerate(rows)})
+        aggregates = TrialBalanceEngine()
+        aggregates.load(facts)
+        self.duplicates.load_rows(rows)
+        self.root.after(0, self.on_ledger_loaded, model, aggregates, errors, False)
+
+    def on_ledger_loaded(self, model, aggregates, errors, done):
+        """Show a loaded ledger (model None: unchanged) and, when `done`, finish startup."""
+        for name, message in errors:
+            messagebox.showerror("Error", f"Failed to load {name}: {message}")
+        if model is not None:
+            self.table_2.set_model(model)
+            self.aggregates = aggregates
+            # Vouchers saved while the loader ran may be missing from what it read
+            for number in self.saved_during_load:
+                rows = self.ledger.voucher_rows(number)
+                self.table_2.replace_voucher(number, rows)
+                self.aggregates.replace_voucher(number, self.ledger.facts(number))
+                self.duplicates.replace_voucher(number, rows)
+            self.update_total_label()
+            self.schedule_trial_balance()
+        if done:
+            if not len(self.table_2.model):
+                messagebox.showinfo("Info", "No valid JSON data found to display in the table.")
+            self.finish_loading()
+
+    def on_ledger_failed(self, message):
+        messagebox.showerror("Error", f"Failed to load the ledger: {message}")
+        self.finish_loading()
+
+    def finish_loading(self):
+        """Hide the progress indicator and start watching for vouchers written elsewhere."""
+        self.ledger_loading = False
+        self.saved_during_load.clear()
+        self.load_frame.grid_remove()
+        self.status_bar.grid_configure(columnspan=3)
+        if self.watcher is None:
+            self.watcher = VoucherWatcher(Path.cwd(), self.ledger, self.on_vouchers_changed)
+            self.watcher.start()
 
 def main():
     """Main function to run the Tkinter application."""
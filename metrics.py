@@ -0,0 +1,316 @@
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+
+# Serve Prometheus text on this port (e.g. 9464) and/or append one JSON line per API call here
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+METRICS_JSONL = os.getenv("METRICS_JSONL", "")
+
+# Latency buckets in seconds (upper bounds, +Inf is implied)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# USD per million (input, output) tokens; override with CLOUDFLARE_PRICE_PER_MTOK="in,out"
+MODEL_PRICES = {
+    "@cf/mistralai/mistral-small-3.1-24b-instruct": (0.351, 0.555),
+    "@cf/meta/llama-3.1-8b-instruct": (0.282, 0.827),
+}
+_price_override = os.getenv("CLOUDFLARE_PRICE_PER_MTOK", "")
+
+HELP = {
+    "cf_request_seconds": ("histogram", "Cloudflare API call time by phase (dns, connect, ttfb, total)"),
+    "cf_requests_total": ("counter", "Cloudflare API calls by final status"),
+    "cf_retries_total": ("counter", "Retried Cloudflare API attempts"),
+    "cf_tokens_total": ("counter", "Tokens reported in the API usage field"),
+    "cf_cost_usd_total": ("counter", "Estimated spend from token usage"),
+    "cf_cache_requests_total": ("counter", "Response cache lookups by result"),
+    "cf_truncated_total": ("counter", "Replies cut off at a sized max_tokens and requested again"),
+    "cf_coalesced_total": ("counter", "Calls answered by an identical request already in flight"),
+    "cf_hedged_total": ("counter", "Second requests sent because the first passed its latency deadline"),
+    "cf_route_wins_total": ("counter", "Agent calls by the model and request (primary or hedge) that answered"),
+    "duplicate_check_seconds": ("histogram", "Time spent checking a bank line against the duplicate index"),
+    "duplicates_flagged_total": ("counter", "Bank lines flagged as likely duplicates, by what they matched"),
+    "scheduler_wait_seconds": ("histogram", "Time spent waiting for the account rate limit"),
+    "scheduler_throttled_total": ("counter", "429 responses that paused the scheduler"),
+    "ui_update_seconds": ("histogram", "Time spent updating Tk widgets"),
+}
+
+
+def model_price(model):
+    """(input, output) USD per million tokens for `model`, or None when unknown."""
+    if _price_override:
+        try:
+            prompt, completion = (float(part) for part in _price_override.split(","))
+            return prompt, completion
+        except ValueError:
+            pass
+    return MODEL_PRICES.get(model)
+
+
+class Histogram:
+    """
+    Bucketed histogram plus a window of the most recent samples.
+
+    The buckets feed the Prometheus export; the window gives live
+    percentiles (e.g. the p95 in the status bar) without keeping every sample.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1024):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms keyed by (name, labels).
+
+    Calls are cheap (one lock, a dict lookup and a bisect), so they can sit
+    on the request path and in Tk callbacks.
+    """
+
+    def __init__(self, token_window=60.0):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.token_window = token_window
+        self.token_events = deque()  # (monotonic time, tokens)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """Sum of the counter `name` over every label set that includes `labels`."""
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items()
+                       if key == name and wanted <= set(key_labels))
+
+    def percentile(self, name, fraction, **labels):
+        """Percentile of the recent samples of `name` across every label set that includes `labels`."""
+        wanted = set(labels.items())
+        with self.lock:
+            samples = [value for (key, key_labels), histogram in self.histograms.items()
+                       if key == name and wanted <= set(key_labels) for value in histogram.recent]
+        return _percentile(samples, fraction)
+
+    def sample_count(self, name, **labels):
+        """Number of observations of histogram `name` across every label set that includes `labels`."""
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(histogram.count for (key, key_labels), histogram in self.histograms.items()
+                       if key == name and wanted <= set(key_labels))
+
+    def record_tokens(self, tokens, **labels):
+        self.inc("cf_tokens_total", tokens, **labels)
+        now = time.monotonic()
+        with self.lock:
+            self.token_events.append((now, tokens))
+            while self.token_events and self.token_events[0][0] < now - self.token_window:
+                self.token_events.popleft()
+
+    def tokens_per_minute(self):
+        """Tokens (in + out) seen during the last `token_window` seconds, scaled to one minute."""
+        cutoff = time.monotonic() - self.token_window
+        with self.lock:
+            total = sum(tokens for at, tokens in self.token_events if at >= cutoff)
+        return total * 60.0 / self.token_window
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.buckets), list(h.counts), h.count, h.sum) for key, h in histograms]
+        described = set()
+
+        def describe(name):
+            if name not in described and name in HELP:
+                kind, text = HELP[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), buckets, counts, count, total in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(labels)} {total}")
+            lines.append(f"{name}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.token_events.clear()
+
+
+registry = MetricsRegistry()
+
+
+class JsonlExporter:
+    """Appends one JSON object per line to `path` (thread-safe, line buffered)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+_call_log = JsonlExporter(METRICS_JSONL) if METRICS_JSONL else None
+
+
+def set_call_log(path):
+    """Write per-call records to `path` (None stops writing them)."""
+    global _call_log
+    _call_log = JsonlExporter(path) if path else None
+
+
+def new_call(model, stream=False):
+    """Start a per-call record; the HTTP client fills in phases, status, retries and usage."""
+    return {"ts": time.time(), "model": model, "stream": stream, "retries": 0, "status": None}
+
+
+def record_call(call):
+    """
+    Feed a finished call record into the registry (and the JSONL log if enabled).
+
+    Expected keys: model, status, retries, and where known dns, connect,
+    ttfb, total (seconds) and prompt_tokens / completion_tokens.
+    """
+    model = call.get("model") or ""
+    for phase in ("dns", "connect", "ttfb", "total"):
+        if call.get(phase) is not None:
+            registry.observe("cf_request_seconds", call[phase], phase=phase, model=model)
+    registry.inc("cf_requests_total", status=str(call.get("status")), model=model)
+    if call.get("retries"):
+        registry.inc("cf_retries_total", call["retries"], model=model)
+    prompt_tokens = call.get("prompt_tokens") or 0
+    completion_tokens = call.get("completion_tokens") or 0
+    if prompt_tokens:
+        registry.record_tokens(prompt_tokens, direction="prompt", model=model)
+    if completion_tokens:
+        registry.record_tokens(completion_tokens, direction="completion", model=model)
+    price = model_price(model)
+    if price and (prompt_tokens or completion_tokens):
+        call["cost_usd"] = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+        registry.inc("cf_cost_usd_total", call["cost_usd"], model=model)
+    if _call_log is not None:
+        _call_log.write(call)
+
+
+def record_usage(call, usage):
+    """Copy the token counts of an API `usage` object into a call record."""
+    if isinstance(usage, dict):
+        call["prompt_tokens"] = usage.get("prompt_tokens")
+        call["completion_tokens"] = usage.get("completion_tokens")
+
+
+@contextmanager
+def span(name, **labels):
+    """Time the enclosed block into histogram `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of span()."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def start_http_exporter(port=METRICS_PORT, host="127.0.0.1"):
+    """
+    Serve /metrics in Prometheus text format on a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer or None: The server, or None when `port` is 0.
+    """
+    if not port:
+        return None
+    # Imported here: http.server is only needed when the exporter is on, and it slows app startup
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
@@ -0,0 +1,287 @@
+"""
+Local stand-in for the Cloudflare Workers AI chat completions endpoint.
+
+Serves POST /client/v4/accounts/{account_id}/ai/v1/chat/completions with
+canned voucher replies, both as a regular JSON body and as server-sent
+events when the request has "stream": true. Replies follow the request the
+way the model would: JSON only under the compact prompt or JSON mode, and
+cut off (finish_reason "length") at max_tokens. Latency, token rate and the
+share of 429 / 5xx answers are configurable, so the app and the benchmark
+can be exercised without touching the real API.
+
+Usage:
+    python mock_server.py --port 8787 --latency 0.3 --token-rate 80 --rate-limit 0.05
+    CLOUDFLARE_API_BASE=http://127.0.0.1:8787/client/v4 python main.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PATH_PATTERN = re.compile(r"^/client/v4/accounts/[^/]+/ai/v1/chat/completions$")
+
+# Canned agent_1 style replies (JSON plus the markdown table)
+CANNED_VOUCHERS = [
+    {
+        "明细": [
+            {"编号": "1", "科目": "银行存款", "摘要": "收回维力贸易公司前欠购货款", "借方金额": "52100", "贷方金额": None},
+            {"编号": "1", "科目": "应收账款-维力贸易公司", "摘要": "收回前欠购货款", "借方金额": None, "贷方金额": "52100"},
+        ],
+        "合计": {"借方合计": 52100, "贷方合计": 52100, "平衡": True},
+    },
+    {
+        "明细": [
+            {"编号": "1", "科目": "库存现金", "摘要": "从银行提取备用金", "借方金额": "3000", "贷方金额": None},
+            {"编号": "1", "科目": "银行存款", "摘要": "提取备用金", "借方金额": None, "贷方金额": "3000"},
+        ],
+        "合计": {"借方合计": 3000, "贷方合计": 3000, "平衡": True},
+    },
+    {
+        "明细": [
+            {"编号": "1", "科目": "库存商品", "摘要": "采购商品入库", "借方金额": "10000", "贷方金额": None},
+            {"编号": "1", "科目": "应交税费-应交增值税(进项税额)", "摘要": "进项税额", "借方金额": "1300", "贷方金额": None},
+            {"编号": "1", "科目": "应付账款", "摘要": "采购商品未付款", "借方金额": None, "贷方金额": "11300"},
+        ],
+        "合计": {"借方合计": 11300, "贷方合计": 11300, "平衡": True},
+    },
+]
+
+
+def voucher_reply(voucher, table=True):
+    """
+    Render a voucher the way agent_1 answers: fenced JSON followed by the markdown
+    table, or (table=False, as asked by the compact prompt / JSON mode) bare JSON.
+    """
+    if not table:
+        return json.dumps(voucher, ensure_ascii=False)
+    lines = [
+        "```json",
+        json.dumps(voucher, ensure_ascii=False, indent=2),
+        "```",
+        "",
+        "| 编号 | 科目 | 摘要 | 借方金额 | 贷方金额 |",
+        "|------|------|------|----------|----------|",
+    ]
+    for entry in voucher["明细"]:
+        lines.append(f"| {entry['编号']} | {entry['科目']} | {entry['摘要']} | "
+                     f"{entry['借方金额'] or ''} | {entry['贷方金额'] or ''} |")
+    summary = voucher["合计"]
+    lines.append(f"| | | 合计 | {summary['借方合计']} | {summary['贷方合计']} |")
+    return "\n".join(lines)
+
+
+def count_tokens(text):
+    """Rough token estimate (about 1 token per CJK character or 4 other characters)."""
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text, limit):
+    """Cut `text` to at most `limit` tokens (by count_tokens), as a max_tokens limit would."""
+    if count_tokens(text) <= limit:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+class MockConfig:
+    def __init__(self, latency=0.2, jitter=0.1, token_rate=0.0, error_rate=0.0,
+                 rate_limit=0.0, retry_after=1, replies=None, seed=None, tail_rate=0.0, tail_factor=10.0):
+        self.latency = latency          # seconds before the first byte
+        self.jitter = jitter            # +/- fraction applied to latency
+        self.tail_rate = tail_rate      # share of requests that are `tail_factor` times slower
+        self.tail_factor = tail_factor
+        self.token_rate = token_rate    # generated tokens per second (0 = instant)
+        self.error_rate = error_rate    # share of requests answered with a 500
+        self.rate_limit = rate_limit    # share of requests answered with a 429
+        self.retry_after = retry_after  # Retry-After seconds sent with 429s
+        self.replies = replies  # fixed reply strings; None renders CANNED_VOUCHERS per request
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "errors": 0, "rate_limited": 0}
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None  # set per server in make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=()):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        config = self.config
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"errors": [{"message": "invalid JSON"}]})
+            return
+        if not PATH_PATTERN.match(self.path):
+            self._send_json(404, {"errors": [{"message": "not found"}]})
+            return
+        config.count("requests")
+
+        roll = config.roll()
+        if roll < config.rate_limit:
+            config.count("rate_limited")
+            self._send_json(429, {"errors": [{"message": "rate limited"}]},
+                            [("Retry-After", str(config.retry_after))])
+            return
+        if roll < config.rate_limit + config.error_rate:
+            config.count("errors")
+            self._send_json(500, {"errors": [{"message": "injected error"}]})
+            return
+
+        messages = request.get("messages", [])
+        prompt = "".join(str(m.get("content", "")) for m in messages)
+        user = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+        # Same input, same canned reply, so cache and dedup behave as with a real model
+        choice = sum(map(ord, str(user)))
+        if config.replies:
+            reply = config.replies[choice % len(config.replies)]
+        else:
+            # Like the real prompt: the table only when the system prompt shows one and JSON mode is off
+            table = "表格示例" in str(system) and not request.get("response_format")
+            reply = voucher_reply(CANNED_VOUCHERS[choice % len(CANNED_VOUCHERS)], table)
+        finish_reason = "stop"
+        max_tokens = request.get("max_tokens")
+        if max_tokens and count_tokens(reply) > max_tokens:
+            reply = truncate_tokens(reply, max_tokens)
+            finish_reason = "length"
+        usage = {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(reply)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        delay = config.latency * (1 + config.jitter * (2 * config.roll() - 1))
+        if config.tail_rate and config.roll() < config.tail_rate:
+            delay *= config.tail_factor
+        time.sleep(max(0.0, delay))
+
+        if request.get("stream"):
+            config.count("streamed")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            step = 8
+            for i in range(0, len(reply), step):
+                piece = reply[i:i + step]
+                event = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                if config.token_rate:
+                    time.sleep(count_tokens(piece) / config.token_rate)
+            final = {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "usage": usage}
+            self._write_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        if config.token_rate:
+            time.sleep(usage["completion_tokens"] / config.token_rate)
+        self._send_json(200, {
+            "id": "mock-chatcmpl",
+            "object": "chat.completion",
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                         "finish_reason": finish_reason}],
+            "usage": usage,
+        })
+
+
+class MockServer:
+    """
+    Mock API server on a background thread.
+
+    with MockServer(latency=0.05) as server:
+        set_client(CloudflareClient(base_url=server.base_url))
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, **config):
+        self.config = MockConfig(**config)
+        handler = type("ConfiguredMockHandler", (MockHandler,), {"config": self.config})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/client/v4"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-cloudflare", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Cloudflare Workers AI chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first byte")
+    parser.add_argument("--jitter", type=float, default=0.1, help="+/- fraction of latency")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of requests that are much slower")
+    parser.add_argument("--tail-factor", type=float, default=10.0, help="latency multiplier of those requests")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens per second (0 = instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 500 responses")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of 429 responses")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    server = MockServer(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                        tail_rate=args.tail_rate, tail_factor=args.tail_factor,
+                        token_rate=args.token_rate, error_rate=args.error_rate,
+                        rate_limit=args.rate_limit, retry_after=args.retry_after, seed=args.seed)
+    print(f"Mock Cloudflare AI listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
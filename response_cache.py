@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# On-disk cache location; set CLOUDFLARE_CACHE=0 to disable caching entirely
+CACHE_PATH = os.getenv("CLOUDFLARE_CACHE", "response_cache.sqlite3")
+
+
+def cache_key(model, messages, **options):
+    """
+    Content address for a chat request.
+
+    The key hashes the model, every message (system prompt included) and any
+    extra request options, so editing a prompt in SYSTEM_PROMPTS simply stops
+    matching the old entries.
+    """
+    payload = json.dumps({"model": model, "messages": messages, "options": options},
+                         ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two tier cache for chat completion responses.
+
+    An in-memory LRU answers repeated requests within a session; a SQLite
+    file keeps entries across restarts and is trimmed by age (ttl) and total
+    size (max_bytes). Hit/miss counters are kept per tier.
+    """
+
+    def __init__(self, path=None, max_entries=512, ttl=30 * 24 * 3600, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.db = None
+        self._puts_since_trim = 0
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.db.commit()
+            self.trim()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+            if self.db is not None:
+                now = time.time()
+                row = self.db.execute(
+                    "SELECT value, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row and (not self.ttl or now - row[1] <= self.ttl):
+                    self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    self.db.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.stats["disk_hits"] += 1
+                    return value
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        """Store a response in both tiers."""
+        with self.lock:
+            self._remember(key, value)
+            self.stats["stores"] += 1
+            if self.db is None:
+                return
+            now = time.time()
+            text = json.dumps(value, ensure_ascii=False)
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, text, len(text.encode("utf-8")), now, now)
+            )
+            self.db.commit()
+            self._puts_since_trim += 1
+            if self._puts_since_trim >= 100:
+                self._trim_locked()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def trim(self):
+        """Drop expired entries and the least recently used ones beyond max_bytes."""
+        with self.lock:
+            self._trim_locked()
+
+    def _trim_locked(self):
+        self._puts_since_trim = 0
+        if self.db is None:
+            return
+        removed = 0
+        if self.ttl:
+            removed += self.db.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            freed = 0
+            doomed = []
+            for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                doomed.append((key,))
+                freed += size
+                if total - freed <= self.max_bytes:
+                    break
+            self.db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            removed += len(doomed)
+        self.db.commit()
+        self.stats["evictions"] += removed
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+
+    def hit_rate(self):
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+_cache_enabled = CACHE_PATH != "0"
+
+
+def get_cache():
+    """Return the process wide ResponseCache, or None when caching is disabled."""
+    global _shared_cache
+    if not _cache_enabled:
+        return None
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = ResponseCache(CACHE_PATH)
+    return _shared_cache
+
+
+def set_cache(cache):
+    """Replace the process wide cache (None disables it)."""
+    global _shared_cache, _cache_enabled
+    with _shared_cache_lock:
+        _shared_cache = cache
+        _cache_enabled = cache is not None
@@ -0,0 +1,197 @@
+"""
+Per-agent model routing and hedged requests for the agent chain.
+
+Each agent can have its own model (e.g. a small, fast one for extraction
+and legal review). With hedging on, a call that has not answered by its
+model's p90 latency gets a second request, to the same model or the agent's
+hedge model, and the first valid answer wins; the other request finishes in
+the background and is ignored. The deadline comes from the client's
+cf_request_seconds metrics, so cache hits do not pull it down.
+
+    AGENT_MODELS="agent_2=@cf/meta/llama-3.1-8b-instruct,agent_3=@cf/meta/llama-3.1-8b-instruct"
+    CLOUDFLARE_HEDGE=1 HEDGE_MODELS="agent_1=@cf/meta/llama-3.1-8b-instruct"
+"""
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import metrics
+
+
+# Per-agent model ("agent=model,..."); agents not listed use the caller's model (CLOUDFLARE_MODEL)
+AGENT_MODELS = os.getenv("AGENT_MODELS", "")
+# "1" sends a second request when the first passes its model's latency deadline
+HEDGE_REQUESTS = os.getenv("CLOUDFLARE_HEDGE", "0") == "1"
+# Model of that second request per agent (same syntax); default the primary's model
+HEDGE_MODELS = os.getenv("HEDGE_MODELS", "")
+
+HEDGE_PERCENTILE = 0.9
+# Calls a model needs on record before its deadline is trusted; no hedging until then
+HEDGE_MIN_SAMPLES = 20
+# Hedged calls in flight at once (each uses two threads while it waits)
+HEDGE_WORKERS = 16
+
+
+def parse_agent_models(text):
+    """"agent_2=model,agent_3=model" -> {"agent_2": model, "agent_3": model}."""
+    models = {}
+    for part in text.split(","):
+        agent, sep, model = part.partition("=")
+        if sep and agent.strip() and model.strip():
+            models[agent.strip()] = model.strip()
+    return models
+
+
+def answered(response):
+    """Default validity check: no error and some content."""
+    if "error" in response:
+        return False
+    return bool((response.get("choices") or [{}])[0].get("message", {}).get("content"))
+
+
+class ModelRouter:
+    """
+    Picks the model for each agent call and hedges slow calls.
+
+    Also counts, per agent, the calls, the hedges fired and which model and
+    request (primary or hedge) answered, for report().
+    """
+
+    def __init__(self, agent_models=None, hedge=False, hedge_models=None,
+                 percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES):
+        self.agent_models = dict(agent_models or {})
+        self.hedge = hedge
+        self.hedge_models = dict(hedge_models or {})
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.pool = None
+        self.stats = {}
+
+    def model_for(self, agent_key, default):
+        return self.agent_models.get(agent_key, default)
+
+    def hedge_model_for(self, agent_key, model):
+        return self.hedge_models.get(agent_key, model)
+
+    def deadline(self, model):
+        """Seconds after which a call to `model` is hedged (None: not enough data yet)."""
+        registry = metrics.registry
+        if registry.sample_count("cf_request_seconds", phase="total", model=model) < self.min_samples:
+            return None
+        return registry.percentile("cf_request_seconds", self.percentile, phase="total", model=model)
+
+    def _record(self, agent_key, model, role, hedged):
+        metrics.registry.inc("cf_route_wins_total", agent=agent_key, model=model, role=role)
+        with self.lock:
+            stats = self.stats.setdefault(agent_key, {"calls": 0, "hedged": 0, "wins": {}})
+            stats["calls"] += 1
+            stats["hedged"] += hedged
+            key = f"{role}:{model}"
+            stats["wins"][key] = stats["wins"].get(key, 0) + 1
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS * 2, thread_name_prefix="hedge")
+            return self.pool
+
+    def call(self, agent_key, default_model, send, valid=answered):
+        """
+        Send one agent request along its route.
+
+        Args:
+            agent_key (str): The agent, e.g. "agent_1".
+            default_model (str): Model used when the agent has no route of its own.
+            send (callable): send(model, hedge) -> response dict. `hedge` is True for the
+                second request, which must not be coalesced with the first.
+            valid (callable): valid(response) -> bool. An invalid answer only wins if
+                the other request does not produce a valid one either.
+
+        Returns:
+            dict: The winning response.
+        """
+        model = self.model_for(agent_key, default_model)
+        deadline = self.deadline(model) if self.hedge else None
+        if deadline is None:
+            response = send(model, False)
+            self._record(agent_key, model, "primary", False)
+            return response
+
+        pool = self._get_pool()
+        primary = pool.submit(send, model, False)
+        try:
+            response = primary.result(timeout=deadline)
+        except FutureTimeoutError:
+            pass
+        else:
+            self._record(agent_key, model, "primary", False)
+            return response
+
+        hedge_model = self.hedge_model_for(agent_key, model)
+        metrics.registry.inc("cf_hedged_total", agent=agent_key, model=hedge_model)
+        pending = {primary: ("primary", model), pool.submit(send, hedge_model, True): ("hedge", hedge_model)}
+        fallback = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                role, used = pending.pop(future)
+                response = future.result()
+                if valid(response):
+                    self._record(agent_key, used, role, True)
+                    return response
+                if fallback is None or role == "primary":
+                    fallback = (role, used, response)
+        role, used, response = fallback
+        self._record(agent_key, used, role, True)
+        return response
+
+    def report(self):
+        """
+        Routing and usage summary.
+
+        Returns:
+            dict: {"hedge": bool, "agents": {agent: {"calls", "hedged", "hedge_rate",
+            "hedge_win_rate", "wins": {"primary:model" / "hedge:model": n}}},
+            "models": {model: {"requests", "tokens", "cost_usd"}}}
+        """
+        registry = metrics.registry
+        with self.lock:
+            agents = {agent: {"calls": stats["calls"], "hedged": stats["hedged"], "wins": dict(stats["wins"])}
+                      for agent, stats in self.stats.items()}
+        models = set()
+        for stats in agents.values():
+            hedge_wins = sum(n for key, n in stats["wins"].items() if key.startswith("hedge:"))
+            stats["hedge_rate"] = round(stats["hedged"] / stats["calls"], 4) if stats["calls"] else None
+            stats["hedge_win_rate"] = round(hedge_wins / stats["hedged"], 4) if stats["hedged"] else None
+            models.update(key.split(":", 1)[1] for key in stats["wins"])
+        models.update(self.agent_models.values())
+        models.update(self.hedge_models.values())
+        return {
+            "hedge": self.hedge,
+            "agents": agents,
+            "models": {model: {"requests": registry.counter("cf_requests_total", model=model),
+                               "tokens": registry.counter("cf_tokens_total", model=model),
+                               "cost_usd": round(registry.counter("cf_cost_usd_total", model=model), 6)}
+                       for model in sorted(models)},
+        }
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+
+
+_router = ModelRouter(parse_agent_models(AGENT_MODELS), HEDGE_REQUESTS, parse_agent_models(HEDGE_MODELS))
+
+
+def get_router():
+    """The ModelRouter used by the agents."""
+    return _router
+
+
+def set_router(router):
+    """Replace the agents' router (e.g. with other routes or hedging in a benchmark)."""
+    global _router
+    _router = router
+    return _router
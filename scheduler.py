@@ -0,0 +1,248 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+
+# Workers AI limits are per account; defaults follow the documented 300 requests/minute
+# for text generation. CLOUDFLARE_TPM=0 leaves the token budget unlimited.
+REQUESTS_PER_MINUTE = float(os.getenv("CLOUDFLARE_RPM", "300") or 0)
+TOKENS_PER_MINUTE = float(os.getenv("CLOUDFLARE_TPM", "0") or 0)
+
+# Seconds of budget that may be spent in one burst
+BURST_SECONDS = 10.0
+
+# Priority classes: lower runs first
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+# Pause applied on a 429 that carries no Retry-After
+DEFAULT_THROTTLE_SECONDS = 1.0
+
+
+def estimate_tokens(messages):
+    """Rough prompt size: about 1 token per CJK character or 4 other characters, plus framing."""
+    total = 0
+    for message in messages:
+        text = str(message.get("content", ""))
+        cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+        total += cjk + (len(text) - cjk + 3) // 4 + 4
+    return total
+
+
+class TokenBucket:
+    """Refills at `rate` units per second up to `capacity`; rate 0 means unlimited."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` units are available (0 if they are now)."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # an oversized request waits for a full bucket, not forever
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount, now):
+        if self.rate:
+            self._refill(now)
+            self.level -= min(amount, self.capacity)
+
+    def give(self, amount):
+        """Return unused units (e.g. the part of max_tokens a reply did not use)."""
+        if self.rate:
+            self.level = min(self.capacity, self.level + amount)
+
+    def drain(self, now):
+        if self.rate:
+            self._refill(now)
+            self.level = min(self.level, 0.0)
+
+
+class RequestScheduler:
+    """
+    Admission control for one Cloudflare account.
+
+    A request may start once both budgets allow it: one unit from the
+    request bucket and its estimated tokens (prompt + max_tokens) from the
+    token bucket. Waiting requests are admitted strictly by (priority,
+    arrival), so an interactive call overtakes queued batch work. A 429
+    pauses the whole account for its Retry-After instead of letting every
+    thread find out separately.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 burst_seconds=BURST_SECONDS):
+        request_rate = requests_per_minute / 60.0
+        token_rate = tokens_per_minute / 60.0
+        self.requests = TokenBucket(request_rate, max(1.0, request_rate * burst_seconds))
+        self.tokens = TokenBucket(token_rate, max(1.0, token_rate * burst_seconds))
+        self.cond = threading.Condition()
+        self.waiting = []  # heap of (priority, sequence)
+        self.sequence = itertools.count()
+        self.paused_until = 0.0
+
+    def acquire(self, tokens, priority=INTERACTIVE):
+        """Block until a request of `tokens` estimated tokens may be sent."""
+        start = time.monotonic()
+        with self.cond:
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None  # not our turn: sleep until someone ahead is admitted
+                    if self.waiting[0] == entry:
+                        wait = max(self.paused_until - now,
+                                   self.requests.wait_time(1, now),
+                                   self.tokens.wait_time(tokens, now))
+                        if wait <= 0:
+                            self.requests.take(1, now)
+                            self.tokens.take(tokens, now)
+                            break
+                    self.cond.wait(wait)
+            finally:
+                if self.waiting and self.waiting[0] == entry:
+                    heapq.heappop(self.waiting)
+                else:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                self.cond.notify_all()
+        metrics.registry.observe("scheduler_wait_seconds", time.monotonic() - start,
+                                 priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+    def refund(self, tokens):
+        """Give back estimated tokens that were not used."""
+        if tokens > 0:
+            with self.cond:
+                self.tokens.give(tokens)
+                self.cond.notify_all()
+
+    def throttled(self, retry_after=None):
+        """Record a 429: pause admissions for `retry_after` seconds and drop any saved-up burst."""
+        now = time.monotonic()
+        pause = DEFAULT_THROTTLE_SECONDS if retry_after is None else retry_after
+        with self.cond:
+            self.paused_until = max(self.paused_until, now + pause)
+            self.requests.drain(now)
+            self.cond.notify_all()
+        metrics.registry.inc("scheduler_throttled_total")
+
+    def admission(self, messages, max_tokens, priority=None):
+        """An Admission for one request (priority None means the calling thread's class)."""
+        return Admission(self, estimate_tokens(messages) + max_tokens,
+                         current_priority() if priority is None else priority)
+
+
+class Admission:
+    """
+    One request's pass through a RequestScheduler.
+
+    The HTTP client calls wait() before every attempt (a retry is another
+    request as far as the account limit is concerned), throttled() on a 429
+    and settle() with the reply's usage.
+    """
+
+    def __init__(self, scheduler, tokens, priority):
+        self.scheduler = scheduler
+        self.tokens = tokens
+        self.priority = priority
+
+    def wait(self):
+        self.scheduler.acquire(self.tokens, self.priority)
+
+    def throttled(self, retry_after=None):
+        self.scheduler.throttled(retry_after)
+
+    def settle(self, usage):
+        if isinstance(usage, dict) and usage.get("total_tokens"):
+            self.scheduler.refund(self.tokens - usage["total_tokens"])
+
+
+class RequestCoalescer:
+    """
+    Collapses identical concurrent calls into one.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for and share its result (or exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def run(self, key, func):
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            metrics.registry.inc("cf_coalesced_total")
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"]
+        try:
+            flight["result"] = func()
+        except BaseException as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight["done"].set()
+        return flight["result"]
+
+
+_local = threading.local()
+
+
+def current_priority():
+    """Priority class of the calling thread (INTERACTIVE unless set with priority_class)."""
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+@contextmanager
+def priority_class(priority):
+    """Run the enclosed API calls (on this thread) in `priority`, e.g. BATCH for batch.py."""
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+coalescer = RequestCoalescer()
+
+
+def get_scheduler(account_id):
+    """The shared scheduler for `account_id`, created with the configured limits on first use."""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(account_id)
+        if scheduler is None:
+            scheduler = _schedulers[account_id] = RequestScheduler()
+        return scheduler
+
+
+def set_scheduler(account_id, scheduler):
+    """Replace the scheduler for `account_id` (e.g. with different limits in a benchmark)."""
+    with _schedulers_lock:
+        _schedulers[account_id] = scheduler
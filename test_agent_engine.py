@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+
+from agent_engine import AgentEngine
+
+
+class AgentEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = AgentEngine(2)
+
+    def tearDown(self):
+        self.engine.shutdown()
+
+    def wait_for(self, kinds, timeout=5):
+        results = []
+        deadline = time.monotonic() + timeout
+        while len(results) < len(kinds) and time.monotonic() < deadline:
+            results.extend(self.engine.drain())
+            time.sleep(0.01)
+        self.assertEqual(sorted(kind for kind, *_ in results), sorted(kinds))
+        return results
+
+    def test_cancelled_jobs_keep_their_place_until_they_return(self):
+        lock = threading.Lock()
+        running = [0, 0]  # now, peak
+
+        def job(context):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            # Notices the cancel a little late, like a request being aborted
+            context.cancelled.wait()
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            context.check()
+
+        for _ in range(10):
+            self.engine.submit(1, job)
+        self.engine.cancel(1)
+        self.wait_for(["cancelled"] * 10)
+        self.assertLessEqual(running[1], 2)
+
+    def test_cancel_runs_the_abort_callbacks(self):
+        aborted = threading.Event()
+
+        def job(context):
+            context.on_cancel(aborted.set)
+            aborted.wait(5)
+            context.check()
+
+        self.engine.submit(1, job)
+        time.sleep(0.05)
+        self.engine.cancel(1)
+        self.wait_for(["cancelled"])
+        self.assertTrue(aborted.is_set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+from unittest import mock
+
+import requests
+
+import agents
+import cloudflare_client
+from cloudflare_client import DEFAULT_MAX_TOKENS
+
+
+def reply(content, finish_reason="stop"):
+    return {"choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}]}
+
+
+class ChatRetryTest(unittest.TestCase):
+    def setUp(self):
+        agents._no_json_mode.discard("m")
+
+    def tearDown(self):
+        agents._no_json_mode.discard("m")
+
+    def test_json_mode_rejected_then_truncated(self):
+        responses = [
+            {"error": "400 Client Error", "status": 400},
+            reply('{"明细": [', finish_reason="length"),
+            reply('{"明细": []}'),
+        ]
+        with mock.patch.object(agents, "cloudflare_chat_completion", side_effect=responses) as send:
+            response = agents.chat("t", "a", "m", [{"role": "user", "content": "x"}], max_tokens=256,
+                                   response_format={"type": "json_object"})
+        self.assertEqual(response["choices"][0]["message"]["content"], '{"明细": []}')
+        formats = [call.kwargs["response_format"] for call in send.call_args_list]
+        budgets = [call.kwargs["max_tokens"] for call in send.call_args_list]
+        self.assertEqual(formats, [{"type": "json_object"}, None, None])
+        self.assertEqual(budgets, [256, 256, DEFAULT_MAX_TOKENS])
+        self.assertIn("m", agents._no_json_mode)
+
+    def test_every_attempt_gets_the_limiter(self):
+        limiter = mock.Mock()
+        responses = [reply("cut", finish_reason="length"), reply("full")]
+        with mock.patch.object(agents, "cloudflare_chat_completion", side_effect=responses) as send:
+            with agents.request_limiter(limiter):
+                agents.chat("t", "a", "m", [{"role": "user", "content": "x"}], max_tokens=256)
+        self.assertEqual([call.kwargs["limiter"] for call in send.call_args_list], [limiter, limiter])
+        self.assertIsNone(agents.current_limiter())
+
+    def test_full_budget_reply_is_not_repeated(self):
+        with mock.patch.object(agents, "cloudflare_chat_completion",
+                               return_value=reply("cut", finish_reason="length")) as send:
+            agents.chat("t", "a", "m", [{"role": "user", "content": "x"}])
+        self.assertEqual(send.call_count, 1)
+
+
+class StreamChatRetryTest(unittest.TestCase):
+    def setUp(self):
+        agents._no_json_mode.discard("m")
+
+    def tearDown(self):
+        agents._no_json_mode.discard("m")
+
+    def test_json_mode_rejected_then_truncated(self):
+        calls = []
+        restarts = []
+
+        def stream(*args, max_tokens, response_format, outcome, **kwargs):
+            calls.append((response_format, max_tokens))
+            if len(calls) == 1:
+                raise requests.exceptions.HTTPError(response=mock.Mock(status_code=400))
+            yield "cut" if len(calls) == 2 else "full"
+            outcome["finish_reason"] = "length" if len(calls) == 2 else "stop"
+
+        with mock.patch.object(agents, "stream_cloudflare_chat_completion", side_effect=stream):
+            parts = list(agents.stream_chat("t", "a", "m", [{"role": "user", "content": "x"}], max_tokens=256,
+                                            response_format={"type": "json_object"},
+                                            restart=lambda: restarts.append(True)))
+        self.assertEqual(parts, ["cut", "full"])
+        self.assertEqual(restarts, [True])
+        self.assertEqual(calls, [({"type": "json_object"}, 256), (None, 256), (None, DEFAULT_MAX_TOKENS)])
+
+
+class CloudflareClientTest(unittest.TestCase):
+    def test_http_retries_wait_for_the_limiter(self):
+        client = cloudflare_client.CloudflareClient(backoff_base=0)
+        busy, ok = mock.Mock(status_code=503, headers={}), mock.Mock(status_code=200, headers={})
+        limiter = mock.Mock()
+        with mock.patch.object(client.session, "post", side_effect=[busy, ok]):
+            self.assertIs(client.post("http://x", {}, {}, limiter=limiter), ok)
+        self.assertEqual(limiter.wait.call_count, 2)
+        client.close()
+
+    def test_client_error_closes_the_response(self):
+        client = cloudflare_client.CloudflareClient()
+        rejected = mock.Mock(status_code=400, headers={})
+        rejected.raise_for_status.side_effect = requests.exceptions.HTTPError(response=rejected)
+        with mock.patch.object(client.session, "post", return_value=rejected):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                client.post("http://x", {}, {}, stream=True)
+        rejected.close.assert_called_once()
+        client.close()
+
+    def test_cache_hit_takes_no_token(self):
+        cache = mock.Mock()
+        cache.get.return_value = reply("cached")
+        limiter = mock.Mock()
+        with mock.patch.object(cloudflare_client, "get_cache", return_value=cache):
+            response = cloudflare_client.cloudflare_chat_completion("t", "a", "m", [{"role": "user", "content": "x"}],
+                                                                    limiter=limiter)
+        self.assertEqual(response, reply("cached"))
+        limiter.wait.assert_not_called()
+
+
+class ReplyCacheTest(unittest.TestCase):
+    def ask(self, content):
+        cache = mock.Mock()
+        cache.get.return_value = None
+        client = mock.Mock()
+        client.chat_completion.return_value = reply(content)
+        options = agents.PROMPT_PROFILES["full"].request_options("agent_1", "x")
+        with mock.patch.object(cloudflare_client, "get_cache", return_value=cache), \
+                mock.patch.object(cloudflare_client, "get_client", return_value=client):
+            agents.chat("t", "a", "m", [{"role": "user", "content": "x"}], **options)
+        return cache.put.call_count
+
+    def test_voucher_reply_is_cached(self):
+        voucher = ('{"明细": [{"编号": "1", "科目": "银行存款", "摘要": "x", "借方金额": "1", "贷方金额": null}], '
+                   '"合计": {"借方合计": 1, "贷方合计": 0}}')
+        self.assertEqual(self.ask(voucher), 1)
+
+    def test_reply_without_voucher_is_not_cached(self):
+        self.assertEqual(self.ask("抱歉，我无法生成凭证。"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from duplicate_index import DuplicateIndex, apply_template, line_date
+
+
+class DuplicateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = DuplicateIndex()
+        self.index.add_input("2025-01-05 支付给华润置地有限公司1月房租 20000")
+
+    def test_same_line_is_flagged(self):
+        matches = self.index.check("2025-01-05 支付给华润置地有限公司1月房租 20000")
+        self.assertEqual(matches[0]["reasons"][0], "text")
+
+    def test_same_day_counterparty_and_amount_is_flagged(self):
+        self.assertTrue(self.index.check("2025-01-05 华润置地有限公司 房租 20,000.00"))
+
+    def test_recurring_payment_on_another_date_is_not_flagged(self):
+        self.assertEqual(self.index.check("2025-02-05 支付给华润置地有限公司2月房租 20000"), [])
+        self.assertEqual(self.index.check("2025-03-05 支付给华润置地有限公司3月房租 20000"), [])
+
+
+class LineDateTest(unittest.TestCase):
+    def test_single_date(self):
+        self.assertEqual(line_date("2025/3/1 维力贸易有限公司 转账货款 52100元"), "2025-03-01")
+        self.assertEqual(line_date("20250301 收到货款 100"), "2025-03-01")
+
+    def test_no_or_several_dates(self):
+        self.assertIsNone(line_date("提取备用金 3000"))
+        self.assertIsNone(line_date("2025-03-01 至 2025-03-31 利息 12.5"))
+
+    def test_template_takes_the_line_date(self):
+        voucher = {"明细": [{"编号": "1", "科目": "银行存款", "摘要": "x", "借方金额": "100", "贷方金额": None},
+                          {"编号": "1", "科目": "应收账款", "摘要": "x", "借方金额": None, "贷方金额": "100"}]}
+        self.assertEqual(apply_template(voucher, "2025-04-02 收到货款 100")["日期"], "2025-04-02")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+from voucher_archive import MAGIC, RECORD, ArchiveError, VoucherArchive
+
+
+def voucher(summary):
+    return {"明细": [{"编号": "1", "科目": "银行存款", "摘要": summary, "借方金额": "100", "贷方金额": None}]}
+
+
+class VoucherArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "vouchers.archive")
+        self.archive = VoucherArchive(self.path, durable=False)
+
+    def tearDown(self):
+        if self.archive is not None:
+            self.archive.close()
+        self.tmp.cleanup()
+
+    def reopen(self, data=None):
+        self.archive.close()
+        if data is not None:
+            with open(self.path, "wb") as f:
+                f.write(data)
+        self.archive = VoucherArchive(self.path, durable=False)
+        return self.archive
+
+    def test_put_supersedes_and_survives_reopen(self):
+        self.archive.put(1, voucher("a"), mtime=10.0)
+        self.archive.put(1, voucher("b"))
+        self.archive.put(2, voucher("c"))
+        self.archive.remove(2)
+        archive = self.reopen()
+        self.assertEqual(archive.numbers(), [1])
+        self.assertEqual(archive.get(1), voucher("b"))
+        self.assertIsNone(archive.mtime(1))
+
+    def test_append_takes_the_next_number(self):
+        self.archive.put(7, voucher("a"))
+        self.assertEqual(self.archive.append(voucher("b")), 8)
+        self.assertEqual(self.reopen().append(voucher("c")), 9)
+
+    def test_torn_tail_is_cut_off(self):
+        for summary in "abc":
+            self.archive.append(voucher(summary))
+        with open(self.path, "rb") as f:
+            data = f.read()
+        archive = self.reopen(data[:-5])
+        self.assertEqual(archive.numbers(), [1, 2])
+        self.assertEqual(archive.append(voucher("d")), 3)
+        self.assertEqual(self.reopen().get(3), voucher("d"))
+
+    def test_damaged_record_in_the_middle_raises(self):
+        for summary in "abc":
+            self.archive.append(voucher(summary))
+        with open(self.path, "rb") as f:
+            data = bytearray(f.read())
+        # Corrupt the first record's length so it reaches past the end of the file
+        RECORD.pack_into(data, len(MAGIC), 1 << 20, *RECORD.unpack_from(data, len(MAGIC))[1:])
+        self.archive.close()
+        self.archive = None
+        with open(self.path, "wb") as f:
+            f.write(data)
+        with self.assertRaises(ArchiveError):
+            VoucherArchive(self.path)
+        self.assertEqual(os.path.getsize(self.path), len(data))  # nothing truncated
+
+    def test_compact_keeps_only_current_versions(self):
+        for version in range(3):
+            self.archive.put_many([(number, voucher(f"{number}-{version}"), None) for number in range(1, 4)])
+        self.archive.remove(3)
+        before = os.path.getsize(self.path)
+        self.archive.compact()
+        self.assertLess(os.path.getsize(self.path), before)
+        archive = self.reopen()
+        self.assertEqual(archive.numbers(), [1, 2])
+        self.assertEqual(archive.get(2), voucher("2-2"))
+        self.assertEqual(archive.stats()["dead_bytes"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from decimal import Decimal
+
+from voucher_check import AmountError, correction_message, to_fen, verify_voucher
+from voucher_extract import VoucherFormatError, extract_voucher
+
+
+def voucher(*rows):
+    return {"明细": [{"科目": account, "借方金额": debit, "贷方金额": credit} for account, debit, credit in rows]}
+
+
+class VatCheckTest(unittest.TestCase):
+    def test_sale_with_13_percent_vat(self):
+        result = verify_voucher(voucher(
+            ("银行存款", "113", None),
+            ("主营业务收入", None, "100"),
+            ("应交税费-应交增值税(销项税额)", None, "13"),
+        ))
+        self.assertTrue(result["balanced"])
+        self.assertTrue(result["vat_ok"])
+
+    def test_wrong_vat_is_reported(self):
+        result = verify_voucher(voucher(
+            ("库存商品", "100", None),
+            ("应交税费-应交增值税(进项税额)", "17", None),
+            ("银行存款", None, "117"),
+        ))
+        self.assertTrue(result["balanced"])
+        self.assertFalse(result["vat_ok"])
+        self.assertEqual(result["vat_expected"], Decimal("13"))
+        self.assertIn("增值税", correction_message(result))
+
+    def test_lines_outside_the_rate_are_not_checked(self):
+        # Paying last month's VAT with the city tax, a 9% sale, and a sale with its cost transfer
+        for rows in (
+            [("应交税费-未交增值税", "5000", None), ("应交税费-应交城市维护建设税", "350", None), ("银行存款", None, "5350")],
+            [("银行存款", "109", None), ("主营业务收入", None, "100"), ("应交税费-应交增值税(销项税额)", None, "9")],
+            [("银行存款", "113", None), ("主营业务收入", None, "100"), ("应交税费-应交增值税(销项税额)", None, "13"),
+             ("主营业务成本", "80", None), ("库存商品", None, "80")],
+        ):
+            self.assertTrue(verify_voucher(voucher(*rows))["vat_ok"], rows)
+
+    def test_no_vat_lines(self):
+        result = verify_voucher(voucher(("银行存款", "50", None), ("应收账款", None, "50")))
+        self.assertTrue(result["vat_ok"])
+        self.assertIsNone(result["vat_expected"])
+
+
+class AmountTest(unittest.TestCase):
+    def test_non_finite_amounts_are_rejected(self):
+        for value in ("NaN", "Infinity", "-inf", float("nan"), "1e999"):
+            with self.assertRaises(AmountError):
+                to_fen(value)
+        with self.assertRaises(VoucherFormatError):
+            extract_voucher('{"明细": [{"编号": "1", "科目": "银行存款", "摘要": "", "借方金额": "NaN", "贷方金额": null}]}')
+
+
+if __name__ == "__main__":
+    unittest.main()
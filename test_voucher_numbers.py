@@ -0,0 +1,66 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from voucher_numbers import SEQUENCE_FILE, VoucherNumberAllocator
+
+
+class VoucherNumberAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def touch(self, name):
+        open(os.path.join(self.directory, name), "w").close()
+
+    def test_first_use_starts_above_existing_files(self):
+        self.touch("3.json")
+        self.touch("notes.json")
+        allocator = VoucherNumberAllocator(self.directory)
+        self.assertEqual(allocator.save("{}"), "4.json")
+        with open(os.path.join(self.directory, SEQUENCE_FILE)) as f:
+            self.assertEqual(f.read(), "4")
+
+    def test_high_water_mark_is_not_reused(self):
+        allocator = VoucherNumberAllocator(self.directory)
+        self.assertEqual(allocator.save("{}"), "1.json")
+        self.assertEqual(allocator.save("{}"), "2.json")
+        os.remove(os.path.join(self.directory, "2.json"))
+        # A new allocator (another process) reads the mark instead of scanning
+        self.assertEqual(VoucherNumberAllocator(self.directory).save("{}"), "3.json")
+
+    def test_number_taken_meanwhile_is_skipped(self):
+        allocator = VoucherNumberAllocator(self.directory)
+        allocator.save("{}")
+        self.touch("2.json")  # written by hand or by another process
+        self.assertEqual(allocator.reserve(), 3)
+        with open(os.path.join(self.directory, "2.json")) as f:
+            self.assertEqual(f.read(), "")
+
+    def test_concurrent_saves_get_distinct_numbers(self):
+        allocators = [VoucherNumberAllocator(self.directory) for _ in range(2)]
+        names = []
+        lock = threading.Lock()
+
+        def save(allocator):
+            for _ in range(20):
+                name = allocator.save("{}")
+                with lock:
+                    names.append(name)
+
+        threads = [threading.Thread(target=save, args=(allocators[i % 2],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(names)), 80)
+        with open(os.path.join(self.directory, names[0]), encoding="utf-8") as f:
+            self.assertEqual(f.read(), "{}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,279 @@
+from array import array
+from decimal import Decimal
+
+from voucher_check import AmountError, to_fen
+
+
+PERIODS = ("month", "quarter", "year")
+
+# Period key of lines without a usable date
+UNDATED = ""
+
+
+def _amount_fen(value):
+    if not value:
+        return 0
+    try:
+        return to_fen(value)
+    except AmountError:
+        return 0
+
+
+def _day_number(date):
+    """ISO date (or date-time) string -> yyyymmdd int; 0 when missing or malformed."""
+    if not date:
+        return 0
+    digits = str(date)[:10].replace("-", "")
+    return int(digits) if len(digits) == 8 and digits.isdigit() else 0
+
+
+def facts_from_rows(rows):
+    """Ledger row dicts (编号, 科目, 借方金额, 贷方金额, 日期) -> engine fact tuples."""
+    facts = []
+    for row in rows:
+        number = str(row.get("编号", ""))
+        facts.append((int(number) if number.isdigit() else -1, str(row.get("科目") or ""), row.get("日期"),
+                      _amount_fen(row.get("借方金额")), _amount_fen(row.get("贷方金额"))))
+    return facts
+
+
+def period_key(month, period="month"):
+    """Roll a "YYYY-MM" month key up to "YYYY-MM", "YYYY-Qn" or "YYYY" (None: a single bucket)."""
+    if period is None:
+        return None
+    if month == UNDATED or period == "month":
+        return month
+    if period == "quarter":
+        return f"{month[:4]}-Q{(int(month[5:7]) - 1) // 3 + 1}"
+    if period == "year":
+        return month[:4]
+    raise ValueError(f"unknown period {period!r}, expected one of {PERIODS}")
+
+
+def account_at_level(account, level=None):
+    """The first `level` parts of a "一级-二级-..." account name (None: the full name)."""
+    if level is None:
+        return account
+    return "-".join(account.split("-")[:level])
+
+
+class TrialBalanceEngine:
+    """
+    Per-科目 and per-period aggregation over all 明细 lines.
+
+    Lines are kept column-wise in stdlib arrays (account id, month id,
+    yyyymmdd date, debit fen, credit fen, voucher) with accounts and months
+    dictionary encoded. Alongside, debit/credit totals are maintained per
+    (account, month) cell, so account/period queries and the trial balance
+    only touch the cells, not the lines. Replacing or removing a voucher
+    tombstones its old lines and adjusts the cells; the columns are compacted
+    once most of them are dead. Arbitrary date ranges scan the columns.
+    """
+
+    def __init__(self):
+        self.accounts = []          # account id -> name
+        self.account_ids = {}
+        self.months = []            # month id -> "YYYY-MM" (or UNDATED)
+        self.month_ids = {}
+        self._clear_columns()
+
+    def _clear_columns(self):
+        self.account = array("i")
+        self.month = array("i")
+        self.day = array("i")
+        self.debit = array("q")
+        self.credit = array("q")
+        self.voucher = array("q")
+        self.alive = array("b")
+        self.lines_of = {}          # voucher number -> [line index]
+        self.cells = {}             # (account id, month id) -> [debit fen, credit fen]
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.alive) - self.dead
+
+    def _account_id(self, name):
+        index = self.account_ids.get(name)
+        if index is None:
+            index = self.account_ids[name] = len(self.accounts)
+            self.accounts.append(name)
+        return index
+
+    def _month_id(self, day):
+        month = f"{day // 10000:04d}-{day // 100 % 100:02d}" if day else UNDATED
+        index = self.month_ids.get(month)
+        if index is None:
+            index = self.month_ids[month] = len(self.months)
+            self.months.append(month)
+        return index
+
+    # --- updates ---
+    def load(self, facts):
+        """Replace everything with `facts`: (voucher number, 科目, date, debit fen, credit fen) tuples."""
+        self._clear_columns()
+        self._append(facts)
+
+    def _append(self, facts):
+        cells = self.cells
+        dates = {}  # dates repeat a lot: parse each once
+        for number, account_name, date, debit, credit in facts:
+            parsed = dates.get(date)
+            if parsed is None:
+                day = _day_number(date)
+                parsed = dates[date] = (day, self._month_id(day))
+            day, month = parsed
+            account = self._account_id(account_name or "")
+            self.lines_of.setdefault(number, []).append(len(self.alive))
+            self.account.append(account)
+            self.month.append(month)
+            self.day.append(day)
+            self.debit.append(debit)
+            self.credit.append(credit)
+            self.voucher.append(number)
+            self.alive.append(1)
+            cell = cells.get((account, month))
+            if cell is None:
+                cells[(account, month)] = [debit, credit]
+            else:
+                cell[0] += debit
+                cell[1] += credit
+
+    def remove_voucher(self, number):
+        """Drop every line of voucher `number`. Returns how many were removed."""
+        lines = self.lines_of.pop(number, ())
+        for index in lines:
+            cell = self.cells[(self.account[index], self.month[index])]
+            cell[0] -= self.debit[index]
+            cell[1] -= self.credit[index]
+            self.alive[index] = 0
+        self.dead += len(lines)
+        if self.dead > 1024 and self.dead > len(self.alive) // 2:
+            self._compact()
+        return len(lines)
+
+    def replace_voucher(self, number, facts):
+        """Replace the lines of voucher `number` with `facts` (None or [] removes it)."""
+        self.remove_voucher(number)
+        if facts:
+            self._append(facts)
+
+    def _compact(self):
+        keep = [index for index, alive in enumerate(self.alive) if alive]
+        columns = (self.account, self.month, self.day, self.debit, self.credit, self.voucher)
+        packed = [array(column.typecode, (column[i] for i in keep)) for column in columns]
+        self.account, self.month, self.day, self.debit, self.credit, self.voucher = packed
+        self.alive = array("b", bytes([1]) * len(keep))
+        self.lines_of = {}
+        for index, number in enumerate(self.voucher):
+            self.lines_of.setdefault(number, []).append(index)
+        self.dead = 0
+
+    # --- queries ---
+    def _month_range(self, start, end):
+        """
+        Month ids within ["YYYY-MM", "YYYY-MM"] (either bound optional). Undated
+        lines sort before every month, so they count whenever `start` is open.
+        """
+        if start is None and end is None:
+            return None
+        return {index for index, month in enumerate(self.months)
+                if (start is None or month >= start) and (end is None or month <= end)}
+
+    def group_by(self, period="month", level=None, start=None, end=None):
+        """
+        Debit/credit totals per (account, period).
+
+        Args:
+            period (str): "month", "quarter", "year", or None for no period split.
+            level (int): Roll sub-accounts up to this many name parts (1 = 一级科目); None keeps them.
+            start (str), end (str): Inclusive bounds, "YYYY-MM" (answered from the cells) or
+                "YYYY-MM-DD" (answered by scanning the lines).
+
+        Returns:
+            dict: {(account, period key): (debit fen, credit fen)}; the period key is
+            None when `period` is None.
+        """
+        result = {}
+        if (start is None or len(start) == 7) and (end is None or len(end) == 7):
+            months = self._month_range(start, end)
+            for (account, month), (debit, credit) in self.cells.items():
+                if (months is not None and month not in months) or (not debit and not credit):
+                    continue
+                key = (account_at_level(self.accounts[account], level), period_key(self.months[month], period))
+                total = result.get(key)
+                result[key] = (debit, credit) if total is None else (total[0] + debit, total[1] + credit)
+            return result
+        low = _day_number(start) if start else 0
+        high = _day_number(end) if end else 99999999
+        if start and len(start) == 7:
+            low = int(start.replace("-", "")) * 100
+        if end and len(end) == 7:
+            high = int(end.replace("-", "")) * 100 + 31
+        sums = {}
+        for index, day in enumerate(self.day):
+            if low <= day <= high and self.alive[index]:
+                cell = (self.account[index], self.month[index])
+                total = sums.get(cell)
+                if total is None:
+                    sums[cell] = [self.debit[index], self.credit[index]]
+                else:
+                    total[0] += self.debit[index]
+                    total[1] += self.credit[index]
+        for (account, month), (debit, credit) in sums.items():
+            key = (account_at_level(self.accounts[account], level), period_key(self.months[month], period))
+            total = result.get(key, (0, 0))
+            result[key] = (total[0] + debit, total[1] + credit)
+        return result
+
+    def account_totals(self, level=None, start=None, end=None):
+        """{account: (debit fen, credit fen)} over the given range."""
+        return {account: totals for (account, _), totals
+                in self.group_by(None, level, start, end).items()}
+
+    def trial_balance(self, start=None, end=None, level=1):
+        """
+        Trial balance (试算平衡表) for the months `start`..`end` ("YYYY-MM", inclusive).
+
+        Opening balances come from every line before `start`, undated lines
+        included; balances are debit minus credit (negative = credit balance).
+
+        Returns:
+            dict: {"rows": [{"科目", "期初余额", "借方发生额", "贷方发生额", "期末余额"} ...]
+            sorted by account, all amounts Decimal yuan; "借方合计"/"贷方合计" of the
+            period; "平衡" whether they agree.}
+        """
+        opening = {}
+        if start is not None:
+            for (account, month), (debit, credit) in self.cells.items():
+                if self.months[month] < start:
+                    name = account_at_level(self.accounts[account], level)
+                    opening[name] = opening.get(name, 0) + debit - credit
+        movement = self.account_totals(level, start, end)
+        rows = []
+        total_debit = total_credit = 0
+        for name in sorted(set(opening) | set(movement)):
+            debit, credit = movement.get(name, (0, 0))
+            before = opening.get(name, 0)
+            if not (before or debit or credit):
+                continue
+            total_debit += debit
+            total_credit += credit
+            rows.append({
+                "科目": name,
+                "期初余额": Decimal(before) / 100,
+                "借方发生额": Decimal(debit) / 100,
+                "贷方发生额": Decimal(credit) / 100,
+                "期末余额": Decimal(before + debit - credit) / 100,
+            })
+        return {
+            "rows": rows,
+            "借方合计": Decimal(total_debit) / 100,
+            "贷方合计": Decimal(total_credit) / 100,
+            "平衡": total_debit == total_credit,
+        }
+
+    def periods(self, period="month"):
+        """Sorted period keys that have lines (undated excluded)."""
+        return sorted({period_key(self.months[month], period)
+                       for (_, month), cell in self.cells.items()
+                       if self.months[month] != UNDATED and (cell[0] or cell[1])})
@@ -0,0 +1,255 @@
+import tkinter as tk
+from tkinter import ttk
+from bisect import bisect_left
+from decimal import Decimal
+
+from voucher_check import AmountError, to_fen
+
+
+LEDGER_COLUMNS = ["编号", "科目", "摘要", "借方金额", "贷方金额"]
+
+
+def _amount_fen(value):
+    if not value:
+        return 0
+    try:
+        return to_fen(value)
+    except AmountError:
+        return 0
+
+
+def row_key(row, position):
+    """Stable identity of a ledger row: (voucher number, line), else its position."""
+    number = str(row.get("编号", ""))
+    return (int(number) if number.isdigit() else -1), number, row.get("line", position)
+
+
+def row_values(row):
+    return (
+        row.get("编号", ""),
+        row.get("科目", ""),
+        row.get("摘要", ""),
+        row.get("借方金额") if row.get("借方金额") else "",
+        row.get("贷方金额") if row.get("贷方金额") else "",
+    )
+
+
+class LedgerTableModel:
+    """
+    Sorted ledger rows plus running debit/credit totals.
+
+    Rows are identified by row_key, so a refresh is applied as a diff: only
+    added, changed or removed rows touch the model, and the totals are
+    adjusted by those rows instead of being summed again.
+    """
+
+    def __init__(self):
+        self.keys = []          # sorted row keys
+        self.rows = {}          # key -> (values, debit_fen, credit_fen)
+        self.debit_fen = 0
+        self.credit_fen = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def upsert(self, key, row):
+        """Insert or replace one row. Returns the index it lands at, or None if unchanged."""
+        values = row_values(row)
+        debit, credit = _amount_fen(row.get("借方金额")), _amount_fen(row.get("贷方金额"))
+        old = self.rows.get(key)
+        if old is not None:
+            if old == (values, debit, credit):
+                return None
+            self.debit_fen -= old[1]
+            self.credit_fen -= old[2]
+            index = bisect_left(self.keys, key)
+        else:
+            index = bisect_left(self.keys, key)
+            self.keys.insert(index, key)
+        self.rows[key] = (values, debit, credit)
+        self.debit_fen += debit
+        self.credit_fen += credit
+        return index
+
+    def remove(self, key):
+        """Remove one row. Returns the index it was at, or None if it was not there."""
+        old = self.rows.pop(key, None)
+        if old is None:
+            return None
+        index = bisect_left(self.keys, key)
+        del self.keys[index]
+        self.debit_fen -= old[1]
+        self.credit_fen -= old[2]
+        return index
+
+    def remove_voucher(self, number):
+        """Remove every line of voucher `number`. Returns how many were removed."""
+        start = bisect_left(self.keys, (number,))
+        end = bisect_left(self.keys, (number + 1,))
+        for key in self.keys[start:end]:
+            old = self.rows.pop(key)
+            self.debit_fen -= old[1]
+            self.credit_fen -= old[2]
+        del self.keys[start:end]
+        return end - start
+
+    def load(self, rows_by_key):
+        """Bulk load an empty model from {key: row} (amounts already in fen via debit_fen/credit_fen are used as is)."""
+        for key, row in rows_by_key.items():
+            if "debit_fen" in row:
+                debit, credit = row["debit_fen"], row["credit_fen"]
+            else:
+                debit, credit = _amount_fen(row.get("借方金额")), _amount_fen(row.get("贷方金额"))
+            self.rows[key] = (row_values(row), debit, credit)
+            self.debit_fen += debit
+            self.credit_fen += credit
+        self.keys = sorted(self.rows)
+
+    def values_at(self, index):
+        return self.rows[self.keys[index]][0]
+
+    def totals(self):
+        """Debit/credit totals as Decimal yuan."""
+        return Decimal(self.debit_fen) / 100, Decimal(self.credit_fen) / 100
+
+
+class VirtualTable:
+    """
+    Treeview that only materialises the rows currently on screen.
+
+    The widget holds a fixed pool of items, one per visible line; scrolling
+    rewrites their values from the backing LedgerTableModel, so memory and
+    redraw cost do not grow with the ledger. The last virtual row is the 合计
+    row, kept up to date from the model's running totals.
+    """
+
+    def __init__(self, parent, columns=LEDGER_COLUMNS, column_width=120):
+        self.model = LedgerTableModel()
+        self.offset = 0
+        self.pool = []
+        self.shown = []  # values currently in each pool item
+
+        self.frame = ttk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings", height=8)
+        for header in columns:
+            self.tree.heading(header, text=header)
+            self.tree.column(header, width=column_width, anchor=tk.CENTER)
+        self.scrollbar_y = ttk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.scrollbar_x = ttk.Scrollbar(self.frame, orient="horizontal", command=self.tree.xview)
+        self.tree.configure(xscrollcommand=self.scrollbar_x.set)
+        self.scrollbar_y.pack(side="right", fill="y")
+        self.scrollbar_x.pack(side="bottom", fill="x")
+        self.tree.pack(side="left", fill="both", expand=True)
+
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(3))
+        self.tree.bind("<Prior>", lambda event: self.scroll(-len(self.pool)))
+        self.tree.bind("<Next>", lambda event: self.scroll(len(self.pool)))
+        self.tree.bind("<Home>", lambda event: self.scroll_to(0))
+        self.tree.bind("<End>", lambda event: self.scroll_to(self.total_rows()))
+        self.resize_pool(8)
+
+    # --- data ---
+    def total_rows(self):
+        return len(self.model) + 1  # + 合计 row
+
+    def virtual_values(self, index):
+        if index < len(self.model):
+            return self.model.values_at(index)
+        total_debit, total_credit = self.model.totals()
+        return ("合计", "", "", total_debit, total_credit)
+
+    def set_rows(self, rows):
+        """Show exactly `rows`, applying only the differences to the current contents."""
+        wanted = {}
+        for position, row in enumerate(rows):
+            wanted[row_key(row, position)] = row
+        removed = [key for key in self.model.keys if key not in wanted]
+        if not self.model.keys or len(removed) > 1000:
+            # First load or mostly different data: a bulk load beats many list edits
+            self.model = LedgerTableModel()
+            self.model.load(wanted)
+        else:
+            for key in removed:
+                self.model.remove(key)
+            for key, row in wanted.items():
+                self.model.upsert(key, row)
+        self.render()
+
+    def set_model(self, model):
+        """Show a LedgerTableModel built elsewhere (e.g. on a loader thread) in place of the current one."""
+        self.model = model
+        self.render()
+
+    def upsert_rows(self, rows):
+        """Add or update `rows`, leaving all other rows alone."""
+        for position, row in enumerate(rows):
+            self.model.upsert(row_key(row, len(self.model) + position), row)
+        self.render()
+
+    def replace_voucher(self, number, rows):
+        """Replace all lines of voucher `number` with `rows` (e.g. after it was saved again)."""
+        self.model.remove_voucher(number)
+        self.upsert_rows(rows)
+
+    def remove_rows(self, keys):
+        for key in keys:
+            self.model.remove(key)
+        self.render()
+
+    def clear(self):
+        self.model = LedgerTableModel()
+        self.offset = 0
+        self.render()
+
+    # --- view ---
+    def resize_pool(self, count):
+        count = max(1, count)
+        while len(self.pool) < count:
+            self.pool.append(self.tree.insert("", "end", values=()))
+            self.shown.append(())
+        while len(self.pool) > count:
+            self.tree.delete(self.pool.pop())
+            self.shown.pop()
+        self.render()
+
+    def on_resize(self, event):
+        row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        heading = row_height + 4
+        self.resize_pool((event.height - heading) // row_height)
+
+    def render(self):
+        """Write the rows of the visible window into the item pool (changed items only)."""
+        total = self.total_rows()
+        self.offset = max(0, min(self.offset, total - len(self.pool)))
+        for slot, iid in enumerate(self.pool):
+            index = self.offset + slot
+            values = self.virtual_values(index) if index < total else ()
+            if values != self.shown[slot]:
+                self.tree.item(iid, values=values)
+                self.shown[slot] = values
+        first = self.offset / total
+        last = min(1.0, (self.offset + len(self.pool)) / total)
+        self.scrollbar_y.set(first, last)
+
+    def scroll(self, lines):
+        self.scroll_to(self.offset + lines)
+        return "break"
+
+    def scroll_to(self, offset):
+        self.offset = offset
+        self.render()
+        return "break"
+
+    def yview(self, *args):
+        """Scrollbar command: ("moveto", fraction) or ("scroll", n, "units"/"pages")."""
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * self.total_rows()))
+        elif args[0] == "scroll":
+            step = len(self.pool) if args[2] == "pages" else 1
+            self.scroll(int(args[1]) * step)
+
+    def on_mousewheel(self, event):
+        return self.scroll(-3 if event.delta > 0 else 3)
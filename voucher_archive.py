@@ -0,0 +1,359 @@
+"""
+Append-only segment archive of vouchers.
+
+One file replaces a directory of "n.json" files. Each record is a fixed
+header (payload length, CRC32, voucher number, mtime) followed by the
+voucher as compact UTF-8 JSON; an empty payload is a tombstone. The file is
+read through mmap and an in-memory offset index maps each voucher number to
+its latest record, so a voucher is found without parsing any other, and a
+scan only parses what it yields. Superseded records are dropped by
+compaction, which runs once they are most of the file.
+
+    python voucher_archive.py import vouchers/ --archive vouchers.archive
+    python voucher_archive.py export out/ --archive vouchers.archive
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from ledger_store import voucher_number
+from voucher_numbers import write_file_atomic
+
+
+ARCHIVE_PATH = os.getenv("VOUCHER_ARCHIVE", "vouchers.archive")
+
+MAGIC = b"VOUCHERSEG1\n"
+# payload length, CRC32 of the payload, voucher number, mtime (0 when unknown)
+RECORD = struct.Struct("<IIqd")
+
+# Compact once superseded records take more than this many bytes and over half the file
+COMPACT_MIN_BYTES = 1 << 20
+
+
+class ArchiveError(ValueError):
+    """Raised for a damaged archive (a bad record anywhere but at the very end)."""
+
+
+class VoucherArchive:
+    """
+    Vouchers in one append-only segment file, read through mmap.
+
+    Writes append a record and move the voucher's index entry to it, so
+    saving costs one small write. A torn record at the end (a crash while
+    appending) is cut off when the archive is opened; a damaged record with
+    intact ones after it raises ArchiveError instead.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH, durable=True):
+        self.path = path
+        self.durable = durable      # fsync after every append
+        self.lock = threading.Lock()
+        self.index = {}             # voucher number -> (record offset, mtime)
+        self.highest = 0            # highest voucher number in the file, for append()
+        self.dead_bytes = 0
+        self.map = None
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(MAGIC)
+        self.file = open(path, "r+b")
+        self._remap()
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ArchiveError(f"{path} is not a voucher archive")
+        try:
+            self._load_index()
+        except ArchiveError:
+            self.close()
+            raise
+
+    def _remap(self):
+        # The old map is not closed: a scan() in progress may still be reading it,
+        # and it is released with the last reference
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_index(self):
+        """Build the offset index from the record headers (payloads are checksummed, not parsed)."""
+        data = self.map
+        size = len(data)
+        offset = len(MAGIC)
+        while offset < size:
+            if offset + RECORD.size > size:
+                break
+            length, crc, number, mtime = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + length
+            if end > size or zlib.crc32(data[offset + RECORD.size:end]) != crc:
+                # Only the last record can be torn; an intact record after this one
+                # means a damaged header (e.g. its length) in the middle of the file
+                if end < size or self._record_follows(offset + RECORD.size):
+                    raise ArchiveError(f"{self.path}: damaged record at byte {offset}")
+                break
+            self.highest = max(self.highest, number)
+            previous = self.index.pop(number, None)
+            if previous is not None:
+                self.dead_bytes += self._record_size(previous[0])
+            if length:
+                self.index[number] = (offset, mtime)
+            else:
+                self.dead_bytes += RECORD.size  # the tombstone itself
+            offset = end
+        if offset < size:
+            # Torn append: drop the partial record so the next one starts cleanly
+            self.map.close()
+            self.map = None
+            self.file.truncate(offset)
+            self._remap()
+
+    def _record_follows(self, start):
+        """Whether an intact voucher record starts at or after byte `start`."""
+        data = self.map
+        size = len(data)
+        # Every voucher payload is a JSON object, so only headers right before a "{" can start one
+        brace = data.find(b"{", start + RECORD.size)
+        while brace != -1:
+            offset = brace - RECORD.size
+            length, crc, _, _ = RECORD.unpack_from(data, offset)
+            if length and brace + length <= size and zlib.crc32(data[brace:brace + length]) == crc:
+                return True
+            brace = data.find(b"{", brace + 1)
+        return False
+
+    def _record_size(self, offset):
+        return RECORD.size + RECORD.unpack_from(self.map, offset)[0]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, number):
+        return number in self.index
+
+    def numbers(self):
+        """Archived voucher numbers, ascending."""
+        return sorted(self.index)
+
+    def mtime(self, number):
+        """mtime stored with voucher `number` (None if it is not archived or has none)."""
+        entry = self.index.get(number)
+        return (entry[1] or None) if entry else None
+
+    def version(self, number):
+        """CRC32 of the current record of voucher `number` (None if it is not archived); changes when it is re-put."""
+        with self.lock:
+            entry = self.index.get(number)
+            return RECORD.unpack_from(self.map, entry[0])[1] if entry else None
+
+    # --- writes ---
+    def _append(self, records):
+        # Caller holds the lock; records are (number, payload bytes, mtime)
+        offset = self.file.seek(0, os.SEEK_END)
+        chunks = []
+        for number, payload, mtime in records:
+            chunks.append(RECORD.pack(len(payload), zlib.crc32(payload), number, mtime or 0.0))
+            chunks.append(payload)
+            self.highest = max(self.highest, number)
+            previous = self.index.pop(number, None)
+            if previous is not None:
+                self.dead_bytes += self._record_size(previous[0])
+            if payload:
+                self.index[number] = (offset, mtime or 0.0)
+            else:
+                self.dead_bytes += RECORD.size
+            offset += RECORD.size + len(payload)
+        self.file.write(b"".join(chunks))
+        self.file.flush()
+        if self.durable:
+            os.fsync(self.file.fileno())
+        self._remap()
+        if self.dead_bytes > COMPACT_MIN_BYTES and self.dead_bytes * 2 > len(self.map):
+            self._compact()
+
+    def put(self, number, voucher, mtime=None):
+        """Archive `voucher` as number `number`, superseding any earlier version."""
+        self.put_many([(number, voucher, mtime)])
+
+    def append(self, voucher, mtime=None):
+        """
+        Archive `voucher` under the next free number (above every number in the file).
+
+        Returns:
+            int: The voucher's number.
+        """
+        payload = json.dumps(voucher, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with self.lock:
+            number = self.highest + 1
+            self._append([(number, payload, mtime)])
+        return number
+
+    def put_many(self, vouchers):
+        """Archive (number, voucher, mtime) triples with one write (and one fsync)."""
+        records = [(number, json.dumps(voucher, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), mtime)
+                   for number, voucher, mtime in vouchers]
+        if records:
+            with self.lock:
+                self._append(records)
+
+    def remove(self, number):
+        """Write a tombstone for voucher `number`. Returns False if it was not archived."""
+        with self.lock:
+            if number not in self.index:
+                return False
+            self._append([(number, b"", None)])
+            return True
+
+    # --- reads ---
+    def raw(self, number):
+        """The stored JSON bytes of voucher `number`, or None."""
+        with self.lock:
+            entry = self.index.get(number)
+            if entry is None:
+                return None
+            offset = entry[0]
+            length = RECORD.unpack_from(self.map, offset)[0]
+            start = offset + RECORD.size
+            return self.map[start:start + length]
+
+    def get(self, number):
+        """Voucher `number` as a dict, or None if it is not archived."""
+        payload = self.raw(number)
+        return json.loads(payload) if payload is not None else None
+
+    def scan(self, numbers=None):
+        """
+        Yield (number, JSON bytes, mtime) of the archived vouchers in file order.
+
+        Args:
+            numbers (iterable): Only these voucher numbers (default: all).
+        """
+        with self.lock:
+            wanted = self.index if numbers is None else {n: self.index[n] for n in numbers if n in self.index}
+            entries = sorted((offset, number, mtime) for number, (offset, mtime) in wanted.items())
+            data = self.map  # later writes remap; this view stays valid for the scan
+        for offset, number, mtime in entries:
+            start = offset + RECORD.size
+            yield number, data[start:start + RECORD.unpack_from(data, offset)[0]], mtime or None
+
+    def items(self, numbers=None):
+        """Yield (number, voucher dict, mtime), parsing one voucher at a time."""
+        for number, payload, mtime in self.scan(numbers):
+            yield number, json.loads(payload), mtime
+
+    # --- maintenance ---
+    def compact(self):
+        """Rewrite the archive with only the current version of each voucher, in number order."""
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        index = {}
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            offset = len(MAGIC)
+            for number in sorted(self.index):
+                record_offset, mtime = self.index[number]
+                size = self._record_size(record_offset)
+                f.write(self.map[record_offset:record_offset + size])
+                index[number] = (offset, mtime)
+                offset += size
+            f.flush()
+            os.fsync(f.fileno())
+        self.map = None
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "r+b")
+        self._remap()
+        self.index = index
+        self.dead_bytes = 0
+        self.highest = max(index, default=0)
+
+    def import_json_files(self, directory="."):
+        """
+        Archive the "n.json" voucher files of `directory`.
+
+        Files already archived with the same modification time are skipped.
+
+        Returns:
+            tuple: (archived numbers, list of (filename, error message)).
+        """
+        batch, errors = [], []
+        for entry in os.scandir(directory):
+            number = voucher_number(entry.name)
+            if number is None or not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            mtime = entry.stat().st_mtime
+            if self.index.get(number, (None, None))[1] == mtime:
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    voucher = json.load(f)
+            except (OSError, ValueError) as e:
+                errors.append((entry.name, str(e)))
+                continue
+            if isinstance(voucher, dict) and "明细" in voucher:
+                batch.append((number, voucher, mtime))
+        self.put_many(batch)
+        return sorted(number for number, _, _ in batch), errors
+
+    def export_json_files(self, directory=".", numbers=None):
+        """
+        Write archived vouchers back out as "n.json" files (the layout main.py and batch.py use).
+
+        Each file is written atomically and gets the voucher's stored mtime,
+        so a later import (into the ledger or an archive) sees it unchanged.
+
+        Returns:
+            list of str: The files written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        written = []
+        for number, voucher, mtime in self.items(numbers):
+            path = os.path.join(directory, f"{number}.json")
+            write_file_atomic(path, json.dumps(voucher, ensure_ascii=False, indent=2))
+            if mtime:
+                os.utime(path, (mtime, mtime))
+            written.append(path)
+        return written
+
+    def stats(self):
+        return {"vouchers": len(self.index), "bytes": len(self.map), "dead_bytes": self.dead_bytes}
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+
+def main(argv=None):
+    """Convert between a directory of n.json files and a voucher archive."""
+    parser = argparse.ArgumentParser(description="Append-only voucher archive (import, export, compact).")
+    parser.add_argument("command", choices=["import", "export", "compact", "stats"])
+    parser.add_argument("directory", nargs="?", default=".", help="n.json directory for import/export")
+    parser.add_argument("--archive", default=ARCHIVE_PATH)
+    parser.add_argument("--numbers", type=int, nargs="+", help="export only these vouchers")
+    args = parser.parse_args(argv)
+    archive = VoucherArchive(args.archive, durable=False)
+    try:
+        if args.command == "import":
+            archived, errors = archive.import_json_files(args.directory)
+            for name, message in errors:
+                print(f"Failed to load {name}: {message}")
+            print(f"Archived {len(archived)} vouchers into {args.archive}")
+        elif args.command == "export":
+            written = archive.export_json_files(args.directory, args.numbers)
+            print(f"Exported {len(written)} vouchers to {args.directory}")
+        elif args.command == "compact":
+            before = archive.stats()["bytes"]
+            archive.compact()
+            print(f"Compacted {args.archive}: {before} -> {archive.stats()['bytes']} bytes")
+        print(json.dumps(archive.stats()))
+    finally:
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
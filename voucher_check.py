@@ -0,0 +1,200 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+
+VAT_RATE = Decimal("0.13")
+CENT = Decimal("0.01")
+VAT_ACCOUNT = "增值税"
+# Accepted VAT rates, the general 13% first (9%/6% sales and services, small-scale 3%/1%, 5%)
+VAT_RATES = (VAT_RATE, Decimal("0.09"), Decimal("0.06"), Decimal("0.05"), Decimal("0.03"), Decimal("0.01"))
+# Lines VAT is levied on: 销项税额 on revenue, 进项税额 on purchases (一级科目)
+REVENUE_ACCOUNTS = ("主营业务收入", "其他业务收入")
+PURCHASE_ACCOUNTS = ("库存商品", "原材料", "在途物资", "材料采购", "周转材料", "委托加工物资", "固定资产", "在建工程",
+                     "工程物资", "无形资产", "生产成本", "制造费用", "管理费用", "销售费用", "研发支出")
+VAT_TOLERANCE_FEN = 1  # rounding of the split done by the model
+
+
+class AmountError(ValueError):
+    """Raised when an amount in a voucher cannot be read as a number."""
+
+
+def to_decimal(value):
+    """
+    Convert a voucher amount (number, numeric string, None or "") to Decimal.
+
+    Floats go through str() so 0.1 stays 0.1 instead of its binary expansion.
+    NaN and infinities are not amounts.
+    """
+    if value is None or value == "":
+        return Decimal(0)
+    if isinstance(value, bool):
+        raise AmountError(f"not an amount: {value!r}")
+    try:
+        amount = value if isinstance(value, Decimal) else Decimal(str(value).replace(",", "").strip() or "0")
+    except InvalidOperation:
+        raise AmountError(f"not an amount: {value!r}")
+    if not amount.is_finite():
+        raise AmountError(f"not an amount: {value!r}")
+    return amount
+
+
+def to_fen(value):
+    """Amount as an integer number of fen (cents), rounded half up."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value * 100
+    if isinstance(value, str):
+        # Fast path for the usual "52100" / "3000.50" strings, no Decimal needed
+        text = value.replace(",", "").strip()
+        negative = text.startswith("-")
+        whole, _, frac = text.lstrip("+-").partition(".")
+        if whole.isdigit() and len(frac) <= 2 and (not frac or frac.isdigit()):
+            fen = int(whole) * 100 + int(frac.ljust(2, "0"))
+            return -fen if negative else fen
+    try:
+        return int(to_decimal(value).quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+    except InvalidOperation:  # too many digits to keep fen
+        raise AmountError(f"not an amount: {value!r}")
+
+
+def fen_to_number(fen):
+    """Integer fen back to a JSON friendly number (int when whole yuan)."""
+    if fen % 100 == 0:
+        return fen // 100
+    return float(Decimal(fen) / 100)
+
+
+def sum_fen(rows):
+    """Debit/credit totals of 明细 rows as integer fen."""
+    debit = credit = 0
+    for row in rows:
+        d = row.get("借方金额")
+        c = row.get("贷方金额")
+        if d:
+            debit += to_fen(d)
+        if c:
+            credit += to_fen(c)
+    return debit, credit
+
+
+def sum_amounts(rows):
+    """
+    Exact debit/credit totals of 明细 rows.
+
+    Amounts are summed as integer fen (plain numeric strings skip Decimal
+    parsing entirely), so tens of thousands of rows add up in milliseconds
+    without float drift.
+
+    Returns:
+        tuple: (total_debit, total_credit) as Decimal yuan.
+    """
+    debit, credit = sum_fen(rows)
+    return Decimal(debit) / 100, Decimal(credit) / 100
+
+
+def vat_on(net, rate=VAT_RATE):
+    """VAT on a net (tax-exclusive) amount, as Decimal rounded to the fen."""
+    return (to_decimal(net) * rate).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def vat_fen(rows, rates=VAT_RATES):
+    """
+    Check the 进项/销项 VAT lines of 明细 rows against the amounts they are levied on.
+
+    销项税额 lines are checked against the 收入 lines on the same side and
+    进项税额 lines against the purchase lines (PURCHASE_ACCOUNTS) on the same
+    side; the tax must be one of the standard `rates` of that net amount
+    (vat_on), within a fen. Other VAT lines
+    (进项税额转出, 未交增值税, ...) and VAT lines without a matching net line
+    are not checked.
+
+    Returns:
+        tuple: (expected, actual) VAT in integer fen over the checked lines
+        (expected at VAT_RATE if no rate fits), or (None, None) if nothing
+        was checked.
+    """
+    totals = {}  # (kind, field) -> [tax fen, net fen]
+    for row in rows:
+        account = str(row.get("科目") or "")
+        if VAT_ACCOUNT in account and "转出" not in account:
+            kind = "output" if "销项" in account else "input" if "进项" in account else None
+            slot = 0
+        elif any(name in account for name in REVENUE_ACCOUNTS):
+            kind, slot = "output", 1
+        elif account.split("-")[0] in PURCHASE_ACCOUNTS:
+            kind, slot = "input", 1
+        else:
+            continue
+        if kind is None:
+            continue
+        for field in ("借方金额", "贷方金额"):
+            if row.get(field):
+                totals.setdefault((kind, field), [0, 0])[slot] += to_fen(row[field])
+    expected = actual = None
+    for tax, net in totals.values():
+        if not tax or not net:
+            continue
+        amounts = [int(vat_on(Decimal(net) / 100, rate) * 100) for rate in rates]
+        fits = [vat for vat in amounts if abs(vat - tax) <= VAT_TOLERANCE_FEN]
+        expected = (expected or 0) + (fits[0] if fits else amounts[0])
+        actual = (actual or 0) + tax
+    return expected, actual
+
+
+def verify_voucher(voucher):
+    """
+    Recompute the 合计 block of a voucher and mark it balanced or not.
+
+    The voucher is updated in place: 借方合计/贷方合计 are replaced with the
+    exact sums of 明细 and 平衡 is set from them, whatever the model claimed.
+    进项/销项 VAT lines are checked against their net amount (vat_fen), within a fen.
+
+    Returns:
+        dict: {"balanced", "debit", "credit", "difference", "claimed",
+        "vat_ok", "vat_expected", "vat_actual"} where "claimed" is the 合计
+        the model produced (or None) and the VAT amounts are None when the
+        voucher has no VAT lines to check.
+    """
+    rows = voucher.get("明细", [])
+    debit, credit = sum_fen(rows)
+    vat_expected, vat_actual = vat_fen(rows)
+    claimed = voucher.get("合计")
+    voucher["合计"] = {
+        "借方合计": fen_to_number(debit),
+        "贷方合计": fen_to_number(credit),
+        "平衡": debit == credit,
+    }
+    return {
+        "balanced": debit == credit,
+        "debit": Decimal(debit) / 100,
+        "credit": Decimal(credit) / 100,
+        "difference": Decimal(debit - credit) / 100,
+        "claimed": dict(claimed) if isinstance(claimed, dict) else None,
+        "vat_ok": vat_expected is None or abs(vat_expected - vat_actual) <= VAT_TOLERANCE_FEN,
+        "vat_expected": None if vat_expected is None else Decimal(vat_expected) / 100,
+        "vat_actual": None if vat_actual is None else Decimal(vat_actual) / 100,
+    }
+
+
+def correction_message(result):
+    """
+    Targeted follow-up asking the model to fix only the wrong amounts.
+
+    Names the two totals and the difference of an unbalanced voucher and/or
+    the VAT found and expected. Sent as the next user turn after the model's
+    own reply, so it corrects the voucher it already drafted instead of
+    starting over.
+    """
+    problems = []
+    if not result["balanced"]:
+        problems.append(
+            f"凭证借贷不平衡：明细中借方金额合计为 {result['debit']}，贷方金额合计为 {result['credit']}，"
+            f"差额为 {result['difference']}。"
+        )
+    if not result.get("vat_ok", True):
+        problems.append(
+            f"增值税额有误：明细中进项/销项税额合计为 {result['vat_actual']}，按不含税金额和13%税率应为 {result['vat_expected']}。"
+        )
+    return (
+        "".join(problems)
+        + "请只修正有误的明细金额（含税金额请按13%增值税率拆分为不含税金额和税额），"
+        "保持其他内容不变，并只返回修正后的完整Json对象。"
+    )
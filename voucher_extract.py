@@ -0,0 +1,192 @@
+import json
+import math
+import re
+import threading
+
+
+DETAIL_FIELDS = ("编号", "科目", "摘要", "借方金额", "贷方金额")
+
+# The agent_1 example prompt contains `"平衡“: true`, and models copy it.
+# Full-width quotes right before a colon are repaired to ASCII ones.
+_FULLWIDTH_KEY_QUOTE = re.compile(r'[“”]\s*:')
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+
+
+class VoucherFormatError(ValueError):
+    """Raised when no valid voucher JSON object can be found in a reply."""
+
+
+class JsonObjectScanner:
+    """
+    Incremental scanner that finds top-level JSON objects in free text.
+
+    Text can be fed in chunks (e.g. straight from a streamed reply); every
+    balanced {...} span is returned as soon as its closing brace arrives.
+    Braces inside JSON strings are ignored, surrounding markdown is skipped.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk):
+        """
+        Scan another piece of text.
+
+        Returns:
+            list of str: Complete top-level object spans finished in this chunk.
+        """
+        found = []
+        for ch in chunk:
+            if self.depth == 0:
+                if ch == "{":
+                    self.depth = 1
+                    self.buffer = [ch]
+                continue
+            self.buffer.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    found.append("".join(self.buffer))
+                    self.buffer = []
+        return found
+
+
+def _repair(text):
+    text = _FULLWIDTH_KEY_QUOTE.sub('":', text)
+    return _TRAILING_COMMA.sub(r"\1", text)
+
+
+def _is_amount(value):
+    if value is None or value == "":
+        return True
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return math.isfinite(value)
+    try:
+        # "NaN" and "Infinity" parse as floats but are not amounts
+        return math.isfinite(float(str(value).replace(",", "")))
+    except (ValueError, OverflowError):
+        return False
+
+
+def validate_voucher(voucher):
+    """
+    Check a parsed object against the 明细/合计 voucher schema.
+
+    Returns:
+        list of str: Problems found (empty when the voucher is valid).
+    """
+    if not isinstance(voucher, dict):
+        return ["voucher is not a JSON object"]
+    problems = []
+    details = voucher.get("明细")
+    if not isinstance(details, list) or not details:
+        problems.append("明细 must be a non-empty list")
+        details = []
+    for i, entry in enumerate(details):
+        if not isinstance(entry, dict):
+            problems.append(f"明细[{i}] is not an object")
+            continue
+        for field in DETAIL_FIELDS:
+            if field not in entry:
+                problems.append(f"明细[{i}] is missing {field}")
+        for field in ("借方金额", "贷方金额"):
+            if not _is_amount(entry.get(field)):
+                problems.append(f"明细[{i}].{field} is not a number: {entry.get(field)!r}")
+    summary = voucher.get("合计")
+    if summary is not None:
+        if not isinstance(summary, dict):
+            problems.append("合计 is not an object")
+        else:
+            for field in ("借方合计", "贷方合计"):
+                if field in summary and not _is_amount(summary[field]):
+                    problems.append(f"合计.{field} is not a number: {summary[field]!r}")
+    return problems
+
+
+def _candidate_spans(text):
+    spans = JsonObjectScanner().feed(text)
+    yield from spans
+    # A stray unbalanced "{" in the prose can hide the real object from the
+    # scanner; fall back to trying a JSON decode at every brace.
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            _, end = decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            start = text.find("{", start + 1)
+            continue
+        span = text[start:end]
+        if span not in spans:
+            yield span
+        start = text.find("{", end)
+
+
+def extract_voucher(text):
+    """
+    Find, parse and validate the voucher JSON object in an agent reply.
+
+    Works on fenced (```json) or bare JSON mixed with the markdown table.
+    When several objects are present the first valid voucher wins.
+
+    Raises:
+        VoucherFormatError: If no valid voucher object is found.
+    """
+    errors = []
+    repaired = _repair(text)
+    for source in (text, repaired) if repaired != text else (text,):
+        for span in _candidate_spans(source):
+            try:
+                candidate = json.loads(span)
+            except json.JSONDecodeError as e:
+                errors.append(f"invalid JSON: {e}")
+                continue
+            if not isinstance(candidate, dict) or "明细" not in candidate:
+                continue
+            problems = validate_voucher(candidate)
+            if not problems:
+                return candidate
+            errors.extend(problems)
+    if not errors:
+        errors.append("no JSON object with 明细 found")
+    raise VoucherFormatError("; ".join(errors))
+
+
+class ExtractionStats:
+    """Thread-safe counters of how vouchers were extracted."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"local": 0, "fallback": 0, "failed": 0}
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def fallback_rate(self):
+        with self.lock:
+            total = sum(self.counts.values())
+            return (self.counts["fallback"] + self.counts["failed"]) / total if total else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+extraction_stats = ExtractionStats()
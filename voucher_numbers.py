@@ -0,0 +1,109 @@
+import os
+import threading
+
+
+SEQUENCE_FILE = ".voucher_seq"
+
+
+def write_file_atomic(file_path, content):
+    """
+    Write `content` to `file_path` via a temporary file and rename.
+
+    Readers see either the old file or the complete new one, never a
+    half-written voucher.
+    """
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+class VoucherNumberAllocator:
+    """
+    Hands out voucher numbers ("n.json") for one directory in constant time.
+
+    The highest number handed out is persisted in a small sequence file, so
+    the next number is known without probing 1.json, 2.json, ... Each number
+    is claimed by creating its file with O_EXCL, which fails if another
+    thread or process got there first; the allocator then simply moves on.
+    """
+
+    def __init__(self, directory=".", extension="json"):
+        self.directory = directory
+        self.extension = extension
+        self.sequence_path = os.path.join(directory, SEQUENCE_FILE)
+        self.lock = threading.Lock()
+        self.high_water = None
+
+    def _load_high_water(self):
+        try:
+            with open(self.sequence_path, "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            pass
+        # First use in this directory: one scan to find the largest existing number
+        suffix = "." + self.extension
+        highest = 0
+        for entry in os.scandir(self.directory):
+            stem = entry.name[:-len(suffix)] if entry.name.endswith(suffix) else ""
+            if stem.isdigit():
+                highest = max(highest, int(stem))
+        return highest
+
+    def _save_high_water(self):
+        write_file_atomic(self.sequence_path, str(self.high_water))
+
+    def path_for(self, number):
+        return os.path.join(self.directory, f"{number}.{self.extension}")
+
+    def reserve(self):
+        """
+        Claim the next free voucher number.
+
+        An empty file is created for it (O_CREAT | O_EXCL) so nobody else can
+        take the same number; fill it with write_file_atomic.
+
+        Returns:
+            int: The reserved number.
+        """
+        with self.lock:
+            if self.high_water is None:
+                self.high_water = self._load_high_water()
+            number = self.high_water + 1
+            while True:
+                try:
+                    fd = os.open(self.path_for(number), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    number += 1  # taken by another process or written by hand
+                    continue
+                os.close(fd)
+                break
+            self.high_water = number
+            self._save_high_water()
+            return number
+
+    def save(self, content):
+        """
+        Reserve a number and write `content` to its file.
+
+        Returns:
+            str: The name of the file created.
+        """
+        number = self.reserve()
+        write_file_atomic(self.path_for(number), content)
+        return f"{number}.{self.extension}"
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(directory=".", extension="json"):
+    """Return the shared allocator for a directory, so all threads use one lock."""
+    key = (os.path.abspath(directory), extension)
+    with _allocators_lock:
+        if key not in _allocators:
+            _allocators[key] = VoucherNumberAllocator(directory, extension)
+        return _allocators[key]
@@ -0,0 +1,168 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import threading
+import time
+
+from ledger_store import voucher_number
+
+
+# inotify event masks (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify():
+    """Return (libc, inotify fd) or None when inotify is not available (non-Linux, no libc)."""
+    if not hasattr(os, "uname") or os.uname().sysname != "Linux":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return libc, fd
+
+
+class VoucherWatcher:
+    """
+    Background watcher that ingests new or changed "n.json" voucher files.
+
+    Uses inotify where available and falls back to polling directory mtimes.
+    Only the files that changed are parsed (off the UI thread) and written to
+    the ledger; `on_change` then receives a list of (number, rows) deltas,
+    rows being None for a deleted voucher. Bursts of events are coalesced.
+    """
+
+    def __init__(self, directory, ledger, on_change, poll_interval=2.0, debounce=0.2, use_inotify=True):
+        self.directory = os.fspath(directory)
+        self.ledger = ledger
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.backend = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="voucher-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def run(self):
+        inotify = _load_inotify() if self.use_inotify else None
+        if inotify is not None:
+            libc, fd = inotify
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK)
+            if wd >= 0:
+                self.backend = "inotify"
+                try:
+                    self._run_inotify(fd)
+                finally:
+                    os.close(fd)
+                return
+            os.close(fd)
+        self.backend = "polling"
+        self._run_polling()
+
+    def _run_inotify(self, fd):
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([fd], [], [], 0.5)
+            if not ready:
+                continue
+            names = set()
+            # Coalesce a burst (e.g. temp file + rename) into one ingest
+            deadline = time.monotonic() + self.debounce
+            while True:
+                names.update(self._read_events(fd))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    break
+            self.ingest(names)
+
+    @staticmethod
+    def _read_events(fd):
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+            offset += length
+            if name:
+                names.append(name)
+        return names
+
+    def _snapshot(self):
+        snapshot = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json") and voucher_number(entry.name) is not None:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.name] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def _run_polling(self):
+        previous = self._snapshot()
+        while not self.stop_event.wait(self.poll_interval):
+            current = self._snapshot()
+            changed = {name for name, stat in current.items() if previous.get(name) != stat}
+            changed.update(set(previous) - set(current))
+            previous = current
+            if changed:
+                self.ingest(changed)
+
+    def ingest(self, names):
+        """
+        Parse the given files, update the ledger and report the deltas.
+
+        Files the ledger already holds at the same mtime (e.g. saved by this
+        app a moment ago) are skipped.
+        """
+        deltas = []
+        for name in sorted(names):
+            number = voucher_number(name)
+            if number is None or not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if self.ledger.has_voucher(number):
+                    self.ledger.remove_voucher(number)
+                    deltas.append((number, None))
+                continue
+            if stat.st_size == 0 or self.ledger.file_mtime(number) == stat.st_mtime:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    voucher = json.load(f)
+            except (OSError, ValueError):
+                continue  # half-written by a non-atomic writer; the next event retries
+            if not isinstance(voucher, dict) or "明细" not in voucher:
+                continue
+            deltas.append((number, self.ledger.add_voucher(number, voucher, name, stat.st_mtime)))
+        if deltas:
+            self.on_change(deltas)
+        return deltas